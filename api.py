@@ -1,22 +1,32 @@
 from io import BytesIO
 import os
 from PIL import Image
-import requests
+from threading import Thread
+from typing import List
 from uuid import uuid4 as uuid
 
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, File, Form, Request, UploadFile
 from fastapi.exceptions import HTTPException
-from google.cloud import storage
-import uvicorn
-
-from components import (
-  ReplicateMaskGen,
-  ReplicateInPainting,
-  LocalMaskGen,
-  OverlayImage
-)
+from fastapi.responses import FileResponse, JSONResponse
+import pydantic
+
+# components and their backends are imported on first use to keep cold starts fast
+import components
+from components import model_registry
+from components.compositing import Placement
+from components.admission import AdmissionController, AdmissionRejected, EndpointLimit, Priority, load_limits
+from components.deadline import DeadlineExceeded, check_deadline, parse_deadline, request_deadline, run_blocking
+from components.http_client import get_http_client
+from components.lazy_import import import_timings
+from components.micro_batcher import MicroBatcher
+from components.profiling import Profiler, current_session
+from components.replicate_base import PredictionFailed
+from components.storage import get_storage
+from components.upload_guard import UploadGuard, UploadRejected
+from components.usage import BudgetExceeded, get_usage_ledger
 from domain.schemas import (
   OverlayRequestGenerate,
+  OverlayPlacement,
   ImageListResponse,
 )
 from domain.enums import MaskGen
@@ -25,6 +35,25 @@ from domain.enums import MaskGen
 # initialize fastapi app
 app = FastAPI()
 
+# limits memory held by uploads across all requests on this worker
+upload_guard = UploadGuard()
+
+# opt in per request cpu and allocation profiles, see components/profiling.py
+profiler = Profiler()
+
+# concurrency, queue length and priority per endpoint, endpoints not listed
+# (health checks, debug) are never queued. overridable with ADMISSION_LIMITS
+ADMISSION_LIMITS = {
+  "/overlay-image": EndpointLimit(max_concurrency=8, max_queue=32, priority=Priority.HIGH),
+  "/overlay-batch": EndpointLimit(max_concurrency=4, max_queue=16, priority=Priority.NORMAL),
+  "/create-binary-mask": EndpointLimit(max_concurrency=8, max_queue=32, priority=Priority.NORMAL),
+  "/infill-background": EndpointLimit(max_concurrency=4, max_queue=8, priority=Priority.LOW),
+  "/generate-background": EndpointLimit(max_concurrency=4, max_queue=8, priority=Priority.LOW),
+}
+admission = AdmissionController(load_limits(ADMISSION_LIMITS))
+# applied to requests that don't send a deadline, unset means no deadline
+DEFAULT_REQUEST_TIMEOUT = float(os.environ["REQUEST_TIMEOUT_SECONDS"]) if os.environ.get("REQUEST_TIMEOUT_SECONDS") else None
+
 
 # Google Cloud Provider constants
 BUCKET_NAME = "width-image-bucket"
@@ -32,6 +61,16 @@ PROJECT_NAME = "triple-whale-staging"
 SA_JSON_PATH = "triple-whale-staging-83e688a363fe.json"
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = SA_JSON_PATH
 
+# where endpoint outputs are written, `gcs` (default), `local` or `memory`
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "gcs")
+STORAGE_ROOT = os.environ.get("STORAGE_ROOT", "output-images")
+output_storage = get_storage(
+  backend=STORAGE_BACKEND,
+  root=STORAGE_ROOT,
+  bucket_name=BUCKET_NAME,
+  project=PROJECT_NAME
+)
+
 
 # convert image to byte array and return
 # used for upload byte data as string
@@ -42,85 +81,222 @@ def convert_image_to_bytes(image: Image):
   return imgByteArr.getvalue()
 
 
-# upload byte data as string to gcs bucket
-# returns path to object
-def upload_data_to_gcs(data, target_key):
+# download model outputs in parallel over the pooled client
+# and upload them concurrently to output storage
+def request_and_upload_images(urls):
+  contents = get_http_client().fetch_many(urls, return_exceptions=True)
+  items = [(f'{uuid()}.png', content) for content in contents if not isinstance(content, Exception)]
+  # failed downloads and uploads are left out
+  image_paths = output_storage.write_many(items)
+  return [image_path for image_path in image_paths if image_path]
+
+
+# run local segmentation for a micro batch of uploaded files
+def segment_uploads(image_files):
+  images = [Image.open(image_file) for image_file in image_files]
+  return components.LocalMaskGen().segment_images(images)
+
+
+# concurrent local mask requests that arrive within the window share one onnx call
+mask_batcher = MicroBatcher(
+  process_batch=segment_uploads,
+  max_batch_size=int(os.environ.get("MASK_BATCH_SIZE", 8)),
+  window_seconds=float(os.environ.get("MASK_BATCH_WINDOW_MS", 10)) / 1000
+)
+
+
+# converts each image passed in a list and uploads them concurrently
+def convert_and_upload_images(images):
+  # convert images to bytes
+  items = [(f'{uuid()}.png', convert_image_to_bytes(image)) for image in images]
+  # upload byte data to output storage, failed uploads come back as None
+  image_paths = output_storage.write_many(items)
+  return [image_path for image_path in image_paths if image_path]
+
+# load every model the endpoints use
+def preload_models(rembg: bool = True):
+  model_registry.preload(
+    rembg_models=(model_registry.DEFAULT_REMBG_MODEL,) if rembg else (),
+    replicate_models=[
+      (model.model_name, model.model_version_id)
+      for model in (components.ReplicateInPainting, components.ReplicateMaskGen, components.OverlayImage)
+    ]
+  )
+
+
+# load models this worker needs, anything already loaded by a preforking parent is reused
+def warm_models():
   try:
-    client = storage.Client(project=PROJECT_NAME)
-    bucket = client.bucket(BUCKET_NAME)
-    bucket.blob(target_key).upload_from_string(data)
-    return bucket.blob(target_key).public_url
+    preload_models()
+    model_registry.set_ready()
   except Exception as e:
     print(e)
-  return None
 
 
-# simple method used to download img from url
-# and upload to gcs
-def request_and_upload_image(url):
+@app.on_event("startup")
+def start_warming_models():
+  # warm in the background so /health answers while models load
+  if not model_registry.is_ready():
+    Thread(target=warm_models, daemon=True).start()
+
+
+# registered before admission control so it runs inside it and queue time isn't profiled
+@app.middleware("http")
+async def request_profiling(request: Request, call_next):
+  if not profiler.should_profile(request.headers.get("x-profile")):
+    return await call_next(request)
+  with profiler.session(f"{request.method} {request.url.path}") as session:
+    response = await call_next(request)
+  if session is not None:
+    response.headers["X-Profile-Id"] = session.profile_id
+  return response
+
+
+# clients can ask for a lower priority than their endpoint's (e.g. batch jobs), never a higher one
+def request_priority(request: Request, limit: EndpointLimit):
+  requested = request.headers.get("x-priority", "").upper()
+  if requested in Priority.__members__:
+    return max(limit.priority, Priority[requested])
+  return limit.priority
+
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+  # the deadline is visible to everything the request runs, see components/deadline.py
+  deadline = parse_deadline(request.headers, default_timeout=DEFAULT_REQUEST_TIMEOUT)
+  token = request_deadline.set(deadline)
   try:
-    response = requests.get(url)
-    img_path = upload_data_to_gcs(
-      data=response.content,
-      target_key=f'{uuid()}.png'
-    )
-    if img_path:
-      return img_path
-  except Exception as e:
-    print(e)
-  return None
+    path = request.url.path
+    limit = admission.limit_for(path)
+    if limit is None:
+      return await call_next(request)
+    try:
+      async with admission.admit(path, request_priority(request, limit), deadline):
+        return await call_next(request)
+    except AdmissionRejected as e:
+      headers = {"Retry-After": str(e.retry_after)} if e.retry_after else None
+      return JSONResponse(status_code=e.status_code, content={"detail": e.detail}, headers=headers)
+  finally:
+    request_deadline.reset(token)
 
 
-# calls convert and gcs upload functions for each image passed in a list
-def convert_and_upload_images(images):
-  image_paths = []
-  for image in images:
-    # convert image to bytes
-    image_bytes = convert_image_to_bytes(image)
-    # upload byte data to google cloud storage bucket
-    image_path = upload_data_to_gcs(
-      data=image_bytes,
-      target_key=f'{uuid()}.png'
-    )
-    if image_path:
-      image_paths.append(image_path)
-  return image_paths
+# registered last so it runs first, an oversized body is refused before it takes an admission slot
+@app.middleware("http")
+async def upload_size_limit(request: Request, call_next):
+  try:
+    upload_guard.check_content_length(request.headers)
+  except UploadRejected as e:
+    return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+  return await call_next(request)
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded_handler(request: Request, exc: DeadlineExceeded):
+  return JSONResponse(status_code=504, content={"detail": str(exc)})
+
+
+@app.exception_handler(UploadRejected)
+async def upload_rejected_handler(request: Request, exc: UploadRejected):
+  return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+
+
+@app.exception_handler(BudgetExceeded)
+async def budget_exceeded_handler(request: Request, exc: BudgetExceeded):
+  return JSONResponse(status_code=429, content={"detail": str(exc)})
+
 
 @app.get("/health")
 def health():
   return "ok"
 
 
+@app.get("/ready")
+def ready():
+  # only report ready once models are loaded so traffic is not routed to a cold worker
+  if not model_registry.is_ready():
+    raise HTTPException(503, detail="models loading")
+  return "ok"
+
+
+@app.get("/debug/import-timings")
+def debug_import_timings():
+  # seconds spent importing each lazily loaded module in this worker
+  return import_timings()
+
+
+@app.get("/debug/http")
+def debug_http():
+  # downloads, retries, bytes and latency of the pooled output client, per host
+  return get_http_client().metrics()
+
+
+@app.get("/debug/admission")
+async def debug_admission():
+  # active and queued requests per endpoint on this worker
+  return admission.metrics()
+
+
+@app.get("/debug/profiles")
+def debug_profiles():
+  # latest request profiles on this worker, newest first
+  return profiler.list()
+
+
+@app.get("/debug/profiles/{profile_id}")
+def debug_profile(profile_id: str):
+  summary = profiler.get(profile_id)
+  if summary is None:
+    raise HTTPException(404, detail="profile not found")
+  return summary
+
+
+@app.get("/debug/profiles/{profile_id}/pstats")
+def debug_profile_pstats(profile_id: str):
+  # raw cProfile output for snakeviz or pstats
+  summary = profiler.get(profile_id)
+  if summary is None:
+    raise HTTPException(404, detail="profile not found")
+  return FileResponse(summary["artifacts"]["pstats"], filename=f"{profile_id}.prof")
+
+
+@app.get("/usage")
+def usage():
+  # replicate predictions and gpu seconds used by this worker, per endpoint, prompt and batch
+  return get_usage_ledger().to_dict()
+
+
 @app.post("/create-binary-mask")
 async def create_binary_mask(
   input_image: UploadFile = File(...),
   mask_gen: MaskGen = MaskGen.LOCAL
 ):
-  # read in image data
-  input_image_data = await input_image.read()
-  # check which mask gen to use
-  if mask_gen.value == MaskGen.LOCAL.value:
-    local_mask_gen = LocalMaskGen()
-    # generate mask image
-    mask_image = local_mask_gen.create_binary_mask_endpoint(
-      input_image=BytesIO(input_image_data)
-    )
-    # generate no background image
-    no_background_image = local_mask_gen.remove_background(
-      BytesIO(input_image_data)
-    )
-    # convert images to bytes and upload to gcs, get image paths
-    image_paths = convert_and_upload_images(images=[mask_image, no_background_image])
-    return ImageListResponse(output = image_paths)
-  elif mask_gen.value == MaskGen.REPLICATE.value:
-    replicate_mask_gen = ReplicateMaskGen()
-    # TODO: fix no_background_image (inverted)
-    mask_image, no_background_image = replicate_mask_gen.create_binary_mask_endpoint(
-      input=BytesIO(input_image_data)
-    )
-    # convert images to bytes and upload to gcs, get image paths
-    image_paths = convert_and_upload_images(images=[mask_image, no_background_image])
-    return ImageListResponse(output = image_paths)
+  # check the upload and hold memory budget while it is processed
+  async with upload_guard.admit(input_image) as (input_image_file,):
+    # waiting for upload budget may have used up the deadline
+    check_deadline("segmentation")
+    # check which mask gen to use
+    if mask_gen.value == MaskGen.LOCAL.value:
+      if current_session.get() is not None:
+        # a shared batch would run outside this request's profile, segment it on its own
+        mask_image, no_background_image = (await run_blocking(segment_uploads, [input_image_file]))[0]
+      else:
+        # generate mask and no background image, batched with other requests
+        mask_image, no_background_image = await mask_batcher.submit(input_image_file)
+      # convert images to bytes and upload to gcs, get image paths
+      image_paths = await run_blocking(convert_and_upload_images, images=[mask_image, no_background_image])
+      return ImageListResponse(output = image_paths)
+    elif mask_gen.value == MaskGen.REPLICATE.value:
+      replicate_mask_gen = components.ReplicateMaskGen()
+      replicate_mask_gen.set_usage_labels(endpoint="/create-binary-mask")
+      # TODO: fix no_background_image (inverted)
+      # blocking work runs off the event loop so queued and cheap requests keep moving
+      mask_image, no_background_image = await run_blocking(
+        replicate_mask_gen.create_binary_mask_endpoint,
+        input=input_image_file
+      )
+      # convert images to bytes and upload to gcs, get image paths
+      image_paths = await run_blocking(convert_and_upload_images, images=[mask_image, no_background_image])
+      return ImageListResponse(output = image_paths)
 
 
 @app.post("/infill-background")
@@ -130,18 +306,20 @@ async def infill_background(
   prompt: str = "",
   num_outputs: int = 2,
 ):
-  # read in images
-  input_image_data = await input_image.read()
-  mask_image_data = await mask_image.read()
-  inpainter = ReplicateInPainting()
-  output = inpainter.run_endpoint(
-    image=input_image_data,
-    mask_image=mask_image_data,
-    prompt=prompt,
-    num_outputs=num_outputs
-  )
+  # check the uploads and hold memory budget while they are processed
+  async with upload_guard.admit(input_image, mask_image) as (input_image_file, mask_image_file):
+    check_deadline("inpainting")
+    inpainter = components.ReplicateInPainting()
+    inpainter.set_usage_labels(endpoint="/infill-background")
+    output = await run_blocking(
+      inpainter.run_endpoint,
+      image=input_image_file,
+      mask_image=mask_image_file,
+      prompt=prompt,
+      num_outputs=num_outputs
+    )
 
-  image_paths = [request_and_upload_image(url) for url in output]
+  image_paths = await run_blocking(request_and_upload_images, output or [])
   if image_paths:
     return ImageListResponse(output=image_paths)
   else:
@@ -149,11 +327,18 @@ async def infill_background(
 
 
 @app.post("/generate-background")
-def generate_background(request: OverlayRequestGenerate):
-  overlay = OverlayImage()
-  output = overlay.generate_scenes_endpoint(prompt=request.prompt, num_outputs=request.num_outputs)
-  image_paths = [request_and_upload_image(url) for url in output]
-  return ImageListResponse(output = image_paths)
+async def generate_background(request: OverlayRequestGenerate):
+  overlay = components.OverlayImage()
+  overlay.set_usage_labels(endpoint="/generate-background")
+  try:
+    output = await run_blocking(overlay.generate_scenes_endpoint, prompt=request.prompt, num_outputs=request.num_outputs)
+  except PredictionFailed as e:
+    raise HTTPException(502, detail=str(e))
+  image_paths = await run_blocking(request_and_upload_images, output or [])
+  if image_paths:
+    return ImageListResponse(output=image_paths)
+  else:
+    raise HTTPException(500, detail="No output from model")
 
 
 @app.post("/overlay-image")
@@ -163,21 +348,58 @@ async def overlay_image(
   x_pos: int = 0,
   y_pos: int = 0,
 ):
-  # read in images
-  background_file_data = await background_file.read()
-  foreground_file_data = await foreground_file.read()
-  # start overlay process
-  overlay = OverlayImage()
-  output = overlay.overlay_image_endpoint(
-    background_img=background_file_data,
-    foreground_img=foreground_file_data,
-    x_pos=x_pos,
-    y_pos=y_pos
-  )
-  # convert image to bytes and upload to gcs, get image path
-  image_paths = convert_and_upload_images(images=[output])
+  # check the uploads and hold memory budget while they are processed
+  async with upload_guard.admit(background_file, foreground_file) as (background_image_file, foreground_image_file):
+    check_deadline("overlaying")
+    # start overlay process
+    overlay = components.OverlayImage()
+    output = await run_blocking(
+      overlay.overlay_image_endpoint,
+      background_img=background_image_file,
+      foreground_img=foreground_image_file,
+      x_pos=x_pos,
+      y_pos=y_pos
+    )
+    # convert image to bytes and upload to gcs, get image path
+    image_paths = await run_blocking(convert_and_upload_images, images=[output])
+  return ImageListResponse(output = image_paths)
+
+
+@app.post("/overlay-batch")
+async def overlay_batch(
+  foreground_file: UploadFile = File(...),
+  background_files: List[UploadFile] = File(...),
+  placements: str = Form(""),
+):
+  # placements is a json list of {"scene", "x", "y", "scale", "anchor"}, scene indexes
+  # background_files. empty means one top left placement per background
+  try:
+    requested = pydantic.parse_raw_as(List[OverlayPlacement], placements) if placements else []
+    layouts = [
+      Placement(scene=p.scene, x=p.x, y=p.y, scale=p.scale, anchor=p.anchor.value)
+      for p in requested
+    ]
+  except ValueError as e:
+    # pydantic.ValidationError is a ValueError too
+    raise HTTPException(status_code=400, detail=f"invalid placements: {e}")
+  # check the uploads and hold memory budget while they are processed
+  async with upload_guard.admit(foreground_file, *background_files) as (foreground_image_file, *background_image_files):
+    check_deadline("overlaying")
+    overlay = components.OverlayImage()
+    try:
+      outputs = await run_blocking(
+        overlay.overlay_batch_endpoint,
+        foreground_img=foreground_image_file,
+        background_imgs=background_image_files,
+        placements=layouts,
+      )
+    except ValueError as e:
+      raise HTTPException(status_code=400, detail=str(e))
+    # convert images to bytes and upload them concurrently
+    image_paths = await run_blocking(convert_and_upload_images, images=outputs)
   return ImageListResponse(output = image_paths)
 
 
 if __name__ == '__main__':
+  import uvicorn
   uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
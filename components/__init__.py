@@ -1,5 +1,17 @@
-from components.local_mask_generate import LocalMaskGen
-from components.overlay_image import OverlayImage
-from components.replicate_inpaint import ReplicateInPainting
-from components.replicate_mask_generate import ReplicateMaskGen
+from components.lazy_import import timed_import
 
+# components are imported on first use so callers only pay for the backends they need
+_COMPONENT_MODULES = {
+  "LocalMaskGen": "components.local_mask_generate",
+  "OverlayImage": "components.overlay_image",
+  "ReplicateInPainting": "components.replicate_inpaint",
+  "ReplicateMaskGen": "components.replicate_mask_generate",
+}
+
+__all__ = list(_COMPONENT_MODULES)
+
+
+def __getattr__(name):
+  if name in _COMPONENT_MODULES:
+    return getattr(timed_import(_COMPONENT_MODULES[name]), name)
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
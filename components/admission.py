@@ -0,0 +1,247 @@
+import asyncio
+from contextlib import asynccontextmanager
+from enum import IntEnum
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import time
+
+"""
+Admission control for the api. Every limited endpoint gets a concurrency cap
+and a bounded waiting queue, on top of a worker wide cap shared by all of them.
+When a slot frees up the waiter with the best priority class whose endpoint
+has room goes first, and a few worker wide slots are kept for high and normal
+priority requests, so a burst of slow inpainting calls can't starve the cheap
+endpoints. Full queues shed load with a retry hint, and waiters whose
+deadline passes are dropped before they start any work
+"""
+
+# requests running at once on a worker, across all limited endpoints
+MAX_CONCURRENCY = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", 8))
+# of those, slots low priority requests never take, so they can't hold the whole worker
+RESERVED_SLOTS = int(os.environ.get("ADMISSION_RESERVED_SLOTS", 2))
+# longest a request without a deadline waits in a queue
+MAX_WAIT_SECONDS = float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", 60))
+# json overrides for the per endpoint limits, see `load_limits`
+LIMITS_OVERRIDE = os.environ.get("ADMISSION_LIMITS")
+# weight of the latest sample in the moving averages
+EWMA_WEIGHT = 0.2
+
+
+class Priority(IntEnum):
+  HIGH = 0
+  NORMAL = 1
+  LOW = 2
+
+
+class EndpointLimit:
+  def __init__(self, max_concurrency: int, max_queue: int, priority: Priority = Priority.NORMAL):
+    self.max_concurrency = max_concurrency
+    self.max_queue = max_queue
+    self.priority = Priority(priority)
+
+
+class AdmissionRejected(Exception):
+  def __init__(self, status_code: int, detail: str, retry_after: int = None):
+    super().__init__(detail)
+    self.status_code = status_code
+    self.detail = detail
+    self.retry_after = retry_after
+
+
+def load_limits(defaults, override: str = LIMITS_OVERRIDE):
+  """
+  merge `ADMISSION_LIMITS` over the defaults, e.g.
+  {"/infill-background": {"max_concurrency": 1, "max_queue": 4, "priority": "low"}}
+  """
+  limits = dict(defaults)
+  if not override:
+    return limits
+  for path, values in json.loads(override).items():
+    current = limits.get(path) or EndpointLimit(MAX_CONCURRENCY, MAX_CONCURRENCY)
+    priority = values.get("priority", current.priority)
+    limits[path] = EndpointLimit(
+      max_concurrency=values.get("max_concurrency", current.max_concurrency),
+      max_queue=values.get("max_queue", current.max_queue),
+      priority=Priority[priority.upper()] if isinstance(priority, str) else priority,
+    )
+  return limits
+
+
+class EndpointStats:
+  def __init__(self):
+    self.active = 0
+    self.queued = 0
+    self.admitted = 0
+    self.shed = 0
+    self.expired = 0
+    self.completed = 0
+    self.wait_seconds = 0.0
+    self.service_seconds = 0.0
+
+
+  def observe(self, attribute, seconds):
+    previous = getattr(self, attribute)
+    setattr(self, attribute, seconds if not previous else previous + EWMA_WEIGHT * (seconds - previous))
+
+
+class AdmissionController:
+  def __init__(
+    self,
+    limits,
+    max_concurrency: int = MAX_CONCURRENCY,
+    max_wait_seconds: float = MAX_WAIT_SECONDS,
+    reserved_slots: int = RESERVED_SLOTS,
+  ):
+    """limits maps a path to an EndpointLimit, paths not in it are never limited"""
+    logging.basicConfig()
+    self.logger = logging.getLogger(__name__)
+    self.logger.setLevel(logging.INFO)
+    self.limits = limits
+    self.max_concurrency = max_concurrency
+    # low priority always gets at least one slot
+    self.reserved_slots = max(0, min(reserved_slots, max_concurrency - 1))
+    self.max_wait_seconds = max_wait_seconds
+    self.active = 0
+    self.stats = {path: EndpointStats() for path in limits}
+    # heap of (priority, arrival, path, future), cancelled futures are skipped when popped
+    self._waiting = []
+    self._arrivals = itertools.count()
+
+
+  def limit_for(self, path: str):
+    return self.limits.get(path)
+
+
+  def _slots_for(self, priority):
+    """worker wide slots requests of this priority may fill"""
+    return self.max_concurrency - self.reserved_slots if priority >= Priority.LOW else self.max_concurrency
+
+
+  def _can_start(self, path, priority):
+    return self.active < self._slots_for(priority) and self.stats[path].active < self.limits[path].max_concurrency
+
+
+  def _start(self, path):
+    self.active += 1
+    self.stats[path].active += 1
+    self.stats[path].admitted += 1
+
+
+  def _dispatch(self):
+    """hand free slots to the best waiters whose endpoint has room"""
+    blocked = []
+    while self._waiting and self.active < self.max_concurrency:
+      entry = heapq.heappop(self._waiting)
+      priority, _, path, future = entry
+      if future.done():
+        continue
+      if not self._can_start(path, priority):
+        blocked.append(entry)
+        continue
+      self._start(path)
+      self.stats[path].queued -= 1
+      future.set_result(None)
+    for entry in blocked:
+      heapq.heappush(self._waiting, entry)
+
+
+  def retry_after(self, path):
+    """rough seconds until a new request for path would get through the queue"""
+    stats = self.stats[path]
+    limit = self.limits[path]
+    estimate = stats.service_seconds * (stats.queued + 1) / max(1, limit.max_concurrency)
+    return max(1, math.ceil(estimate))
+
+
+  async def acquire(self, path: str, priority: Priority = None, deadline: float = None):
+    limit = self.limits[path]
+    stats = self.stats[path]
+    priority = limit.priority if priority is None else priority
+    if self._can_start(path, priority):
+      # every waiter left after a dispatch is blocked, so starting now doesn't jump anyone
+      self._start(path)
+      return 0.0
+
+    if stats.queued >= limit.max_queue:
+      stats.shed += 1
+      raise AdmissionRejected(429, f"{path} queue is full", retry_after=self.retry_after(path))
+
+    timeout = self.max_wait_seconds
+    if deadline is not None:
+      timeout = min(timeout, deadline - time.time())
+    if timeout <= 0:
+      stats.expired += 1
+      raise AdmissionRejected(504, "request deadline passed before it could start")
+
+    future = asyncio.get_event_loop().create_future()
+    heapq.heappush(self._waiting, (priority, next(self._arrivals), path, future))
+    stats.queued += 1
+    wait_start = time.perf_counter()
+    try:
+      await asyncio.wait_for(asyncio.shield(future), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+      if future.done() and not future.cancelled():
+        # admitted just as we gave up, hand the slot to the next waiter
+        self.release(path)
+      else:
+        future.cancel()
+        stats.queued -= 1
+      if isinstance(e, asyncio.CancelledError):
+        raise
+      stats.expired += 1
+      if deadline is not None and time.time() >= deadline:
+        raise AdmissionRejected(504, "request deadline passed while queued")
+      raise AdmissionRejected(503, f"timed out waiting for {path}", retry_after=self.retry_after(path))
+    waited = time.perf_counter() - wait_start
+    stats.observe("wait_seconds", waited)
+    return waited
+
+
+  def release(self, path: str, service_seconds: float = None):
+    stats = self.stats[path]
+    self.active -= 1
+    stats.active -= 1
+    if service_seconds is not None:
+      stats.completed += 1
+      stats.observe("service_seconds", service_seconds)
+    self._dispatch()
+
+
+  @asynccontextmanager
+  async def admit(self, path: str, priority: Priority = None, deadline: float = None):
+    """hold a slot for path while the block runs, raises AdmissionRejected if none is given"""
+    await self.acquire(path, priority, deadline)
+    start_time = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.release(path, time.perf_counter() - start_time)
+
+
+  def metrics(self):
+    return {
+      "active": self.active,
+      "max_concurrency": self.max_concurrency,
+      "reserved_slots": self.reserved_slots,
+      "queued": sum(stats.queued for stats in self.stats.values()),
+      "endpoints": {
+        path: {
+          "priority": self.limits[path].priority.name.lower(),
+          "max_concurrency": self.limits[path].max_concurrency,
+          "max_queue": self.limits[path].max_queue,
+          "active": stats.active,
+          "queued": stats.queued,
+          "admitted": stats.admitted,
+          "completed": stats.completed,
+          "shed": stats.shed,
+          "expired": stats.expired,
+          "avg_wait_seconds": round(stats.wait_seconds, 4),
+          "avg_service_seconds": round(stats.service_seconds, 4),
+        }
+        for path, stats in self.stats.items()
+      },
+    }
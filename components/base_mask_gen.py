@@ -1,10 +1,26 @@
-import os
+from PIL import Image
+
+from components.dedup import group_filenames
+from components.lazy_import import lazy_module
+from components.mask_postprocess import MaskPostProcessor
+from components.storage import get_storage
+
+np = lazy_module("numpy")
 
 class BaseMaskGen:
   def __init__(self):
     self.BATCH = None
     self.MASK_PATH = None
     self.INPUT_PATH = None
+    # images are read and written through storage, local files relative to the cwd by default
+    self.storage = get_storage()
+    # shared clean up applied to every segmentation before it becomes a mask
+    self.mask_postprocessor = MaskPostProcessor()
+    # near duplicate grouping is off unless set_dedup is called
+    self.dedup_distance = None
+    self.dedup_report = None
+    # per file cpu and allocation profiles are off unless set_profiler is called
+    self.profiler = None
 
 
   def set_constants(self, batch: bool, input_path: str, no_bg_path: str, mask_path: str):
@@ -15,12 +31,74 @@ class BaseMaskGen:
     self.MASK_PATH = mask_path
 
 
+  def set_storage(self, storage):
+    """set the storage backend images are read from and written to"""
+    self.storage = storage
+
+
+  def set_mask_postprocessor(self, mask_postprocessor: MaskPostProcessor):
+    """set the post processing applied to segmentations"""
+    self.mask_postprocessor = mask_postprocessor
+
+
+  def set_dedup(self, max_distance: int = None, report=None):
+    """
+    run inference once per group of near duplicate inputs (perceptual hashes at most
+    max_distance bits apart), None disables grouping. avoided calls go to report
+    """
+    self.dedup_distance = max_distance
+    self.dedup_report = report
+
+
+  def set_profiler(self, profiler=None):
+    """profile each file (or batch) with profiler, None disables profiling"""
+    self.profiler = profiler
+
+
+  def group_filenames(self, filename_list):
+    """representative filename -> near duplicate filenames that reuse its segmentation"""
+    return group_filenames(
+      self.storage, self.INPUT_PATH, filename_list,
+      max_distance=self.dedup_distance, report=self.dedup_report, stage=self.dedup_stage()
+    )
+
+
+  def dedup_stage(self):
+    return f"{type(self).__name__} masks"
+
+
+  def reject_duplicate(self, member, representative):
+    """
+    member's mask couldn't be adapted from representative's, it is left without one
+    so the next pass over the files needing masks segments it on its own
+    """
+    self.logger.info(f"{member} doesn't line up with {representative}, segmenting it on its own")
+    if self.dedup_report is not None:
+      self.dedup_report.record_rejected(self.dedup_stage(), member)
+
+
+  def postprocess_mask(self, image, foreground):
+    """
+    turn a segmentation of image (subject white) into the inpainting mask
+    (background white) and the no background image
+    """
+    rgba = image.convert("RGBA")
+    mask, alpha = self.mask_postprocessor.process(
+      np.array(foreground.convert("L")),
+      guide=np.array(rgba.convert("RGB"))
+    )
+    # composite with an empty image so the background is black as well as transparent
+    no_bg_image = Image.composite(rgba, Image.new("RGBA", rgba.size, 0), Image.fromarray(alpha))
+    return Image.fromarray(mask), no_bg_image
+
+
   def run(self):
-    mask_images = [filename for filename in os.listdir(self.MASK_PATH) if filename.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    mask_images = self.storage.list_images(self.MASK_PATH)
+    target_images = []
     if self.BATCH:
-      target_images = [filename for filename in os.listdir(self.INPUT_PATH) if filename.lower().endswith(('.png', '.jpg', '.jpeg'))]
+      target_images = self.storage.list_images(self.INPUT_PATH)
       self.run_batch(mask_images=mask_images, target_images=target_images)
     else:
       self.run_single(mask_images)
     
-    self.logger.info(f"{len(mask_images)} masks found for {len(target_images)}")
\ No newline at end of file
+    self.logger.info(f"{len(mask_images)} masks found for {len(target_images)}")
@@ -0,0 +1,59 @@
+import asyncio
+from contextvars import ContextVar, copy_context
+from functools import partial
+import time
+
+from components.profiling import profile_thread
+
+"""
+Per request deadlines. The api sets the deadline of the request being handled
+in a context variable, expensive steps call check_deadline first so a request
+the client has already given up on doesn't start a replicate prediction
+"""
+
+# unix time after which the current request's result is no longer wanted, None for no deadline
+request_deadline = ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+  pass
+
+
+def parse_deadline(headers, default_timeout: float = None, now: float = None):
+  """
+  deadline from `X-Request-Deadline` (unix seconds) or `X-Request-Timeout`
+  (seconds from now), the earlier one wins. None if neither is set
+  """
+  now = time.time() if now is None else now
+  deadlines = []
+  try:
+    if headers.get("x-request-deadline"):
+      deadlines.append(float(headers["x-request-deadline"]))
+    if headers.get("x-request-timeout"):
+      deadlines.append(now + float(headers["x-request-timeout"]))
+  except ValueError:
+    pass
+  if not deadlines and default_timeout:
+    deadlines.append(now + default_timeout)
+  return min(deadlines) if deadlines else None
+
+
+def remaining_seconds():
+  deadline = request_deadline.get()
+  return None if deadline is None else deadline - time.time()
+
+
+def check_deadline(stage: str = ""):
+  """raise DeadlineExceeded if the current request's deadline has passed"""
+  remaining = remaining_seconds()
+  if remaining is not None and remaining <= 0:
+    raise DeadlineExceeded(f"deadline passed {-remaining:.1f} seconds before {stage or 'starting work'}")
+
+
+async def run_blocking(func, *args, **kwargs):
+  """
+  run a blocking call in the default executor with the caller's context, so it
+  sees the request deadline and is profiled with the request
+  """
+  context = copy_context()
+  return await asyncio.get_event_loop().run_in_executor(None, partial(context.run, profile_thread, func, *args, **kwargs))
@@ -0,0 +1,182 @@
+import logging
+
+from PIL import Image
+
+from components.lazy_import import lazy_module
+from components.upload_prep import open_image
+
+cv2 = lazy_module("cv2")
+np = lazy_module("numpy")
+
+"""
+Find near duplicate images (same product shot with a different crop or
+compression) with a perceptual hash so inference runs once per group, and
+adapt the representative's output to the other members of the group. an output
+is only reused when the two images line up around the subject once aligned,
+otherwise the member needs its own inference
+"""
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+HASH_SIZE = 8
+# the hash is taken from the low frequencies of a DCT of this size
+DCT_SIZE = 32
+# hashes this many bits apart or closer are considered the same image
+DEFAULT_MAX_DISTANCE = 6
+# below this phase correlation response the shift estimate is noise
+MIN_ALIGNMENT_RESPONSE = 0.1
+# largest mean gray level difference (0-1) of the aligned images along the
+# subject's outline, above it the reused mask wouldn't follow the member's subject
+MAX_ALIGNMENT_ERROR = 0.04
+# width in pixels of the band around the outline the error is measured on
+OUTLINE_WIDTH = 5
+
+_dct_matrix = None
+
+
+def _dct():
+  global _dct_matrix
+  if _dct_matrix is None:
+    n = np.arange(DCT_SIZE)
+    _dct_matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * DCT_SIZE))
+  return _dct_matrix
+
+
+def phash(image):
+  """64 bit perceptual hash of an image"""
+  pixels = np.asarray(image.convert("L").resize((DCT_SIZE, DCT_SIZE), Image.LANCZOS), dtype=np.float64)
+  dct = _dct()
+  low_frequencies = (dct @ pixels @ dct.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+  # compare against the median without the dc term, which only carries brightness
+  bits = low_frequencies > np.median(low_frequencies[1:])
+  return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def hamming_distance(a: int, b: int):
+  return bin(a ^ b).count("1")
+
+
+def hash_key(storage, key):
+  # only a tiny version of the image is needed, let the decoder skip the rest
+  return phash(open_image(storage.read(key), target_size=(DCT_SIZE, DCT_SIZE)))
+
+
+def group_near_duplicates(storage, keys, max_distance: int = DEFAULT_MAX_DISTANCE):
+  """
+  group storage keys of near identical images, returns a dict of
+  representative key -> list of member keys (in the order they were given)
+  """
+  groups = {}
+  representative_hashes = []
+  for key in keys:
+    try:
+      image_hash = hash_key(storage, key)
+    except Exception as e:
+      # unreadable images get their own group, inference will report the error
+      logger.info(f"could not hash {key}: {e}")
+      groups[key] = []
+      continue
+    for representative, representative_hash in representative_hashes:
+      if hamming_distance(image_hash, representative_hash) <= max_distance:
+        groups[representative].append(key)
+        break
+    else:
+      representative_hashes.append((key, image_hash))
+      groups[key] = []
+  return groups
+
+
+def group_filenames(storage, directory, filename_list, max_distance=None, report=None, stage=""):
+  """
+  group filenames in a directory by near duplicate images, every file is its own
+  group when max_distance is None. returns representative -> list of members
+  """
+  if max_distance is None:
+    return {filename: [] for filename in filename_list}
+  keys = {f"{directory}/{filename}": filename for filename in filename_list}
+  groups = group_near_duplicates(storage, keys, max_distance)
+  groups = {keys[representative]: [keys[member] for member in members] for representative, members in groups.items()}
+  if report is not None:
+    report.record(stage, groups)
+  return groups
+
+
+def alignment_error(aligned_representative, member_gray, mask):
+  """
+  mean gray level difference (0-1) of two aligned grayscale images in a band
+  around the outline of mask, the whole image when the mask has no outline
+  """
+  kernel = np.ones((OUTLINE_WIDTH, OUTLINE_WIDTH), np.uint8)
+  outline = cv2.morphologyEx((mask > 127).astype(np.uint8), cv2.MORPH_GRADIENT, kernel) > 0
+  difference = np.abs(aligned_representative - member_gray)
+  if outline.any():
+    difference = difference[outline]
+  return float(difference.mean()) / 255
+
+
+def adapt_output(output, representative, member, nearest: bool = False):
+  """
+  map an output computed for `representative` onto near duplicate `member`:
+  scale it to the member's size and shift it by the offset between the two images.
+  None when the images can't be aligned closely enough to reuse the output
+  """
+  size = member.size
+  resample = Image.NEAREST if nearest else Image.LANCZOS
+  adapted = np.asarray(output.resize(size, resample))
+
+  representative_gray = np.asarray(representative.convert("L").resize(size, Image.BILINEAR), dtype=np.float32)
+  member_gray = np.asarray(member.convert("L"), dtype=np.float32)
+  (shift_x, shift_y), response = cv2.phaseCorrelate(representative_gray, member_gray)
+  if response < MIN_ALIGNMENT_RESPONSE:
+    logger.info(f"alignment response {response:.3f} is too weak to reuse the output")
+    return None
+
+  translation = np.float32([[1, 0, shift_x], [0, 1, shift_y]])
+  interpolation = cv2.INTER_NEAREST if nearest else cv2.INTER_LINEAR
+  shifted = cv2.warpAffine(adapted, translation, size, flags=interpolation, borderMode=cv2.BORDER_REPLICATE)
+  shifted = Image.fromarray(shifted)
+
+  # a crop or scale change a translation can't undo shows up along the subject's outline
+  aligned_representative = cv2.warpAffine(representative_gray, translation, size, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+  error = alignment_error(aligned_representative, member_gray, np.asarray(shifted.convert("L")))
+  if error > MAX_ALIGNMENT_ERROR:
+    logger.info(f"alignment error {error:.3f} is too high to reuse the output")
+    return None
+  return shifted
+
+
+class DedupReport:
+  """counts the inference calls avoided by grouping, per pipeline stage"""
+
+  def __init__(self):
+    self.stages = {}
+
+
+  def record(self, stage: str, groups):
+    stage_report = self.stages.setdefault(stage, {"items": 0, "inference_calls": 0, "groups": {}})
+    stage_report["items"] += sum(1 + len(members) for members in groups.values())
+    stage_report["inference_calls"] += len(groups)
+    for representative, members in groups.items():
+      if members:
+        stage_report["groups"][representative] = list(members)
+    logger.info(f"{stage}: {stage_report['items'] - stage_report['inference_calls']} inference call(s) avoided so far")
+
+
+  def record_rejected(self, stage: str, member: str):
+    """a grouped member whose output couldn't be reused, it is counted again when it runs on its own"""
+    stage_report = self.stages[stage]
+    stage_report["items"] -= 1
+    stage_report.setdefault("rejected", []).append(member)
+
+
+  def to_dict(self):
+    stages = {
+      stage: {**report, "calls_avoided": report["items"] - report["inference_calls"]}
+      for stage, report in self.stages.items()
+    }
+    return {
+      "calls_avoided": sum(report["calls_avoided"] for report in stages.values()),
+      "stages": stages,
+    }
@@ -0,0 +1,227 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+from threading import Lock
+from time import perf_counter, sleep
+from urllib.parse import urlparse
+
+from components.deadline import remaining_seconds
+from components.lazy_import import lazy_module
+from components.profiling import propagate_context
+
+requests = lazy_module("requests")
+requests_adapters = lazy_module("requests.adapters")
+
+"""
+One pooled http client for downloading model outputs. A single session keeps
+connections to the replicate delivery hosts alive between downloads, every
+request has a connect and read timeout (cut short by the request deadline),
+transient failures are retried with exponential backoff while the deadline
+leaves time for another attempt, and the outputs of a multi output prediction
+are fetched in parallel
+"""
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# connections kept alive per host
+POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 16))
+CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+# longest gap between bytes of a response, not the whole download
+READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 60))
+RETRIES = int(os.environ.get("HTTP_RETRIES", 3))
+# retries sleep backoff * 2 ** (retry - 1) seconds
+BACKOFF = float(os.environ.get("HTTP_BACKOFF", 0.5))
+# longest `Retry-After` of a 429/503 waited for before retrying
+MAX_RETRY_AFTER = float(os.environ.get("HTTP_MAX_RETRY_AFTER", 10))
+# downloads run at once by fetch_many
+MAX_PARALLEL_DOWNLOADS = int(os.environ.get("HTTP_MAX_PARALLEL_DOWNLOADS", 8))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def _empty_totals():
+  return {"downloads": 0, "failed": 0, "retries": 0, "bytes": 0, "seconds": 0.0, "max_seconds": 0.0}
+
+
+class HttpClient:
+  def __init__(
+    self,
+    pool_size: int = POOL_SIZE,
+    connect_timeout: float = CONNECT_TIMEOUT,
+    read_timeout: float = READ_TIMEOUT,
+    retries: int = RETRIES,
+    backoff: float = BACKOFF,
+    max_retry_after: float = MAX_RETRY_AFTER,
+    max_parallel: int = MAX_PARALLEL_DOWNLOADS,
+  ):
+    self.pool_size = pool_size
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.max_retry_after = max_retry_after
+    self.max_parallel = max_parallel
+    # created on first use so importing this module doesn't import requests
+    self._session = None
+    self.totals = _empty_totals()
+    # host -> totals
+    self.hosts = {}
+    self._lock = Lock()
+
+
+  @property
+  def session(self):
+    with self._lock:
+      if self._session is None:
+        # retries are done by fetch, which can see the request deadline
+        adapter = requests_adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        self._session = session
+      return self._session
+
+
+  def timeout(self):
+    """(connect, read) timeouts, no longer than what is left of the request deadline"""
+    remaining = remaining_seconds()
+    if remaining is None:
+      return (self.connect_timeout, self.read_timeout)
+    remaining = max(remaining, 0.1)
+    return (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+
+
+  def _record(self, url, seconds, size=0, retries=0, failed=False):
+    host = urlparse(url).netloc
+    with self._lock:
+      for bucket in (self.totals, self.hosts.setdefault(host, _empty_totals())):
+        bucket["downloads"] += 1
+        bucket["failed"] += int(failed)
+        bucket["retries"] += retries
+        bucket["bytes"] += size
+        bucket["seconds"] += seconds
+        bucket["max_seconds"] = max(bucket["max_seconds"], seconds)
+
+
+  def retry_delay(self, retry: int, response=None):
+    """seconds to sleep before retry number `retry`, a capped `Retry-After` when the response sent one"""
+    delay = self.backoff * 2 ** (retry - 1)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+      delay = max(delay, min(float(retry_after), self.max_retry_after))
+    except (TypeError, ValueError):
+      # missing, or an http date, which the backoff stands in for
+      pass
+    return delay
+
+
+  def _can_retry(self, retries: int, delay: float):
+    """whether another attempt is allowed and would start before the request deadline"""
+    if retries >= self.retries:
+      return False
+    remaining = remaining_seconds()
+    return remaining is None or remaining > delay
+
+
+  def fetch(self, url: str, timeout=None, headers=None) -> bytes:
+    """
+    download url, raises for connection errors and error statuses left after
+    retrying. every attempt gets what is left of the request deadline, and no
+    retry starts once it would begin after the deadline
+    """
+    start_time = perf_counter()
+    retries = 0
+    while True:
+      try:
+        response = self.session.get(url, timeout=timeout or self.timeout(), headers=headers)
+      except (requests.ConnectionError, requests.Timeout):
+        delay = self.retry_delay(retries + 1)
+        if not self._can_retry(retries, delay):
+          self._record(url, perf_counter() - start_time, retries=retries, failed=True)
+          raise
+      except Exception:
+        self._record(url, perf_counter() - start_time, retries=retries, failed=True)
+        raise
+      else:
+        delay = self.retry_delay(retries + 1, response)
+        if response.status_code not in RETRY_STATUSES or not self._can_retry(retries, delay):
+          break
+        response.close()
+      retries += 1
+      logger.info(f"retrying {url} in {delay:.2f} seconds ({retries}/{self.retries})")
+      sleep(delay)
+    try:
+      response.raise_for_status()
+      content = response.content
+    except Exception:
+      self._record(url, perf_counter() - start_time, retries=retries, failed=True)
+      raise
+    self._record(url, perf_counter() - start_time, size=len(content), retries=retries)
+    return content
+
+
+  def fetch_json(self, url: str, headers=None):
+    return json.loads(self.fetch(url, headers=headers))
+
+
+  def fetch_many(self, urls, return_exceptions: bool = False):
+    """
+    download urls in parallel, returns the contents in the same order. with
+    return_exceptions a failed download gives its exception instead of raising
+    """
+    urls = list(urls)
+    if not urls:
+      return []
+    def fetch_url(url):
+      try:
+        return self.fetch(url)
+      except Exception as e:
+        if not return_exceptions:
+          raise
+        logger.info(f"exception downloading {url}: {e}")
+        return e
+
+    if len(urls) == 1:
+      return [fetch_url(urls[0])]
+    with ThreadPoolExecutor(max_workers=min(self.max_parallel, len(urls))) as executor:
+      return list(executor.map(propagate_context(fetch_url), urls))
+
+
+  def metrics(self):
+    def summary(totals):
+      return {
+        **totals,
+        "seconds": round(totals["seconds"], 4),
+        "max_seconds": round(totals["max_seconds"], 4),
+        "avg_seconds": round(totals["seconds"] / totals["downloads"], 4) if totals["downloads"] else 0.0,
+      }
+
+    with self._lock:
+      return {
+        "totals": summary(self.totals),
+        "hosts": {host: summary(totals) for host, totals in self.hosts.items()},
+        "config": {
+          "pool_size": self.pool_size,
+          "connect_timeout": self.connect_timeout,
+          "read_timeout": self.read_timeout,
+          "retries": self.retries,
+          "backoff": self.backoff,
+          "max_retry_after": self.max_retry_after,
+          "max_parallel": self.max_parallel,
+        },
+      }
+
+
+_client = None
+_client_lock = Lock()
+
+
+def get_http_client():
+  """the client shared by every component in the process, configured from the environment"""
+  global _client
+  with _client_lock:
+    if _client is None:
+      _client = HttpClient()
+    return _client
@@ -0,0 +1,61 @@
+import importlib
+import logging
+from threading import RLock
+from time import perf_counter
+
+"""
+Defer heavy imports (rembg, opencv, replicate, gcs) until they are first used
+and record how long each one took, so startup only pays for the stages in use
+"""
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# module name -> seconds spent importing it
+IMPORT_TIMINGS = {}
+_import_lock = RLock()
+
+
+def timed_import(name: str):
+  """import a module and record the time it took if it was not already loaded"""
+  with _import_lock:
+    if name in IMPORT_TIMINGS:
+      return importlib.import_module(name)
+    start_time = perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_TIMINGS[name] = perf_counter() - start_time
+  logger.info(f"imported {name} in {IMPORT_TIMINGS[name]:.3f} seconds")
+  return module
+
+
+def import_timings():
+  """import cost per module, most expensive first"""
+  return dict(sorted(IMPORT_TIMINGS.items(), key=lambda item: item[1], reverse=True))
+
+
+class LazyModule:
+  """stands in for a module and imports it on first attribute access"""
+
+  def __init__(self, name: str):
+    self._name = name
+    self._module = None
+
+
+  def _load(self):
+    if self._module is None:
+      self._module = timed_import(self._name)
+    return self._module
+
+
+  def __getattr__(self, attribute):
+    return getattr(self._load(), attribute)
+
+
+  def __repr__(self):
+    state = "loaded" if self._module is not None else "not loaded"
+    return f"<lazy module {self._name} ({state})>"
+
+
+def lazy_module(name: str):
+  return LazyModule(name)
@@ -1,12 +1,11 @@
 import logging
-import numpy as np
-import os
 
-import cv2
-from rembg import remove
 from PIL import Image
 
 from components.base_mask_gen import BaseMaskGen
+from components.dedup import adapt_output
+from components.profiling import maybe_profile
+from components.segmentation_engine import SegmentationEngine
 
 """
 Using OpenCV, rembg, and PIL find and remove the background from a source directory, then make a binary mask of the subject
@@ -14,78 +13,56 @@ Using OpenCV, rembg, and PIL find and remove the background from a source direct
 
 class LocalMaskGen(BaseMaskGen):
   def __init__(self):
+    super().__init__()
     # set up logger
     logging.basicConfig()
     self.logger = logging.getLogger(__name__)
     self.logger.setLevel(logging.INFO)
+    # built on first use, loading it loads the onnx model
+    self._engine = None
+
+
+  @property
+  def engine(self):
+    if self._engine is None:
+      self._engine = SegmentationEngine()
+    return self._engine
 
 
   # generate a list of filenames to create masks for
   def get_filenames(self):
     filename_list = []
-    for filename in os.listdir(self.INPUT_PATH):
-      image = os.path.join(self.INPUT_PATH, filename)
-      mask = os.path.join(self.MASK_PATH, filename)
-      # check if image file exists, is an image type, and no mask already exists
-      if os.path.isfile(image) and not os.path.isfile(mask) and filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+    for filename in self.storage.list_images(self.INPUT_PATH):
+      mask = f"{self.MASK_PATH}/{filename}"
+      # check no mask already exists
+      if not self.storage.exists(mask):
         self.logger.info(f"no mask found for: {filename}, adding to list")
         filename_list.append(filename)
     
     return filename_list
 
 
-  # remove the background of an image using rembg
-  def remove_background(self, file_path):
-    self.logger.info(f"reading in image: {file_path}")
-    # read in image
-    input = Image.open(file_path)
-    
-    # remove background
-    self.logger.info(f"removing background from image: {file_path}")
-    return remove(input)
+  def segment_images(self, images):
+    """
+    run segmentation on a list of images in one batch, returns a
+    (mask image, no background image) pair for each
+    """
+    soft_masks = self.engine.predict_masks(images)
+    return [self.postprocess_mask(image, soft_mask) for image, soft_mask in zip(images, soft_masks)]
 
 
-  # write file out
+  # write file out, storage converts the image if the format can't hold it
   def save_no_bg_image(self, filename, image, path):
-    try:
-      self.logger.info(f"writing no background image: {filename} to path: {path}")
-      image.save(path)
-    except Exception as e:
-      # depending on filetype this might break, convert and write
-      self.logger.info(f"exception writing no background image: {filename}. exception: {e}")
-      self.logger.info(f"converting image and trying write again...")
-      image = image.convert("RGB")
-      image.save(path)
-      self.logger.info(f"{path} written")
-
-
-  def create_binary_mask(self, filename, input_path, output_path):
-    # convert to mask
-    self.logger.info(f"reading in no bg photo to opencv: {input_path}")
-    cv2_image = cv2.imread(input_path)
-
-    self.logger.info(f"converting {filename} to binary mask")
-    img_gray = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2GRAY)
-    ret, im = cv2.threshold(img_gray, 5, 255, cv2.THRESH_BINARY_INV)
-
-    self.logger.info(f"writing mask {filename} to file")
-    cv2.imwrite(output_path, im)
-
-    self.logger.info(f"write successful: {output_path}")
-  
+    self.logger.info(f"writing no background image: {filename} to path: {path}")
+    self.storage.write_image(path, image)
+    self.logger.info(f"{path} written")
+
 
   def create_binary_mask_endpoint(self, input_image):
     input = Image.open(input_image)
-    no_bg_image = remove(input)
-
-    self.logger.info(f"reading in no bg photo to opencv: {no_bg_image}")
-    cv2_image = cv2.cvtColor(np.array(no_bg_image), cv2.COLOR_RGB2BGR)
-
     self.logger.info(f"converting to binary mask")
-    img_gray = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2GRAY)
-    _, im = cv2.threshold(img_gray, 5, 255, cv2.THRESH_BINARY_INV)
-
-    return Image.fromarray(im)
+    mask_image, _ = self.segment_images([input])[0]
+    return mask_image
 
 
   def run_batch(self, mask_images, target_images):
@@ -95,35 +72,56 @@ class LocalMaskGen(BaseMaskGen):
 
       self.logger.info(f"found {len(filename_list)} valid image names needing masks...")
 
-      for filename in filename_list:
-        input_path = f"{self.INPUT_PATH}/{filename}"
-        no_bg_path = f"{self.NO_BG_PATH}/{filename}"
-        mask_path = f"{self.MASK_PATH}/{filename}"
-        
-        output = self.remove_background(file_path=input_path)
-
-        self.save_no_bg_image(filename, output, no_bg_path)
-
-        self.create_binary_mask(filename, no_bg_path, mask_path)
+      # near duplicates reuse the segmentation of their group's representative
+      groups = self.group_filenames(filename_list)
+      representatives = list(groups)
+
+      # run the model on a batch of images per call
+      batch_size = self.engine.max_batch_size
+      for start in range(0, len(representatives), batch_size):
+        with maybe_profile(self.profiler, f"local mask batch {start // batch_size}"):
+          batch_filenames = representatives[start:start + batch_size]
+          images = [self.storage.read_image(f"{self.INPUT_PATH}/{filename}") for filename in batch_filenames]
+          self.logger.info(f"removing background from {len(images)} image(s)")
+          soft_masks = self.engine.predict_masks(images)
+
+          writes = []
+          for filename, image, soft_mask in zip(batch_filenames, images, soft_masks):
+            targets = [(filename, image, soft_mask)]
+            for member in groups[filename]:
+              member_image = self.storage.read_image(f"{self.INPUT_PATH}/{member}")
+              member_soft_mask = adapt_output(soft_mask, image, member_image)
+              if member_soft_mask is None:
+                self.reject_duplicate(member, filename)
+                continue
+              targets.append((member, member_image, member_soft_mask))
+            for target, target_image, target_soft_mask in targets:
+              mask_image, no_bg_image = self.postprocess_mask(target_image, target_soft_mask)
+              writes.append((f"{self.NO_BG_PATH}/{target}", no_bg_image))
+              writes.append((f"{self.MASK_PATH}/{target}", mask_image))
+          self.storage.write_images(writes)
+          self.logger.info(f"wrote masks for: {batch_filenames}")
       
       # get all mask images now for comparison
-      mask_images = [filename for filename in os.listdir(self.MASK_PATH) if filename.lower().endswith(('.png', '.jpg', '.jpeg'))]
+      mask_images = self.storage.list_images(self.MASK_PATH)
 
   
   def run_single(self, mask_images):
     # just looking for one image in the mask directory
     filename = self.INPUT_PATH.split("/")[-1]
     while filename not in mask_images:
-      output = self.remove_background(file_path=self.INPUT_PATH)
+      self.logger.info(f"removing background from image: {self.INPUT_PATH}")
+      mask_image, no_bg_image = self.segment_images([self.storage.read_image(self.INPUT_PATH)])[0]
 
       no_bg_path = f"{self.NO_BG_PATH}/{filename}"
-      no_bg_path = f"{self.MASK_PATH}/{filename}"
+      mask_path = f"{self.MASK_PATH}/{filename}"
 
-      self.save_no_bg_image(self.INPUT_PATH, output, no_bg_path)
+      self.save_no_bg_image(self.INPUT_PATH, no_bg_image, no_bg_path)
 
-      self.create_binary_mask(filename, no_bg_path, no_bg_path)
+      self.logger.info(f"writing mask {filename} to file")
+      self.storage.write_image(mask_path, mask_image)
 
-      mask_images = [filename for filename in os.listdir(self.MASK_PATH) if filename.lower().endswith(('.png', '.jpg', '.jpeg'))]
+      mask_images = self.storage.list_images(self.MASK_PATH)
 
 
 if __name__ == '__main__':
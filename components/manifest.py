@@ -0,0 +1,179 @@
+import csv
+import json
+import logging
+import os
+
+from components.compositing import Placement
+
+"""
+Read per file parameters from a manifest instead of hard coded prompts. A
+manifest is a csv file with a header row or a jsonl file with one object per
+line, with the columns
+
+  filename, prompt, num_outputs, num_inference_steps, x, y, scale, anchor
+
+only filename is required, empty or missing values fall back to the defaults of
+the stage using them. Rows are read lazily and handed out in chunks, so a
+manifest of millions of rows never has to be held in memory
+"""
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+FORMATS = ("csv", "jsonl")
+# rows submitted together, every prediction of a chunk is waited for before the next one starts
+CHUNK_SIZE = 100
+
+
+class ManifestItem:
+  def __init__(
+    self,
+    filename: str,
+    prompt: str = None,
+    num_outputs: int = None,
+    num_inference_steps: int = None,
+    x: int = None,
+    y: int = None,
+    scale: float = None,
+    anchor: str = None,
+  ):
+    self.filename = filename
+    self.prompt = prompt
+    self.num_outputs = num_outputs
+    self.num_inference_steps = num_inference_steps
+    self.x = x
+    self.y = y
+    self.scale = scale
+    self.anchor = anchor
+
+
+  def options(self):
+    """the inpainting settings this row overrides, as keyword arguments"""
+    options = {"num_outputs": self.num_outputs, "num_inference_steps": self.num_inference_steps}
+    return {name: value for name, value in options.items() if value is not None}
+
+
+  def placement(self, scene: int = 0, default: Placement = None):
+    """where this row puts the foreground on scene number `scene`, unset fields come from default"""
+    default = default or Placement()
+    return Placement(
+      scene=scene,
+      x=default.x if self.x is None else self.x,
+      y=default.y if self.y is None else self.y,
+      scale=default.scale if self.scale is None else self.scale,
+      anchor=default.anchor if self.anchor is None else self.anchor,
+    )
+
+
+def _value(row, name, convert):
+  value = row.get(name)
+  if isinstance(value, str):
+    value = value.strip()
+  if value is None or value == "":
+    return None
+  return convert(value)
+
+
+def _positive_int(value):
+  value = int(value)
+  if value < 1:
+    raise ValueError(f"expected a positive integer, got {value}")
+  return value
+
+
+def parse_row(row):
+  """ManifestItem from a dict of column -> value, raises ValueError for a bad row"""
+  filename = _value(row, "filename", str)
+  if not filename:
+    raise ValueError("row has no filename")
+  item = ManifestItem(
+    filename=filename,
+    prompt=_value(row, "prompt", str),
+    num_outputs=_value(row, "num_outputs", _positive_int),
+    num_inference_steps=_value(row, "num_inference_steps", _positive_int),
+    x=_value(row, "x", int),
+    y=_value(row, "y", int),
+    scale=_value(row, "scale", float),
+    anchor=_value(row, "anchor", str),
+  )
+  # surfaces a bad scale or anchor while the row number is still known
+  item.placement()
+  return item
+
+
+def detect_format(path: str, manifest_format: str = None):
+  if manifest_format:
+    if manifest_format not in FORMATS:
+      raise ValueError(f"unknown manifest format {manifest_format}, choose from {', '.join(FORMATS)}")
+    return manifest_format
+  extension = os.path.splitext(path)[1].lower()
+  if extension == ".csv":
+    return "csv"
+  if extension in (".jsonl", ".ndjson"):
+    return "jsonl"
+  raise ValueError(f"can't tell the format of manifest {path}, pass csv or jsonl")
+
+
+def _rows(f, manifest_format):
+  """(line number, row dict) for every row of an open manifest"""
+  if manifest_format == "csv":
+    reader = csv.DictReader(f)
+    for row in reader:
+      yield reader.line_num, row
+    return
+  for line_number, line in enumerate(f, start=1):
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      row = json.loads(line)
+    except json.JSONDecodeError as e:
+      yield line_number, e
+      continue
+    yield line_number, row if isinstance(row, dict) else ValueError("row is not a json object")
+
+
+def read_manifest(path: str, manifest_format: str = None):
+  """
+  yield a ManifestItem per row of the manifest at path, reading it as it goes.
+  bad rows are logged and skipped so one typo doesn't stop a large batch
+  """
+  manifest_format = detect_format(path, manifest_format)
+  skipped = 0
+  with open(path, newline="") as f:
+    for line_number, row in _rows(f, manifest_format):
+      try:
+        if isinstance(row, Exception):
+          raise row
+        item = parse_row(row)
+      except (ValueError, TypeError) as e:
+        skipped += 1
+        logger.warning(f"skipping {path} line {line_number}: {e}")
+        continue
+      yield item
+  if skipped:
+    logger.warning(f"skipped {skipped} bad row(s) in {path}")
+
+
+def prompt_key(item):
+  return (item.prompt or "", item.num_outputs or 0, item.num_inference_steps or 0)
+
+
+def chunked(items, chunk_size: int = CHUNK_SIZE):
+  """
+  lists of up to chunk_size items, rows with the same prompt and settings next
+  to each other within a chunk. a chunk ends early when a filename repeats, so
+  every filename in a chunk is unique
+  """
+  chunk = []
+  filenames = set()
+  for item in items:
+    if len(chunk) >= chunk_size or item.filename in filenames:
+      yield sorted(chunk, key=prompt_key)
+      chunk = []
+      filenames = set()
+    chunk.append(item)
+    filenames.add(item.filename)
+  if chunk:
+    yield sorted(chunk, key=prompt_key)
@@ -0,0 +1,122 @@
+from components.lazy_import import lazy_module
+
+cv2 = lazy_module("cv2")
+np = lazy_module("numpy")
+
+"""
+Clean up segmentation output before it is used for inpainting. Works on whole
+arrays: guided filter refinement against the source image, threshold, hole
+fill, erode/dilate and feathering, shared by the local and replicate mask generators
+"""
+
+
+class MaskPostProcessor:
+  # alpha above this (0-255) counts as subject in the binary mask
+  THRESHOLD = 128
+  FILL_HOLES = True
+  # pixels to shrink / grow the subject by, shrinking hands the fringe to the inpainter
+  ERODE = 1
+  DILATE = 0
+  # gaussian sigma in pixels applied to the cutout alpha
+  FEATHER = 1.0
+  # guided filter settings, computed at 1/GUIDE_SCALE resolution (fast guided filter)
+  REFINE = True
+  GUIDE_RADIUS = 8
+  GUIDE_EPS = 1e-4
+  GUIDE_SCALE = 4
+
+  def __init__(
+    self,
+    threshold: int = THRESHOLD,
+    fill_holes: bool = FILL_HOLES,
+    erode: int = ERODE,
+    dilate: int = DILATE,
+    feather: float = FEATHER,
+    refine: bool = REFINE,
+    guide_radius: int = GUIDE_RADIUS,
+    guide_eps: float = GUIDE_EPS,
+    guide_scale: int = GUIDE_SCALE,
+  ):
+    self.threshold = threshold
+    self.fill_holes = fill_holes
+    self.erode = erode
+    self.dilate = dilate
+    self.feather = feather
+    self.refine = refine
+    self.guide_radius = guide_radius
+    self.guide_eps = guide_eps
+    self.guide_scale = max(1, guide_scale)
+
+
+  def guided_filter(self, guide, alpha):
+    """
+    edge aware smoothing of alpha (float32 0..1) using the grayscale guide (float32 0..1),
+    pulls mask edges onto the edges in the source image
+    """
+    height, width = alpha.shape
+    small_size = (max(1, width // self.guide_scale), max(1, height // self.guide_scale))
+    radius = max(1, self.guide_radius // self.guide_scale)
+    kernel = (2 * radius + 1, 2 * radius + 1)
+
+    guide_small = cv2.resize(guide, small_size, interpolation=cv2.INTER_AREA)
+    alpha_small = cv2.resize(alpha, small_size, interpolation=cv2.INTER_AREA)
+
+    mean_guide = cv2.boxFilter(guide_small, -1, kernel)
+    mean_alpha = cv2.boxFilter(alpha_small, -1, kernel)
+    corr_guide = cv2.boxFilter(guide_small * guide_small, -1, kernel)
+    corr_guide_alpha = cv2.boxFilter(guide_small * alpha_small, -1, kernel)
+
+    variance = corr_guide - mean_guide * mean_guide
+    covariance = corr_guide_alpha - mean_guide * mean_alpha
+    a = covariance / (variance + self.guide_eps)
+    b = mean_alpha - a * mean_guide
+
+    mean_a = cv2.resize(cv2.boxFilter(a, -1, kernel), (width, height), interpolation=cv2.INTER_LINEAR)
+    mean_b = cv2.resize(cv2.boxFilter(b, -1, kernel), (width, height), interpolation=cv2.INTER_LINEAR)
+    return np.clip(mean_a * guide + mean_b, 0, 1)
+
+
+  def _fill_holes(self, subject):
+    # flood the background from a padded border, anything it can't reach is a hole
+    padded = cv2.copyMakeBorder(subject, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+    flood_mask = np.zeros((padded.shape[0] + 2, padded.shape[1] + 2), dtype=np.uint8)
+    cv2.floodFill(padded, flood_mask, (0, 0), 255)
+    holes = cv2.bitwise_not(padded)[1:-1, 1:-1]
+    return cv2.bitwise_or(subject, holes)
+
+
+  def _kernel(self, pixels):
+    return cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * pixels + 1, 2 * pixels + 1))
+
+
+  def process(self, foreground, guide=None):
+    """
+    foreground: uint8 array, subject white (soft masks are fine)
+    guide: optional RGB uint8 array of the source image, enables refinement
+    returns (mask, alpha) uint8 arrays: the binary inpainting mask with the
+    background white, and the refined, feathered subject alpha for cutouts
+    """
+    alpha = foreground.astype(np.float32) / 255
+    if self.refine and guide is not None:
+      guide_gray = cv2.cvtColor(guide, cv2.COLOR_RGB2GRAY).astype(np.float32) / 255
+      alpha = self.guided_filter(guide_gray, alpha)
+
+    alpha = alpha * 255
+    subject = np.where(alpha >= self.threshold, 255, 0).astype(np.uint8)
+    if self.fill_holes:
+      filled = self._fill_holes(subject)
+      # filled holes are solid subject in the cutout too
+      alpha[filled > subject] = 255
+      subject = filled
+    if self.erode:
+      subject = cv2.erode(subject, self._kernel(self.erode))
+    if self.dilate:
+      subject = cv2.dilate(subject, self._kernel(self.dilate))
+
+    # keep the soft edge from refinement but never outside the cleaned subject
+    alpha = np.minimum(alpha, subject.astype(np.float32))
+    if self.feather:
+      alpha = cv2.GaussianBlur(alpha, (0, 0), self.feather)
+
+    mask = cv2.bitwise_not(subject)
+    return mask, np.clip(alpha, 0, 255).astype(np.uint8)
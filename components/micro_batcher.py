@@ -0,0 +1,68 @@
+import asyncio
+import logging
+
+"""
+Group items submitted by concurrent requests into batches. The first item starts
+a short collection window, everything that arrives before it closes (up to the
+batch size) is processed with one call on a worker thread
+"""
+
+
+class MicroBatcher:
+  def __init__(self, process_batch, max_batch_size: int = 8, window_seconds: float = 0.01):
+    """
+    process_batch takes a list of items and returns a list of results in the
+    same order, it runs in the default executor so it may block
+    """
+    logging.basicConfig()
+    self.logger = logging.getLogger(__name__)
+    self.logger.setLevel(logging.INFO)
+    self.process_batch = process_batch
+    self.max_batch_size = max_batch_size
+    self.window_seconds = window_seconds
+    # created lazily so the batcher can be built before the event loop exists
+    self._queue = None
+    self._worker = None
+
+
+  async def submit(self, item):
+    """queue an item and wait for its result"""
+    if self._queue is None:
+      self._queue = asyncio.Queue()
+    if self._worker is None or self._worker.done():
+      self._worker = asyncio.ensure_future(self._run())
+    future = asyncio.get_event_loop().create_future()
+    await self._queue.put((item, future))
+    return await future
+
+
+  async def _collect(self):
+    batch = [await self._queue.get()]
+    deadline = asyncio.get_event_loop().time() + self.window_seconds
+    while len(batch) < self.max_batch_size:
+      remaining = deadline - asyncio.get_event_loop().time()
+      if remaining <= 0:
+        break
+      try:
+        batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+      except asyncio.TimeoutError:
+        break
+    return batch
+
+
+  async def _run(self):
+    loop = asyncio.get_event_loop()
+    while True:
+      batch = await self._collect()
+      items = [item for item, _ in batch]
+      self.logger.info(f"processing micro batch of {len(items)}")
+      try:
+        results = await loop.run_in_executor(None, self.process_batch, items)
+      except Exception as e:
+        for _, future in batch:
+          if not future.done():
+            future.set_exception(e)
+        continue
+      for (_, future), result in zip(batch, results):
+        if not future.done():
+          future.set_result(result)
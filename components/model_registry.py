@@ -0,0 +1,207 @@
+import logging
+import os
+import tempfile
+from threading import Lock
+
+from components.lazy_import import lazy_module, timed_import
+
+replicate = lazy_module("replicate")
+
+"""
+Process wide cache of loaded models. Components ask the registry for the rembg
+session and replicate model versions instead of building their own, so a worker
+loads each model once and a preforking server can load them before forking
+"""
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_REMBG_MODEL = "u2net"
+# intra op threads for onnx sessions, sessions with a single thread have no thread
+# pool so they are safe to build in a parent process and share with forked workers
+ONNX_THREADS = int(os.environ.get("ONNX_THREADS_PER_WORKER", 0))
+
+_lock = Lock()
+_rembg_sessions = {}
+_replicate_versions = {}
+# (model name, version id) -> lock held while that version is fetched
+_replicate_locks = {}
+_ready = False
+
+
+def is_ready():
+  return _ready
+
+
+def set_ready(ready: bool = True):
+  global _ready
+  _ready = ready
+
+
+# sessions are created with a thread pool unless ONNX_THREADS is 1, those do not
+# survive a fork so they can only be reused in the process that built them
+def fork_safe():
+  return ONNX_THREADS == 1
+
+
+def _rembg_model_path(model_name):
+  home = os.getenv("U2NET_HOME", os.path.join(os.path.expanduser("~"), ".u2net"))
+  return os.path.join(home, f"{model_name}.onnx")
+
+
+class RembgSession:
+  """a loaded rembg model, `inner_session` is its onnxruntime session"""
+
+  def __init__(self, model_name: str, inner_session, fork_safe: bool = False):
+    self.model_name = model_name
+    self.inner_session = inner_session
+    # whether a forked child can keep using it, decided by how it was built
+    self.fork_safe = fork_safe
+
+
+def _dynamic_batch_model(path):
+  """
+  path of a copy of the onnx model at path whose batch dimension is symbolic,
+  written next to it the first time. None if it can't be converted
+  """
+  dynamic_path = f"{os.path.splitext(path)[0]}-dynamic-batch.onnx"
+  if os.path.isfile(dynamic_path):
+    return dynamic_path
+  try:
+    onnx = timed_import("onnx")
+  except ImportError:
+    logger.warning(f"onnx is not installed, can't give {path} a dynamic batch dimension")
+    return None
+  model = onnx.load(path)
+  graph = model.graph
+  # older exports list the weights as inputs too, those keep their shapes
+  weights = {initializer.name for initializer in graph.initializer}
+  for value in list(graph.input) + list(graph.output):
+    dims = value.type.tensor_type.shape.dim
+    if value.name not in weights and dims:
+      # dim_value and dim_param are a oneof, setting the name clears the size
+      dims[0].dim_param = "batch"
+  # intermediate shapes were inferred for the fixed batch and would contradict it
+  del graph.value_info[:]
+  # workers loading at the same time each write their own copy, the last replace wins
+  with tempfile.NamedTemporaryFile(dir=os.path.dirname(dynamic_path), suffix=".onnx.tmp", delete=False) as temporary:
+    temporary_path = temporary.name
+  try:
+    onnx.save(model, temporary_path)
+    os.replace(temporary_path, dynamic_path)
+  except Exception:
+    os.remove(temporary_path)
+    raise
+  logger.info(f"wrote {dynamic_path} with a dynamic batch dimension")
+  return dynamic_path
+
+
+def _fixed_batch(inner_session):
+  batch_dim = inner_session.get_inputs()[0].shape[0]
+  return batch_dim if isinstance(batch_dim, int) and batch_dim > 0 else None
+
+
+def _accepts_batch(inner_session, batch_size: int = 2):
+  """whether the session really runs a batch, a converted graph can still hard code one"""
+  np = timed_import("numpy")
+  model_input = inner_session.get_inputs()[0]
+  if not all(isinstance(dim, int) for dim in model_input.shape[1:]):
+    return True
+  try:
+    outputs = inner_session.run(None, {model_input.name: np.zeros((batch_size, *model_input.shape[1:]), dtype=np.float32)})
+    return outputs[0].shape[0] == batch_size
+  except Exception as e:
+    logger.info(f"model rejected a batch of {batch_size}: {e}")
+    return False
+
+
+def _build_rembg_session(model_name):
+  ort = timed_import("onnxruntime")
+  path = _rembg_model_path(model_name)
+  if not os.path.isfile(path):
+    # rembg downloads the weights the first time a model is used, it can only do
+    # that by building a session so this one load is repeated below
+    logger.info(f"downloading rembg model: {model_name}")
+    timed_import("rembg").new_session(model_name)
+
+  options = ort.SessionOptions()
+  if ONNX_THREADS:
+    options.intra_op_num_threads = ONNX_THREADS
+    options.inter_op_num_threads = 1
+
+  def build(model_path):
+    return ort.InferenceSession(model_path, sess_options=options, providers=ort.get_available_providers())
+
+  inner_session = build(path)
+  # stock u2net is exported with a batch of 1, which would make segmentation
+  # engine batching one image per run. use a copy with a dynamic batch instead
+  if _fixed_batch(inner_session) == 1:
+    try:
+      dynamic_path = _dynamic_batch_model(path)
+      if dynamic_path:
+        dynamic_session = build(dynamic_path)
+        if _accepts_batch(dynamic_session):
+          inner_session = dynamic_session
+        else:
+          logger.warning(f"{dynamic_path} can't run batches, keeping the fixed batch model")
+    except Exception as e:
+      logger.exception(e)
+      logger.warning(f"could not give {model_name} a dynamic batch dimension, keeping the fixed batch model")
+  return RembgSession(model_name, inner_session, fork_safe=fork_safe())
+
+
+def get_rembg_session(model_name: str = DEFAULT_REMBG_MODEL):
+  """return the rembg session for this process, building it on first use"""
+  pid = os.getpid()
+  with _lock:
+    cached = _rembg_sessions.get(model_name)
+    # only rebuild after a fork, and only when the session's thread pool didn't survive it
+    if cached and (cached[0] == pid or cached[1].fork_safe):
+      return cached[1]
+    logger.info(f"loading rembg model: {model_name}")
+    session = _build_rembg_session(model_name)
+    _rembg_sessions[model_name] = (pid, session)
+    return session
+
+
+def get_replicate_version(model_name: str, version_id: str = None):
+  """return a replicate model version, the latest one if no id is given"""
+  key = (model_name, version_id)
+  # the fetch is a network call, only callers of the same version wait on it
+  with _lock:
+    key_lock = _replicate_locks.setdefault(key, Lock())
+  with key_lock:
+    if key not in _replicate_versions:
+      logger.info(f"loading replicate model: {model_name}")
+      model = replicate.models.get(model_name)
+      if version_id is None:
+        version_id = model.versions.list()[0].id
+      _replicate_versions[key] = (model, model.versions.get(version_id))
+    return _replicate_versions[key]
+
+
+def close_connections():
+  """
+  drop pooled http connections held by the replicate client so forked workers
+  do not share sockets opened by the parent
+  """
+  client = getattr(replicate, "default_client", None)
+  for attribute in ("read_session", "write_session", "session"):
+    session = getattr(client, attribute, None)
+    if session is not None and hasattr(session, "close"):
+      session.close()
+
+
+def preload(rembg_models=(DEFAULT_REMBG_MODEL,), replicate_models=()):
+  """
+  load models up front. replicate_models is a list of (model_name, version_id)
+  """
+  for model_name in rembg_models:
+    get_rembg_session(model_name)
+  for model_name, version_id in replicate_models:
+    try:
+      get_replicate_version(model_name, version_id)
+    except Exception as e:
+      # replicate handles are also loaded lazily, a failure here should not stop startup
+      logger.warning(f"could not preload replicate model {model_name}: {e}")
@@ -1,19 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from io import BytesIO
-from PIL import Image
-import replicate
-from time import perf_counter
+import os
 
-from components.replicate_base import ReplicateBase
+from components.compositing import MAX_WORKERS, Placement, composite_batch
+from components.profiling import propagate_context
+from components.replicate_base import PredictionFailed, ReplicateBase
+from components.upload_prep import open_image
 
 
 class OverlayImage(ReplicateBase):
-  def __init__(self):
-    super().__init__()
-    self.model_name = "stability-ai/stable-diffusion"
-    self.model = replicate.models.get(self.model_name)
-    self.model_version_id = self.model.versions.list()[0].id
-    self.version = self.model.versions.get(self.model_version_id)
+  model_name = "stability-ai/stable-diffusion"
+  # None means the latest version of the model
+  model_version_id = None
+
+  def scene_input(self, prompt, num_outputs):
+    return {
+      "prompt": prompt,
+      "width": 768,
+      "height": 768,
+      "prompt_strength": 0.8,
+      "num_outputs": num_outputs,
+      "num_inference_steps": 50,
+      "guidance_scale": 7.5,
+      "scheduler": "K_EULER"
+    }
 
 
   def generate_scenes(
@@ -22,37 +32,22 @@ class OverlayImage(ReplicateBase):
     num_outputs : int = 3
   ):
     self.logger.info(f"generating {num_outputs} for the prompt: {prompt}")
-    prediction = replicate.predictions.create(
-      version=self.version,
-      input={
-        "prompt": prompt,
-        "width": 768,
-        "height": 768,
-        "prompt_strength": 0.8,
-        "num_outputs": num_outputs,
-        "num_inference_steps": 50,
-        "guidance_scale": 7.5,
-        "scheduler": "K_EULER"
-      }
-    )
-    self.logger.info("waiting for pipeline to complete...")
-    start_time = perf_counter()
-    prediction.wait()
-    stop_time = perf_counter()
-    self.logger.info(f"waited for predictions for {stop_time - start_time} seconds...")
+    prediction = self.create_prediction(self.scene_input(prompt, num_outputs), prompt=prompt)
+    self.wait_for_predictions([prediction])
     if num_outputs > 1:
       # if more than one output, iterate through list of urls
-      for output in prediction.output:
-        scene_img = self.request_image(output)
-        path = f"scenes/{datetime.now().isoformat()}.png"
+      scenes = []
+      for scene_img in self.request_images(prediction.output):
+        path = f"{self.SCENE_DIR}/{datetime.now().isoformat()}.png"
         self.logger.info(f"writing generated scene to: {path}")
-        scene_img.save(path)
+        scenes.append((path, scene_img))
+      self.storage.write_images(scenes)
     else:
       # only one output, dont want to iterate through string
       scene_img = self.request_image(prediction.output)
-      path = f"scenes/{datetime.now().isoformat()}.png"
+      path = f"{self.SCENE_DIR}/{datetime.now().isoformat()}.png"
       self.logger.info(f"writing generated scene to: {path}")
-      scene_img.save(path)
+      self.storage.write_image(path, scene_img)
 
 
   def generate_scenes_endpoint(
@@ -61,25 +56,11 @@ class OverlayImage(ReplicateBase):
     num_outputs : int = 3
   ):
     self.logger.info(f"generating {num_outputs} for the prompt: {prompt}")
-    prediction = replicate.predictions.create(
-      version=self.version,
-      input={
-        "prompt": prompt,
-        "width": 768,
-        "height": 768,
-        "prompt_strength": 0.8,
-        "num_outputs": num_outputs,
-        "num_inference_steps": 50,
-        "guidance_scale": 7.5,
-        "scheduler": "K_EULER"
-      }
-    )
-    self.logger.info("waiting for pipeline to complete...")
-    start_time = perf_counter()
-    prediction.wait()
-    stop_time = perf_counter()
-    self.logger.info(f"waited for predictions for {stop_time - start_time} seconds...")
-    
+    prediction = self.create_prediction(self.scene_input(prompt, num_outputs), prompt=prompt)
+    self.wait_for_predictions([prediction])
+    if prediction.status != "succeeded":
+      self.logger.error(f"scene prediction {prediction.id} {prediction.status}: {prediction.error}")
+      raise PredictionFailed(f"scene generation {prediction.status}: {prediction.error}")
     return prediction.output
   
 
@@ -92,32 +73,74 @@ class OverlayImage(ReplicateBase):
     y_pos: int = 50,
   ):
     self.logger.info("reading in images...")
-    background_image = Image.open(background_path)
-    foreground_image = Image.open(foreground_path).resize(background_image.size)
+    background_image = self.storage.read_image(background_path)
+    foreground_image = self.storage.read_image(foreground_path).resize(background_image.size)
 
     back_im = background_image.copy()
     self.logger.info(f"overlaying image: {foreground_path} over: {background_path} at position ({x_pos}, {y_pos})")
     back_im.paste(foreground_image, (x_pos, y_pos), mask=foreground_image)
     self.logger.info(f"writing overlain image to {output_path}")
-    back_im.save(output_path)
+    self.storage.write_image(output_path, back_im)
 
 
   def overlay_image_endpoint(
     self,
-    background_img: bytes,
-    foreground_img: bytes,
+    background_img,
+    foreground_img,
     x_pos: int = 100,
     y_pos: int = 50,
   ):
+    """images can be passed as bytes or file objects"""
     self.logger.info("reading in images...")
-    background_image = Image.open(BytesIO(background_img))
-    foreground_image = Image.open(BytesIO(foreground_img)).resize(background_image.size)
+    background_image = open_image(background_img)
+    # foreground is scaled to the background anyway, skip decoding extra pixels
+    foreground_image = open_image(foreground_img, target_size=background_image.size).resize(background_image.size)
 
     back_im = background_image.copy()
     back_im.paste(foreground_image, (x_pos, y_pos), mask=foreground_image)
     return back_im
 
-  
+
+
+  def overlay_batch(
+    self,
+    foreground_path: str,
+    scene_paths,
+    placements=None,
+    output_dir: str = None,
+  ):
+    """
+    composite one foreground onto many scenes, placements (compositing.Placement)
+    index into scene_paths and default to one top left placement per scene.
+    returns the written locations, one per placement
+    """
+    output_dir = output_dir or self.OUTPUT_IMAGE_DIR
+    placements = placements or [Placement(scene=index) for index in range(len(scene_paths))]
+    self.logger.info(f"reading foreground and {len(scene_paths)} scene(s)...")
+    foreground_image = self.storage.read_image(foreground_path)
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(scene_paths)))) as executor:
+      scenes = list(executor.map(propagate_context(self.storage.read_image), scene_paths))
+
+    self.logger.info(f"overlaying {foreground_path} in {len(placements)} placement(s)")
+    outputs = composite_batch(foreground_image, scenes, placements)
+
+    foreground_name = os.path.splitext(os.path.basename(foreground_path))[0]
+    writes = []
+    for index, (placement, output) in enumerate(zip(placements, outputs)):
+      scene_name = os.path.splitext(os.path.basename(scene_paths[placement.scene]))[0]
+      writes.append((f"{output_dir}/{foreground_name}-{scene_name}-{index}.png", output))
+    self.logger.info(f"writing {len(writes)} overlain image(s) to {output_dir}")
+    return self.storage.write_images(writes)
+
+
+  def overlay_batch_endpoint(self, foreground_img, background_imgs, placements=None):
+    """images can be passed as bytes or file objects, returns one image per placement"""
+    self.logger.info(f"reading foreground and {len(background_imgs)} scene(s)...")
+    foreground_image = open_image(foreground_img)
+    scenes = [open_image(background_img) for background_img in background_imgs]
+    placements = placements or [Placement(scene=index) for index in range(len(scenes))]
+    return composite_batch(foreground_image, scenes, placements)
+
 
 if __name__ == "__main__":
   overlay = OverlayImage()
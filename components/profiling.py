@@ -0,0 +1,292 @@
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+import cProfile
+from datetime import datetime
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import sys
+from threading import Lock
+import time
+import tracemalloc
+from uuid import uuid4
+
+"""
+Opt in cpu and allocation profiling of single api requests or pipeline files.
+A profile session records a cProfile profile of every thread that does work for
+it and a tracemalloc snapshot taken when it ends. Both are written to the
+profile directory as artifacts (`.prof` for pstats/snakeviz, `.tracemalloc`
+for tracemalloc.Snapshot.load) next to a json summary of the hot spots
+"""
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# fraction of requests profiled without being asked to, 0 disables sampling
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+# requests sending this value in `X-Profile` are profiled, unset disables the header
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+# profiling is expensive, never run more than this many sessions at once. before
+# python 3.12 a thread has one profile hook, so concurrent sessions on the event
+# loop thread would replace each other's, it is held at 1 there
+MAX_CONCURRENT_PROFILES = int(os.environ.get("MAX_CONCURRENT_PROFILES", 1))
+# artifacts of older sessions are deleted beyond this many, 0 keeps them all
+MAX_PROFILES = int(os.environ.get("MAX_PROFILES", 50))
+# entries in the summary's top functions and allocation sites
+TOP_ENTRIES = 25
+TRACEBACK_FRAMES = 10
+
+# the session work done in the current context belongs to, see `profile_thread`
+current_session = ContextVar("current_profile_session", default=None)
+
+_tracemalloc_lock = Lock()
+_tracemalloc_users = 0
+_tracemalloc_owned = False
+
+
+def _start_tracemalloc():
+  global _tracemalloc_users, _tracemalloc_owned
+  with _tracemalloc_lock:
+    if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+      tracemalloc.start(TRACEBACK_FRAMES)
+      _tracemalloc_owned = True
+    _tracemalloc_users += 1
+    if _tracemalloc_users == 1 and hasattr(tracemalloc, "reset_peak"):
+      tracemalloc.reset_peak()
+
+
+def _stop_tracemalloc():
+  global _tracemalloc_users, _tracemalloc_owned
+  with _tracemalloc_lock:
+    _tracemalloc_users -= 1
+    # only stop tracing we started, PYTHONTRACEMALLOC may have turned it on
+    if _tracemalloc_users == 0 and _tracemalloc_owned:
+      tracemalloc.stop()
+      _tracemalloc_owned = False
+
+
+def _slug(name):
+  return re.sub(r"[^A-Za-z0-9_.-]+", "-", name).strip("-")[:60]
+
+
+class ProfileSession:
+  def __init__(self, name: str):
+    self.name = name
+    self.profile_id = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{_slug(name)}-{uuid4().hex[:6]}"
+    self.profiles = []
+    self._lock = Lock()
+    self.start_time = None
+    self.start_cpu = None
+    self.start_snapshot = None
+
+
+  @contextmanager
+  def thread(self):
+    """profile the calling thread for the duration of the block"""
+    profile = cProfile.Profile()
+    try:
+      profile.enable()
+    except ValueError:
+      # python 3.12+ allows one active profiler, which already sees every thread
+      yield
+      return
+    try:
+      yield
+    finally:
+      profile.disable()
+      with self._lock:
+        self.profiles.append(profile)
+
+
+def profile_thread(func, *args, **kwargs):
+  """call func, profiled as part of the current context's session if there is one"""
+  session = current_session.get()
+  if session is None:
+    return func(*args, **kwargs)
+  with session.thread():
+    return func(*args, **kwargs)
+
+
+def propagate_context(func):
+  """
+  wrap func for a thread pool: each call runs in a copy of the submitting thread's
+  context, so pool work sees the request deadline and joins its profile session
+  """
+  context = copy_context()
+
+  def run(*args, **kwargs):
+    # a context can only be entered by one thread at a time, every call gets its own copy
+    return context.copy().run(profile_thread, func, *args, **kwargs)
+
+  return run
+
+
+class Profiler:
+  def __init__(
+    self,
+    directory: str = PROFILE_DIR,
+    sample_rate: float = PROFILE_SAMPLE_RATE,
+    token: str = PROFILE_TOKEN,
+    max_concurrent: int = MAX_CONCURRENT_PROFILES,
+    max_profiles: int = MAX_PROFILES,
+  ):
+    self.directory = directory
+    self.sample_rate = sample_rate
+    self.token = token
+    if max_concurrent > 1 and sys.version_info < (3, 12):
+      logger.warning(f"MAX_CONCURRENT_PROFILES={max_concurrent} needs python 3.12, profiling one session at a time")
+      max_concurrent = 1
+    self.max_concurrent = max_concurrent
+    self.active = 0
+    # summaries of the latest sessions, oldest first
+    self.summaries = deque(maxlen=max_profiles or None)
+    self._lock = Lock()
+
+
+  def should_profile(self, header: str = None):
+    """profile when the header carries the token, or for a sample of requests"""
+    if self.token and header == self.token:
+      return True
+    return self.sample_rate > 0 and random.random() < self.sample_rate
+
+
+  @contextmanager
+  def session(self, name: str):
+    """
+    profile the block (and work handed to profile_thread from it), yields the
+    session or None when too many sessions are already running
+    """
+    with self._lock:
+      busy = self.active >= self.max_concurrent
+      if not busy:
+        self.active += 1
+    if busy:
+      yield None
+      return
+    session = ProfileSession(name)
+    token = current_session.set(session)
+    _start_tracemalloc()
+    session.start_snapshot = tracemalloc.take_snapshot()
+    session.start_time = time.perf_counter()
+    session.start_cpu = time.process_time()
+    try:
+      with session.thread():
+        yield session
+    finally:
+      wall_seconds = time.perf_counter() - session.start_time
+      cpu_seconds = time.process_time() - session.start_cpu
+      end_snapshot = tracemalloc.take_snapshot()
+      peak_bytes = tracemalloc.get_traced_memory()[1]
+      _stop_tracemalloc()
+      current_session.reset(token)
+      with self._lock:
+        self.active -= 1
+      try:
+        self.save(session, end_snapshot, wall_seconds, cpu_seconds, peak_bytes)
+      except Exception as e:
+        logger.exception(e)
+        logger.info(f"exception saving profile {session.profile_id}")
+
+
+  def path(self, profile_id: str, extension: str):
+    return os.path.join(self.directory, f"{profile_id}{extension}")
+
+
+  def save(self, session, end_snapshot, wall_seconds, cpu_seconds, peak_bytes):
+    os.makedirs(self.directory, exist_ok=True)
+    stats = pstats.Stats(*session.profiles)
+    stats.dump_stats(self.path(session.profile_id, ".prof"))
+
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+    end_snapshot = end_snapshot.filter_traces(ignore)
+    end_snapshot.dump(self.path(session.profile_id, ".tracemalloc"))
+    growth = end_snapshot.compare_to(session.start_snapshot.filter_traces(ignore), "lineno")
+
+    functions = []
+    for (filename, line, function), (_, calls, total_time, cumulative_time, _) in stats.stats.items():
+      functions.append({
+        "function": f"{filename}:{line}({function})",
+        "calls": calls,
+        "self_seconds": round(total_time, 6),
+        "cumulative_seconds": round(cumulative_time, 6),
+      })
+
+    summary = {
+      "id": session.profile_id,
+      "name": session.name,
+      "created_at": datetime.now().isoformat(),
+      "wall_seconds": round(wall_seconds, 6),
+      # process wide, includes concurrent work that wasn't part of this session
+      "cpu_seconds": round(cpu_seconds, 6),
+      "threads_profiled": len(session.profiles),
+      "peak_traced_bytes": peak_bytes,
+      "top_cumulative": sorted(functions, key=lambda entry: entry["cumulative_seconds"], reverse=True)[:TOP_ENTRIES],
+      "top_self": sorted(functions, key=lambda entry: entry["self_seconds"], reverse=True)[:TOP_ENTRIES],
+      "top_allocations": [
+        {"site": str(stat.traceback), "size_diff_bytes": stat.size_diff, "count_diff": stat.count_diff}
+        for stat in growth[:TOP_ENTRIES]
+      ],
+      "artifacts": {
+        "pstats": self.path(session.profile_id, ".prof"),
+        "tracemalloc": self.path(session.profile_id, ".tracemalloc"),
+      },
+    }
+    with open(self.path(session.profile_id, ".json"), "w") as f:
+      json.dump(summary, f, indent=2)
+
+    with self._lock:
+      if self.summaries.maxlen is not None and len(self.summaries) == self.summaries.maxlen:
+        self._delete(self.summaries[0]["id"])
+      self.summaries.append(summary)
+    logger.info(f"profiled {session.name} in {wall_seconds:.3f} seconds, wrote {summary['artifacts']['pstats']}")
+    return summary
+
+
+  def _delete(self, profile_id):
+    for extension in (".prof", ".tracemalloc", ".json"):
+      try:
+        os.remove(self.path(profile_id, extension))
+      except OSError:
+        pass
+
+
+  def list(self):
+    """short summaries of the kept sessions, newest first"""
+    with self._lock:
+      summaries = list(self.summaries)
+    return [
+      {
+        "id": summary["id"],
+        "name": summary["name"],
+        "created_at": summary["created_at"],
+        "wall_seconds": summary["wall_seconds"],
+        "cpu_seconds": summary["cpu_seconds"],
+        "peak_traced_bytes": summary["peak_traced_bytes"],
+        "hottest": summary["top_self"][0]["function"] if summary["top_self"] else None,
+      }
+      for summary in reversed(summaries)
+    ]
+
+
+  def get(self, profile_id: str):
+    with self._lock:
+      for summary in self.summaries:
+        if summary["id"] == profile_id:
+          return summary
+    return None
+
+
+@contextmanager
+def maybe_profile(profiler, name: str):
+  """profiler.session(name) for a sample of calls if a profiler is set, otherwise a no-op"""
+  if profiler is None or not profiler.should_profile():
+    yield None
+    return
+  with profiler.session(name) as session:
+    yield session
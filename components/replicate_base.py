@@ -1,11 +1,26 @@
 import logging
+import os
 from time import perf_counter
 from io import BytesIO
-import os
 from PIL import Image
-import requests
+
+from components.deadline import check_deadline
+from components.http_client import get_http_client
+from components.lazy_import import lazy_module
+from components.model_registry import get_replicate_version
+from components.storage import get_storage
+from components.usage import get_usage_ledger
+
+replicate = lazy_module("replicate")
 
 DICT_DEFAULT_VAL = "Not Present"
+# predictions are read from here when the client's model lacks their timings
+REPLICATE_API_URL = os.environ.get("REPLICATE_API_URL", "https://api.replicate.com")
+
+
+class PredictionFailed(Exception):
+  """a prediction an endpoint waited for didn't succeed, the message carries its error"""
+  pass
 
 
 # set up defaultdict default value
@@ -18,14 +33,80 @@ def default_prompt():
 
 
 class ReplicateBase:
+  model_name = None
+  model_version_id = None
+
   def __init__(self):
+    # cooperative so mixins such as BaseMaskGen are initialized too
+    super().__init__()
+    # replicate handles are looked up on first use, see `version`
+    self.model = None
+    self._version = None
     self.IMAGE_DIR = "background-images"
     self.MASK_IMAGE_DIR = "mask-images"
     self.OUTPUT_IMAGE_DIR = "output-images"
+    self.SCENE_DIR = "scenes"
+    # images are read and written through storage, local files relative to the cwd by default
+    self.storage = get_storage()
+    # per file cpu and allocation profiles are off unless set_profiler is called
+    self.profiler = None
+    # every prediction is accounted in the process wide ledger under these labels
+    self.usage = get_usage_ledger()
+    self.usage_labels = {"endpoint": type(self).__name__}
+    # outputs are downloaded through the process wide pooled client
+    self.http = get_http_client()
     logging.basicConfig()
     self.logger = logging.getLogger(__name__)
     self.logger.setLevel(logging.INFO)
 
+  @property
+  def version(self):
+    """replicate model version, shared by every instance in the process"""
+    if self._version is None:
+      self.model, self._version = get_replicate_version(self.model_name, self.model_version_id)
+    return self._version
+
+
+  def set_storage(self, storage):
+    """set the storage backend images are read from and written to"""
+    self.storage = storage
+
+
+  def set_profiler(self, profiler=None):
+    """profile each file (or batch) with profiler, None disables profiling"""
+    self.profiler = profiler
+
+
+  def set_usage_labels(self, endpoint: str = None, batch: str = None):
+    """label the usage of predictions created from now on, e.g. with the api path or a batch id"""
+    if endpoint is not None:
+      self.usage_labels["endpoint"] = endpoint
+    if batch is not None:
+      self.usage_labels["batch"] = batch
+
+
+  def track_prediction(self, prediction, input, prompt: str = None):
+    """account a prediction created with `input`, including ones reattached after a restart"""
+    self.usage.track(
+      prediction,
+      labels={**self.usage_labels, "prompt": prompt},
+      inference_steps=input.get("num_inference_steps", 0) * input.get("num_outputs", 1),
+      outputs=input.get("num_outputs", 1),
+    )
+
+
+  def create_prediction(self, input, prompt: str = None):
+    """
+    create a prediction of this model, raises BudgetExceeded when the usage budget is
+    spent and DeadlineExceeded when the request it is for has timed out
+    """
+    check_deadline("creating a prediction")
+    self.usage.check_budget()
+    prediction = replicate.predictions.create(version=self.version, input=input)
+    self.track_prediction(prediction, input, prompt)
+    return prediction
+
+
   def get_filename_list(self):
     """
     create a list of filenames to be used later. add filenames to list only
@@ -33,20 +114,22 @@ class ReplicateBase:
     """
     filename_list = []
 
-    for filename in os.listdir(self.MASK_IMAGE_DIR):
-      if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-        mask = os.path.join(self.MASK_IMAGE_DIR, filename)
-        image = os.path.join(self.IMAGE_DIR, filename)
-        # check if both paths are valid files
-        if os.path.isfile(mask) and os.path.isfile(image):
-          filename_list.append(filename)
+    for filename in self.storage.list_images(self.MASK_IMAGE_DIR):
+      image = f"{self.IMAGE_DIR}/{filename}"
+      # check the matching image exists
+      if self.storage.exists(image):
+        filename_list.append(filename)
     
     return filename_list
   
 
   def request_image(self, output):
-    response = requests.get(output)
-    return Image.open(BytesIO(response.content))
+    return Image.open(BytesIO(self.http.fetch(output)))
+
+
+  def request_images(self, outputs):
+    """download the outputs of a prediction in parallel, returns the images in order"""
+    return [Image.open(BytesIO(content)) for content in self.http.fetch_many(outputs)]
 
 
   def run_pipeline(self, filename_list):
@@ -56,6 +139,9 @@ class ReplicateBase:
     """
     check that all predictions are complete in list
     """
+    if not prediction_list:
+      self.logger.info("no predictions to wait for")
+      return
     self.logger.info("waiting for predictions to complete...")
     start_time = perf_counter()
 
@@ -76,6 +162,31 @@ class ReplicateBase:
 
     stop_time = perf_counter()
     self.logger.info(f"waited for predictions for {stop_time - start_time} seconds...")
+    for prediction in prediction_list:
+      self.record_usage(prediction)
+
+
+  def prediction_details(self, prediction):
+    """
+    the api's json for a prediction. replicate 0.4.0's Prediction keeps only id,
+    status, input, output, error, logs and version, the metrics and timestamps
+    usage accounting needs are only in the raw response
+    """
+    return self.http.fetch_json(
+      f"{REPLICATE_API_URL}/v1/predictions/{prediction.id}",
+      headers={"Authorization": f"Token {os.environ.get('REPLICATE_API_TOKEN', '')}"},
+    )
+
+
+  def record_usage(self, prediction):
+    """account a finished prediction, reading its timings from the api if the object has none"""
+    details = None
+    if self.usage.needs_timings(prediction):
+      try:
+        details = self.prediction_details(prediction)
+      except Exception as e:
+        self.logger.warning(f"could not read timings of prediction {prediction.id}: {e}")
+    self.usage.record_finished(prediction, details)
 
   def write_output(self, filename_list, predictions):
     raise NotImplemented
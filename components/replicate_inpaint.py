@@ -1,12 +1,20 @@
 from collections import defaultdict
-from datetime import datetime
+import hashlib
 from io import BytesIO
+import json
+import os
 from PIL import Image
-from time import perf_counter
-import replicate
-import requests
 
+from components.deadline import DeadlineExceeded
+from components.lazy_import import lazy_module
+from components.manifest import CHUNK_SIZE, chunked
+from components.profiling import maybe_profile
 from components.replicate_base import ReplicateBase, DICT_DEFAULT_VAL, default_prompt, def_value
+from components.run_journal import RunJournal
+from components.usage import BudgetExceeded
+from components.upload_prep import UploadPreparer
+
+replicate = lazy_module("replicate")
 
 class ReplicateInPainting(ReplicateBase):
   model_name = "stability-ai/stable-diffusion-inpainting"
@@ -15,14 +23,15 @@ class ReplicateInPainting(ReplicateBase):
   PROMPT_STRENGTH = 0.8
   NUM_INFERENCE_STEPS = 25
   GUIDANCE_SCALE = 7.5
+  # stable diffusion inpainting works at 512x512, larger uploads are wasted bytes
+  UPLOAD_MAX_SIDE = 512
 
   def __init__(self):
     super().__init__()
-    # initialize replicate model obj
-    self.model = replicate.models.get(self.model_name)
-    # get latest version (can be found with model.versions.list())
-    self.version = self.model.versions.get(self.model_version_id)
-    # store prompt for each file name, can be read in later
+    self.upload_preparer = UploadPreparer(max_side=self.UPLOAD_MAX_SIDE)
+    # records submitted predictions and written outputs so batches can resume, see set_journal
+    self.journal = None
+    # store prompt for each file name, fallback for files a manifest gives no prompt, see run_manifest
     self.prompt_dict = defaultdict(default_prompt)
     self.prompt_dict["image (60).png"] = "A peaceful lake nestled in a valley surrounded by the towering snowing mountains of the Alps, a mist is rising from the water with a golden sunrise illuminating the sky, photorealistic, 8k"
     self.prompt_dict["image (59).png"] = "A narrow cobblestone alley way in New York lined with brick buildings that are several stories tall with ivy climbing the walls and a small cafe with tables illuminated by an old-fashioned street lamp, photorealistic, 8k"
@@ -30,56 +39,187 @@ class ReplicateInPainting(ReplicateBase):
     self.prompt_dict["image (64).png"] = "A sandy beach with crystal-clear water and palm trees swaying in the breeze with a sunset casting a warm glow over the scene, photorealistic, 8k"
   
 
-  def run_pipeline(self, filename_list, prompt_dict):
+  def set_journal(self, path: str = None):
+    """journal batch progress to path and resume from it, None disables journaling"""
+    self.journal = RunJournal(path) if path else None
+
+
+  def item_key(self, filename, prompt, image_bytes, mask_bytes, num_outputs=None, num_inference_steps=None):
+    """
+    stable id for one file's inpainting run, changes when any input parameter or
+    the content of the image or mask changes
+    """
+    params = {
+      "filename": filename,
+      "prompt": prompt,
+      "image_sha256": hashlib.sha256(image_bytes).hexdigest(),
+      "mask_sha256": hashlib.sha256(mask_bytes).hexdigest(),
+      "model_version_id": self.model_version_id,
+      "num_outputs": num_outputs or self.NUM_IMG_OUTPUTS,
+      "num_inference_steps": num_inference_steps or self.NUM_INFERENCE_STEPS,
+      "prompt_strength": self.PROMPT_STRENGTH,
+      "guidance_scale": self.GUIDANCE_SCALE,
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+  def output_path(self, filename, key, index):
+    # deterministic so a rerun overwrites its own outputs instead of adding more
+    stem, extension = os.path.splitext(filename)
+    return f"{self.OUTPUT_IMAGE_DIR}/{stem}-{key}-{index}{extension}"
+
+
+  def reattach_prediction(self, key, filename):
+    """
+    return the prediction journaled for an item if it can still produce output,
+    None if the item has to be submitted again
+    """
+    prediction_id = self.journal.prediction_id(key) if self.journal else None
+    if not prediction_id:
+      return None
+    try:
+      prediction = replicate.predictions.get(prediction_id)
+    except Exception as e:
+      self.logger.info(f"could not reattach to prediction {prediction_id} for {filename}: {e}")
+      return None
+    if prediction.status in ("failed", "canceled"):
+      self.logger.info(f"journaled prediction {prediction_id} for {filename} is {prediction.status}, resubmitting")
+      return None
+    self.logger.info(f"reattached to prediction {prediction_id} for {filename} ({prediction.status})")
+    return prediction
+
+
+  def prediction_input(self, prompt, image=None, mask=None, num_outputs=None, num_inference_steps=None):
+    return {
+      "prompt": prompt,
+      "image": image,
+      "mask": mask,
+      "prompt_strength": self.PROMPT_STRENGTH,
+      "num_outputs": num_outputs or self.NUM_IMG_OUTPUTS,
+      "num_inference_steps": num_inference_steps or self.NUM_INFERENCE_STEPS,
+      "guidance_scale": self.GUIDANCE_SCALE,
+    }
+
+
+  def outputs_exist(self, key, filename):
+    """whether the journal has the item completed and every output it wrote is still in storage"""
+    output_keys = self.journal.completed_output_keys(key) if self.journal else None
+    if output_keys is None:
+      return False
+    # the journal may come from a run against other storage, or outputs were deleted since
+    if not all(self.storage.exists(output_key) for output_key in output_keys):
+      self.logger.info(f"{filename} is completed in the journal but its outputs are missing, running it again")
+      return False
+    return True
+
+
+  def run_pipeline(self, filename_list, prompt_dict, settings=None, keys=None):
     """
     models will run in background so we don't have to wait for each prediction result
-    can get later run model for each file found earlier
+    can get later run model for each file found earlier. settings maps a filename
+    to the num_outputs and num_inference_steps it overrides, keys is filled with
+    the item key of every file for write_output
     """
+    settings = settings or {}
+    keys = {} if keys is None else keys
     # default dict to hold 
     predictions = defaultdict(def_value)
 
     for filename in filename_list:
-      with open(f"{self.IMAGE_DIR}/{filename}", "rb") as image, open(f"{self.MASK_IMAGE_DIR}/{filename}", "rb") as mask:
+      options = settings.get(filename, {})
+      try:
+        image_bytes = self.storage.read(f"{self.IMAGE_DIR}/{filename}")
+        mask_bytes = self.storage.read(f"{self.MASK_IMAGE_DIR}/{filename}")
+      except Exception as e:
+        self.logger.exception(e)
+        self.logger.info(f"exception reading inputs for {filename}: {e}")
+        continue
+      key = self.item_key(filename, prompt_dict[filename], image_bytes, mask_bytes, **options)
+      keys[filename] = key
+      if self.outputs_exist(key, filename):
+        self.logger.info(f"{filename} already completed in journal, skipping")
+        continue
+      prediction = self.reattach_prediction(key, filename)
+      if prediction is not None:
+        # the run that created it never got to account for it
+        self.track_prediction(prediction, self.prediction_input(prompt_dict[filename], **options), prompt=prompt_dict[filename])
+        predictions[filename] = prediction
+        continue
+      with maybe_profile(self.profiler, f"inpaint submit {filename}"):
         try:
-          prediction = replicate.predictions.create(
-            version=self.version,
-            input={
-              "prompt": prompt_dict[filename],
-              "image": image,
-              "mask": mask,
-              "prompt_strength": self.PROMPT_STRENGTH,
-              "num_outputs": self.NUM_IMG_OUTPUTS,
-              "num_inference_steps": self.NUM_INFERENCE_STEPS,
-              "guidance_scale": self.GUIDANCE_SCALE,
-            }
-          )
-          predictions[filename] = prediction
-          self.logger.info(f"prediction triggered for {filename}")
+          image, mask = self.upload_preparer.prepare_pair(image_bytes, mask_bytes)
         except Exception as e:
           self.logger.exception(e)
-          self.logger.info(f"exception calling prediction for {filename}: {e}")
+          self.logger.info(f"exception preparing upload for {filename}: {e}")
+          continue
+        with image, mask:
+          try:
+            prediction = self.create_prediction(
+              self.prediction_input(prompt_dict[filename], image, mask, **options),
+              prompt=prompt_dict[filename]
+            )
+            predictions[filename] = prediction
+            if self.journal:
+              self.journal.record_submitted(key, filename, prediction.id)
+            self.logger.info(f"prediction triggered for {filename}")
+          except BudgetExceeded as e:
+            # the rest of the batch is left for a later (resumed) run
+            self.logger.warning(f"stopping batch before {filename}: {e}")
+            break
+          except Exception as e:
+            self.logger.exception(e)
+            self.logger.info(f"exception calling prediction for {filename}: {e}")
     
     return predictions
 
 
-  def write_output(self, filename_list, predictions):
+  def write_output(self, filename_list, predictions, keys):
+    """keys maps each filename to the item key run_pipeline gave it"""
+    # outputs are fetched first and then written to storage as one batch
+    output_images = []
+    # filename -> (item key, indexes into output_images) for journaling after the write
+    written = {}
+    # files with an output that couldn't be fetched, left unfinished in the journal
+    incomplete = set()
     for filename in filename_list:
-      curr_prediction = predictions[filename]
-      # check prediciton in dict
-      if curr_prediction != DICT_DEFAULT_VAL:
-        prediction_output = curr_prediction.output
-        for output in prediction_output:
-          # create filepath for new mask image
-          new_mask_img_filepath = f"{self.OUTPUT_IMAGE_DIR}/{datetime.now().isoformat()}-{filename}"
-          self.logger.info(f"writing image: {new_mask_img_filepath}")
-          # retrieve output from prediction
-          try:
-            response = requests.get(output)
-            img = Image.open(BytesIO(response.content))
-            img.save(new_mask_img_filepath)
-          except Exception as e:
-            self.logger.info(f"exception writing {new_mask_img_filepath}")
-            self.logger.exception(e)
+      with maybe_profile(self.profiler, f"inpaint output {filename}"):
+        curr_prediction = predictions[filename]
+        # check prediciton in dict
+        if curr_prediction != DICT_DEFAULT_VAL:
+          key = keys[filename]
+          if curr_prediction.status != "succeeded":
+            self.logger.error(f"prediction for {filename} {curr_prediction.status}: {curr_prediction.error}")
+            if self.journal:
+              self.journal.record_failed(key, filename, curr_prediction.error)
+            continue
+          written[filename] = (key, [])
+          prediction_output = curr_prediction.output
+          # every output of the prediction is downloaded at once over the pooled client
+          contents = self.http.fetch_many(prediction_output, return_exceptions=True)
+          for index, content in enumerate(contents):
+            # create filepath for new mask image
+            new_mask_img_filepath = self.output_path(filename, key, index)
+            self.logger.info(f"writing image: {new_mask_img_filepath}")
+            try:
+              if isinstance(content, Exception):
+                raise content
+              img = Image.open(BytesIO(content))
+              written[filename][1].append(len(output_images))
+              output_images.append((new_mask_img_filepath, img))
+            except Exception as e:
+              self.logger.info(f"exception writing {new_mask_img_filepath}")
+              self.logger.exception(e)
+              # leave the item unfinished in the journal so a resume fetches it again
+              incomplete.add(filename)
+    locations = self.storage.write_images(output_images)
+
+    if self.journal:
+      for filename, (key, indexes) in written.items():
+        if filename in incomplete:
+          continue
+        outputs = [locations[index] for index in indexes]
+        if all(outputs):
+          self.journal.record_completed(key, filename, outputs, [output_images[index][0] for index in indexes])
   
 
   def run(self):
@@ -88,10 +228,20 @@ class ReplicateInPainting(ReplicateBase):
 
     self.logger.info(f"found {len(filename_list)} valid image names with masks...")
 
+    self.run_batch(filename_list, self.prompt_dict)
+
+
+  def run_batch(self, filename_list, prompt_dict, settings=None):
+    """submit, wait for and write the outputs of one batch of files"""
+    # every file gets its own prediction, an output inpainted around one image
+    # doesn't fit a near duplicate with a different crop or product
     # run replicate pipeline
+    keys = {}
     predictions = self.run_pipeline(
       filename_list=filename_list,
-      prompt_dict=self.prompt_dict
+      prompt_dict=prompt_dict,
+      settings=settings,
+      keys=keys
     )
 
     # need predictions in list form for some operations
@@ -102,40 +252,63 @@ class ReplicateInPainting(ReplicateBase):
 
     self.logger.info("predictions complete, fetching results...")
 
-    self.write_output(filename_list=filename_list, predictions=predictions)
+    self.write_output(
+      filename_list=filename_list,
+      predictions=predictions,
+      keys=keys
+    )
+
+
+  def run_manifest(self, items, chunk_size: int = CHUNK_SIZE):
+    """
+    inpaint the rows of a manifest (manifest.ManifestItem), read lazily and run a
+    chunk at a time with rows sharing a prompt next to each other. rows without
+    a prompt fall back to prompt_dict, rows whose image or mask is missing are skipped
+    """
+    total = 0
+    for chunk in chunked(items, chunk_size):
+      prompt_dict = {}
+      settings = {}
+      for item in chunk:
+        if not self.storage.exists(f"{self.IMAGE_DIR}/{item.filename}") or not self.storage.exists(f"{self.MASK_IMAGE_DIR}/{item.filename}"):
+          self.logger.warning(f"skipping {item.filename}, image or mask is missing")
+          continue
+        prompt_dict[item.filename] = item.prompt or self.prompt_dict.get(item.filename) or default_prompt()
+        settings[item.filename] = item.options()
+      if not prompt_dict:
+        continue
+      total += len(prompt_dict)
+      self.logger.info(f"inpainting a chunk of {len(prompt_dict)} manifest row(s), {total} so far...")
+      self.run_batch(list(prompt_dict), prompt_dict, settings)
+      try:
+        self.usage.check_budget()
+      except BudgetExceeded as e:
+        # the rest of the manifest is left for a later (resumed) run
+        self.logger.warning(f"stopping manifest after {total} row(s): {e}")
+        break
   
 
   def run_endpoint(
     self, 
-    image: bytes,
-    mask_image: bytes,
+    image,
+    mask_image,
     prompt: str = "",
     num_outputs: int = 2,
   ):
+    """images can be passed as bytes or file objects"""
     self.logger.info("reading in images...")
     try:
-      img_tmp = BytesIO(image)
-      mask_tmp = BytesIO(mask_image)
-      prediction = replicate.predictions.create(
-        version=self.version,
-        input={
-          "prompt": prompt,
-          "image": img_tmp,
-          "mask": mask_tmp,
-          "prompt_strength": self.PROMPT_STRENGTH,
-          "num_outputs": num_outputs,
-          "num_inference_steps": self.NUM_INFERENCE_STEPS,
-          "guidance_scale": self.GUIDANCE_SCALE,
-        }
+      img_tmp, mask_tmp = self.upload_preparer.prepare_pair(image, mask_image)
+      prediction = self.create_prediction(
+        self.prediction_input(prompt, img_tmp, mask_tmp, num_outputs),
+        prompt=prompt
       )
-      self.logger.info("waiting for pipeline to complete...")
-      start_time = perf_counter()
-      prediction.wait()
-      stop_time = perf_counter()
-      self.logger.info(f"waited for predictions for {stop_time - start_time} seconds...")
+      self.wait_for_predictions([prediction])
       if prediction.status != 'succeeded':
         self.logger.error(f"Error from prediction pipeline: {prediction.error}")
       return prediction.output
+    except (BudgetExceeded, DeadlineExceeded):
+      raise
     except Exception as e:
       self.logger.error("Exception running inpaint prediction:")
       self.logger.exception(e)
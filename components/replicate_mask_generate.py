@@ -1,23 +1,23 @@
 from collections import defaultdict
-import cv2
-import os
-from PIL import Image, ImageOps
-import replicate
-from time import perf_counter
+from PIL import Image
 
 from components.base_mask_gen import BaseMaskGen
+from components.dedup import adapt_output
+from components.profiling import maybe_profile
 from components.replicate_base import ReplicateBase, DICT_DEFAULT_VAL, def_value
+from components.usage import BudgetExceeded
+from components.upload_prep import UploadPreparer
 
 class ReplicateMaskGen(ReplicateBase, BaseMaskGen):
+  model_name = "arielreplicate/dichotomous_image_segmentation"
+  model_version_id = "69bd4043d3ff604dcf5abeb27e10d959d520f323cf990a188f072c578348c7fd"
+  NUM_INFERENCE_STEPS = 25
+  # segmentation model input resolution, the mask is scaled back up afterwards
+  UPLOAD_MAX_SIDE = 1024
+
   def __init__(self):
     super().__init__()
-    self.model_name = "arielreplicate/dichotomous_image_segmentation"
-    self.model_version_id = "69bd4043d3ff604dcf5abeb27e10d959d520f323cf990a188f072c578348c7fd"
-    self.NUM_INFERENCE_STEPS = 25
-    # initialize replicate model obj
-    self.model = replicate.models.get(self.model_name)
-    # get latest version (can be found with model.versions.list())
-    self.version = self.model.versions.get(self.model_version_id)
+    self.upload_preparer = UploadPreparer(max_side=self.UPLOAD_MAX_SIDE)
   
 
   def get_filename_list(self):
@@ -27,13 +27,11 @@ class ReplicateMaskGen(ReplicateBase, BaseMaskGen):
     """
     filename_list = []
 
-    for filename in os.listdir(self.INPUT_PATH):
-      if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-        mask = os.path.join(self.MASK_PATH, filename)
-        image = os.path.join(self.INPUT_PATH, filename)
-        # check if both paths are valid files
-        if not os.path.isfile(mask) and os.path.isfile(image):
-          filename_list.append(filename)
+    for filename in self.storage.list_images(self.INPUT_PATH):
+      mask = f"{self.MASK_PATH}/{filename}"
+      # check no mask already exists
+      if not self.storage.exists(mask):
+        filename_list.append(filename)
     
     return filename_list
   
@@ -47,103 +45,106 @@ class ReplicateMaskGen(ReplicateBase, BaseMaskGen):
     predictions = defaultdict(def_value)
 
     for filename in filename_list:
-      if self.BATCH:
-        curr_image_path = f"{self.INPUT_PATH}/{filename}"
-      else:
-        curr_image_path = filename
-      with open(curr_image_path, "rb") as image:
+      with maybe_profile(self.profiler, f"replicate mask submit {filename}"):
+        if self.BATCH:
+          curr_image_path = f"{self.INPUT_PATH}/{filename}"
+        else:
+          curr_image_path = filename
         try:
-          prediction = replicate.predictions.create(
-            version=self.version,
-            input={
-              "input_image": image,
-              "num_inference_steps": self.NUM_INFERENCE_STEPS
-            }
-          )
-          predictions[filename] = prediction
-          self.logger.info(f"prediction triggered for {filename}")
+          image, _ = self.upload_preparer.prepare_image(self.storage.read(curr_image_path))
         except Exception as e:
           self.logger.exception(e)
-          self.logger.info(f"exception calling prediction for {filename}: {e}")
+          self.logger.info(f"exception preparing upload for {filename}: {e}")
+          continue
+        with image:
+          try:
+            prediction = self.create_prediction({
+              "input_image": image,
+              "num_inference_steps": self.NUM_INFERENCE_STEPS
+            })
+            predictions[filename] = prediction
+            self.logger.info(f"prediction triggered for {filename}")
+          except BudgetExceeded as e:
+            self.logger.warning(f"stopping batch before {filename}: {e}")
+            break
+          except Exception as e:
+            self.logger.exception(e)
+            self.logger.info(f"exception calling prediction for {filename}: {e}")
     
     return predictions
   
 
-  def remove_background(self, image_path, mask_path, no_bg_path):
-    # TODO: might want to switch to the .point method
-    # read in original image and mask
-    im = cv2.imread(image_path)
-    mask = cv2.imread(mask_path)
-    # subtract the images to keep what was masked out
-    diff = cv2.subtract(im, mask)
-    # make image background transparent instead of black
-    tmp = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
-    _,alpha = cv2.threshold(tmp,0,255,cv2.THRESH_BINARY)
-    b, g, r = cv2.split(diff)
-    rgba = [b,g,r, alpha]
-    dst = cv2.merge(rgba,4)
-    # write no background image to path
-    cv2.imwrite(no_bg_path, dst)
-
-
-  def write_output(self, filename_list, predictions):
+  def write_output(self, filename_list, predictions, groups=None):
+    """groups maps a filename to near duplicates that reuse its prediction"""
+    groups = groups or {}
     for filename in filename_list:
-      curr_prediction = predictions[filename]
-      # check prediciton in dict
-      if curr_prediction != DICT_DEFAULT_VAL:
-        if curr_prediction.status == "failed":
-          self.logger.error(f"Error with replicate: {curr_prediction.error}")
-        else:
-          try:
-            replicate_img = self.request_image(curr_prediction.output)
-            inverted_image = ImageOps.invert(replicate_img)
-            if self.BATCH:
-              # if we are running as batch, use filenames and treat paths as directories
-              image_path = f"{self.INPUT_PATH}/{filename}"
-              new_mask_path = f"{self.MASK_PATH}/{filename}"
-              no_bg_path = f"{self.NO_BG_PATH}/{filename}"
-            else:
-              # if we are running for single files, need to split the path and get filename
-              short_filename = filename.split("/")[-1]
-              # use filename as full path for initial image
-              image_path = filename
-              new_mask_path = f"{self.MASK_PATH}/{short_filename}"
-              no_bg_path = f"{self.NO_BG_PATH}/{short_filename}"
-            # write 
-            self.logger.info(f"writing image: {new_mask_path}")
-            inverted_image.save(new_mask_path)
-            self.remove_background(image_path=image_path, mask_path=new_mask_path, output_path=no_bg_path)
-          except Exception as e:
-            self.logger.info(f"exception getting output from prediction: {curr_prediction.id}. Prediction status: {curr_prediction.status}, Output: {curr_prediction.output}")
-            self.logger.exception(e)
+      with maybe_profile(self.profiler, f"replicate mask output {filename}"):
+        curr_prediction = predictions[filename]
+        # check prediciton in dict
+        if curr_prediction != DICT_DEFAULT_VAL:
+          if curr_prediction.status == "failed":
+            self.logger.error(f"Error with replicate: {curr_prediction.error}")
+          else:
+            try:
+              replicate_img = self.request_image(curr_prediction.output)
+              if self.BATCH:
+                # if we are running as batch, use filenames and treat paths as directories
+                image_path = f"{self.INPUT_PATH}/{filename}"
+                new_mask_path = f"{self.MASK_PATH}/{filename}"
+                no_bg_path = f"{self.NO_BG_PATH}/{filename}"
+              else:
+                # if we are running for single files, need to split the path and get filename
+                short_filename = filename.split("/")[-1]
+                # use filename as full path for initial image
+                image_path = filename
+                new_mask_path = f"{self.MASK_PATH}/{short_filename}"
+                no_bg_path = f"{self.NO_BG_PATH}/{short_filename}"
+              # the model ran on the downsized upload, scale the mask back to the original
+              original_image = self.storage.read_image(image_path)
+              if replicate_img.size != original_image.size:
+                replicate_img = replicate_img.resize(original_image.size, Image.LANCZOS)
+              # model output has the subject white, post processing inverts it into the inpainting mask
+              mask_image, no_bg_image = self.postprocess_mask(original_image, replicate_img)
+              writes = [(new_mask_path, mask_image), (no_bg_path, no_bg_image)]
+              # near duplicates get the segmentation aligned to their own image
+              for member in groups.get(filename, []):
+                member_image = self.storage.read_image(f"{self.INPUT_PATH}/{member}")
+                member_replicate_img = adapt_output(replicate_img, original_image, member_image)
+                if member_replicate_img is None:
+                  self.reject_duplicate(member, filename)
+                  continue
+                member_mask, member_no_bg = self.postprocess_mask(member_image, member_replicate_img)
+                writes.append((f"{self.MASK_PATH}/{member}", member_mask))
+                writes.append((f"{self.NO_BG_PATH}/{member}", member_no_bg))
+              # write 
+              self.logger.info(f"writing image: {new_mask_path}")
+              self.storage.write_images(writes)
+            except Exception as e:
+              self.logger.info(f"exception getting output from prediction: {curr_prediction.id}. Prediction status: {curr_prediction.status}, Output: {curr_prediction.output}")
+              self.logger.exception(e)
   
 
   def create_binary_mask_endpoint(self, input: bytes):
     self.logger.info("opening image...")
     input_image = Image.open(input)
-    prediction = replicate.predictions.create(
-      version=self.version,
-      input={
-        "input_image": input,
-        "num_inference_steps": self.NUM_INFERENCE_STEPS
-      }
-    )
-    self.logger.info("waiting for predictions to complete...")
-    start_time = perf_counter()
-    prediction.wait()
-    stop_time = perf_counter()
-    self.logger.info(f"waited for predictions for {stop_time - start_time} seconds...")
+    upload, _ = self.upload_preparer.prepare_image(input)
+    prediction = self.create_prediction({
+      "input_image": upload,
+      "num_inference_steps": self.NUM_INFERENCE_STEPS
+    })
+    self.wait_for_predictions([prediction])
     if prediction.status != 'succeeded':
       self.logger.error(f"Error from prediction pipeline: {prediction.error}")
     
     binary_mask_image = self.request_image(prediction.output)
-    blank = input_image.point(lambda _: 0)
-    segmented = Image.composite(input_image, blank, binary_mask_image.convert("1"))
-
-    return binary_mask_image, segmented
+    if binary_mask_image.size != input_image.size:
+      # the model ran on the downsized upload, scale the mask back to the original
+      binary_mask_image = binary_mask_image.resize(input_image.size, Image.LANCZOS)
+    # same post processing as the batch path, the mask comes back with the background white
+    return self.postprocess_mask(input_image, binary_mask_image)
 
 
-  def wait_for_pipeline(self, predictions, filename_list):
+  def wait_for_pipeline(self, predictions, filename_list, groups=None):
     # need predictions in list form for some operations
     prediction_list = [value for value in predictions.values()]
 
@@ -152,25 +153,31 @@ class ReplicateMaskGen(ReplicateBase, BaseMaskGen):
 
     self.logger.info("predictions complete, fetching results...")
 
-    self.write_output(filename_list=filename_list, predictions=predictions)
+    self.write_output(filename_list=filename_list, predictions=predictions, groups=groups)
     
     # get all mask images now for comparison
-    return [filename for filename in os.listdir(self.MASK_PATH) if filename.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    return self.storage.list_images(self.MASK_PATH)
 
   
   def run_batch(self, mask_images, target_images):
     while len(mask_images) < len(target_images):
+      # retrying never ends once the budget is spent, stop the run instead
+      self.usage.check_budget()
       # get all valid image filenames in list that need masks
       filename_list = self.get_filename_list()
         
       self.logger.info(f"found {len(filename_list)} valid image names needing masks...")
 
+      # only one prediction per group of near duplicates
+      groups = self.group_filenames(filename_list)
+      representatives = list(groups)
+
       # run replicate pipeline
       predictions = self.run_pipeline(
-        filename_list=filename_list,
+        filename_list=representatives,
       )
 
-      mask_images = self.wait_for_pipeline(predictions=predictions, filename_list=filename_list)
+      mask_images = self.wait_for_pipeline(predictions=predictions, filename_list=representatives, groups=groups)
 
       
   
@@ -178,6 +185,7 @@ class ReplicateMaskGen(ReplicateBase, BaseMaskGen):
     # just looking for one image in the mask directory
     filename = self.INPUT_PATH.split("/")[-1]
     while filename not in mask_images:
+      self.usage.check_budget()
       # run the replicate pipeline on the single image
       predictions = self.run_pipeline(
         filename_list=[self.INPUT_PATH],
@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+from threading import Lock
+
+"""
+Append only journal for batch runs. Every prediction submitted and every item
+written is recorded as a json line and flushed to disk straight away, so a run
+that is killed part way can be resumed without paying for predictions twice
+"""
+
+SUBMITTED = "submitted"
+COMPLETED = "completed"
+FAILED = "failed"
+
+
+class RunJournal:
+  def __init__(self, path: str):
+    logging.basicConfig()
+    self.logger = logging.getLogger(__name__)
+    self.logger.setLevel(logging.INFO)
+    self.path = path
+    # item key -> latest entry for that item
+    self.entries = {}
+    self._lock = Lock()
+    self.load()
+
+
+  def load(self):
+    """replay the journal, later lines win over earlier ones for the same item"""
+    if not os.path.isfile(self.path):
+      return
+    with open(self.path) as f:
+      for line in f:
+        line = line.strip()
+        if not line:
+          continue
+        try:
+          entry = json.loads(line)
+        except json.JSONDecodeError:
+          # a line cut off by a crash, everything before it is still valid
+          self.logger.warning(f"skipping truncated journal line in {self.path}")
+          continue
+        self.entries[entry["key"]] = {**self.entries.get(entry["key"], {}), **entry}
+    completed = sum(1 for entry in self.entries.values() if entry["status"] == COMPLETED)
+    self.logger.info(f"loaded journal {self.path}: {len(self.entries)} item(s), {completed} completed")
+
+
+  def _append(self, entry):
+    with self._lock:
+      self.entries[entry["key"]] = {**self.entries.get(entry["key"], {}), **entry}
+      directory = os.path.dirname(self.path)
+      if directory:
+        os.makedirs(directory, exist_ok=True)
+      with open(self.path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+  def record_submitted(self, key: str, filename: str, prediction_id: str):
+    self._append({"key": key, "filename": filename, "status": SUBMITTED, "prediction_id": prediction_id})
+
+
+  def record_completed(self, key: str, filename: str, outputs, output_keys):
+    """outputs are the written locations, output_keys the storage keys to check them by"""
+    self._append({
+      "key": key,
+      "filename": filename,
+      "status": COMPLETED,
+      "outputs": list(outputs),
+      "output_keys": list(output_keys),
+    })
+
+
+  def record_failed(self, key: str, filename: str, error: str = None):
+    self._append({"key": key, "filename": filename, "status": FAILED, "error": error})
+
+
+  def completed_output_keys(self, key: str):
+    """storage keys of a completed item's outputs, None if it isn't completed or predates them"""
+    entry = self.entries.get(key)
+    if entry is None or entry["status"] != COMPLETED:
+      return None
+    return entry.get("output_keys")
+
+
+  def prediction_id(self, key: str):
+    """id of a prediction submitted for the item and not yet written, None otherwise"""
+    entry = self.entries.get(key)
+    if entry is not None and entry["status"] == SUBMITTED:
+      return entry.get("prediction_id")
+    return None
@@ -0,0 +1,95 @@
+import logging
+
+from PIL import Image
+
+from components.lazy_import import lazy_module
+from components.model_registry import DEFAULT_REMBG_MODEL, get_rembg_session
+
+np = lazy_module("numpy")
+
+"""
+Run the rembg u2net model on several images with one onnx call. Images are
+letterboxed to the model input size, normalized and stacked into a single
+batch, and the predicted masks are cropped back out and scaled to each image
+"""
+
+
+class SegmentationEngine:
+  INPUT_SIZE = 320
+  # normalization the u2net weights were trained with
+  MEAN = (0.485, 0.456, 0.406)
+  STD = (0.229, 0.224, 0.225)
+  MAX_BATCH_SIZE = 8
+
+  def __init__(self, model_name: str = DEFAULT_REMBG_MODEL, max_batch_size: int = None):
+    logging.basicConfig()
+    self.logger = logging.getLogger(__name__)
+    self.logger.setLevel(logging.INFO)
+    self.session = get_rembg_session(model_name).inner_session
+    self.input_name = self.session.get_inputs()[0].name
+    self.max_batch_size = max_batch_size or self.MAX_BATCH_SIZE
+    # some exports have a fixed batch dimension, never send more than it allows
+    batch_dim = self.session.get_inputs()[0].shape[0]
+    if isinstance(batch_dim, int) and batch_dim > 0 and batch_dim < self.max_batch_size:
+      self.max_batch_size = batch_dim
+      self.logger.warning(
+        f"{model_name} has a fixed batch of {batch_dim}, segmentation runs {batch_dim} image(s) per onnx call. "
+        "install onnx so the registry can load it with a dynamic batch"
+      )
+
+
+  def letterbox(self, image):
+    """
+    scale the image to fit the model input keeping its aspect ratio and pad the
+    rest with black, returns the padded array and the box the image occupies
+    """
+    width, height = image.size
+    scale = self.INPUT_SIZE / max(width, height)
+    new_width = max(1, round(width * scale))
+    new_height = max(1, round(height * scale))
+    left = (self.INPUT_SIZE - new_width) // 2
+    top = (self.INPUT_SIZE - new_height) // 2
+    resized = image.convert("RGB").resize((new_width, new_height), Image.LANCZOS)
+    canvas = np.zeros((self.INPUT_SIZE, self.INPUT_SIZE, 3), dtype=np.uint8)
+    canvas[top:top + new_height, left:left + new_width] = np.asarray(resized)
+    return canvas, (left, top, new_width, new_height)
+
+
+  def _normalize(self, batch):
+    # same per image scaling as rembg: divide by the brightest value, then mean/std
+    batch = batch.astype(np.float32)
+    maxes = batch.reshape(len(batch), -1).max(axis=1)
+    batch /= np.maximum(maxes, 1)[:, None, None, None]
+    batch -= np.array(self.MEAN, dtype=np.float32)
+    batch /= np.array(self.STD, dtype=np.float32)
+    # NHWC -> NCHW
+    return np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+
+
+  def _predict_chunk(self, images):
+    letterboxed = [self.letterbox(image) for image in images]
+    batch = self._normalize(np.stack([canvas for canvas, _ in letterboxed]))
+    predictions = self.session.run(None, {self.input_name: batch})[0][:, 0, :, :]
+
+    # scale every prediction to 0..1 on its own
+    flat = predictions.reshape(len(images), -1)
+    minimums = flat.min(axis=1)[:, None, None]
+    maximums = flat.max(axis=1)[:, None, None]
+    predictions = (predictions - minimums) / np.maximum(maximums - minimums, 1e-8)
+    predictions = (predictions * 255).astype(np.uint8)
+
+    masks = []
+    for image, prediction, (_, (left, top, new_width, new_height)) in zip(images, predictions, letterboxed):
+      cropped = prediction[top:top + new_height, left:left + new_width]
+      masks.append(Image.fromarray(cropped, mode="L").resize(image.size, Image.LANCZOS))
+    return masks
+
+
+  def predict_masks(self, images):
+    """soft foreground masks ("L" images, subject white) at each image's own size"""
+    masks = []
+    for start in range(0, len(images), self.max_batch_size):
+      chunk = images[start:start + self.max_batch_size]
+      self.logger.info(f"segmenting batch of {len(chunk)} image(s)")
+      masks.extend(self._predict_chunk(chunk))
+    return masks
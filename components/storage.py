@@ -0,0 +1,257 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import logging
+import os
+from threading import Lock
+
+from PIL import Image
+
+from components.lazy_import import lazy_module
+from components.profiling import propagate_context
+
+gcs = lazy_module("google.cloud.storage")
+
+"""
+Where the pipeline and api read and write images. Keys are `/` separated paths
+such as `mask-images/image (60).png`, each backend maps them onto its own store
+"""
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# pillow format names for the extensions we write
+EXTENSION_FORMATS = {
+  ".png": "PNG",
+  ".jpg": "JPEG",
+  ".jpeg": "JPEG",
+  ".webp": "WEBP",
+}
+
+
+# encode an image to bytes using the format implied by the key's extension
+def encode_image(image, key, image_format=None):
+  extension = os.path.splitext(key)[1].lower()
+  image_format = image_format or EXTENSION_FORMATS.get(extension) or image.format or "PNG"
+  output = BytesIO()
+  try:
+    image.save(output, format=image_format)
+  except Exception as e:
+    # depending on filetype this might break (e.g. alpha in a jpeg), convert and try again
+    logger.info(f"exception encoding {key} as {image_format}: {e}, converting to RGB")
+    output = BytesIO()
+    image.convert("RGB").save(output, format=image_format)
+  return output.getvalue()
+
+
+class BaseStorage:
+  # writes in write_many run on a thread pool, io bound so more threads than cores is fine
+  MAX_WORKERS = 8
+
+  def write(self, key: str, data: bytes) -> str:
+    """write bytes to key, returns the location of the written object"""
+    raise NotImplementedError
+
+  def read(self, key: str) -> bytes:
+    raise NotImplementedError
+
+  def exists(self, key: str) -> bool:
+    raise NotImplementedError
+
+  def list(self, prefix: str):
+    """names of the objects directly under prefix, like os.listdir"""
+    raise NotImplementedError
+
+
+  def list_images(self, prefix: str):
+    return [name for name in self.list(prefix) if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+  def read_image(self, key: str):
+    return Image.open(BytesIO(self.read(key)))
+
+
+  def write_image(self, key: str, image, image_format=None) -> str:
+    return self.write(key, encode_image(image, key, image_format))
+
+
+  def _write_concurrently(self, write, items):
+    items = list(items)
+    if not items:
+      return []
+
+    def write_item(item):
+      key, value = item
+      try:
+        return write(key, value)
+      except Exception as e:
+        logger.exception(e)
+        logger.info(f"exception writing {key}")
+        return None
+
+    with ThreadPoolExecutor(max_workers=min(self.MAX_WORKERS, len(items))) as executor:
+      return list(executor.map(propagate_context(write_item), items))
+
+
+  def write_many(self, items):
+    """
+    write a list of (key, bytes) concurrently, returns the locations in the same
+    order with None for writes that failed
+    """
+    return self._write_concurrently(self.write, items)
+
+
+  def write_images(self, items):
+    """encode and write a list of (key, image) concurrently, encoding happens on the pool too"""
+    return self._write_concurrently(self.write_image, items)
+
+
+class LocalStorage(BaseStorage):
+  def __init__(self, root: str = "."):
+    self.root = root
+
+
+  def path(self, key: str):
+    return os.path.join(self.root, key)
+
+
+  def write(self, key, data):
+    path = self.path(key)
+    directory = os.path.dirname(path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    with open(path, "wb") as f:
+      f.write(data)
+    return path
+
+
+  def read(self, key):
+    with open(self.path(key), "rb") as f:
+      return f.read()
+
+
+  def exists(self, key):
+    return os.path.isfile(self.path(key))
+
+
+  def list(self, prefix):
+    path = self.path(prefix)
+    if not os.path.isdir(path):
+      return []
+    return [name for name in os.listdir(path) if os.path.isfile(os.path.join(path, name))]
+
+
+class MemoryStorage(BaseStorage):
+  """
+  keeps objects in a dict, useful for benchmarks. reads that miss fall through to
+  `fallback` so inputs can come from disk while outputs stay in memory
+  """
+
+  def __init__(self, fallback: BaseStorage = None):
+    self.fallback = fallback
+    self.objects = {}
+    self._lock = Lock()
+
+
+  def write(self, key, data):
+    with self._lock:
+      self.objects[key] = bytes(data)
+    return f"memory://{key}"
+
+
+  def read(self, key):
+    with self._lock:
+      if key in self.objects:
+        return self.objects[key]
+    if self.fallback is not None:
+      return self.fallback.read(key)
+    raise FileNotFoundError(key)
+
+
+  def exists(self, key):
+    with self._lock:
+      if key in self.objects:
+        return True
+    return self.fallback is not None and self.fallback.exists(key)
+
+
+  def list(self, prefix):
+    directory = prefix.rstrip("/") + "/"
+    with self._lock:
+      names = {
+        key[len(directory):] for key in self.objects
+        if key.startswith(directory) and "/" not in key[len(directory):]
+      }
+    if self.fallback is not None:
+      names.update(self.fallback.list(prefix))
+    return sorted(names)
+
+
+class GCSStorage(BaseStorage):
+  # gcs uploads are slow to start, use more threads for batched writes
+  MAX_WORKERS = 16
+
+  def __init__(self, bucket_name: str, project: str = None):
+    self.bucket_name = bucket_name
+    self.project = project
+    # the client is thread safe and expensive to build, create it once per storage
+    self._bucket = None
+    self._client = None
+    self._lock = Lock()
+
+
+  @property
+  def bucket(self):
+    with self._lock:
+      if self._bucket is None:
+        self._client = gcs.Client(project=self.project)
+        self._bucket = self._client.bucket(self.bucket_name)
+      return self._bucket
+
+
+  def write(self, key, data):
+    blob = self.bucket.blob(key)
+    blob.upload_from_string(data)
+    return blob.public_url
+
+
+  def read(self, key):
+    return self.bucket.blob(key).download_as_bytes()
+
+
+  def exists(self, key):
+    return self.bucket.blob(key).exists()
+
+
+  def list(self, prefix):
+    directory = prefix.rstrip("/") + "/"
+    bucket = self.bucket
+    # the delimiter keeps the listing to objects directly under the prefix
+    blobs = self._client.list_blobs(bucket, prefix=directory, delimiter="/")
+    return [blob.name[len(directory):] for blob in blobs if blob.name != directory]
+
+
+_storages = {}
+_storages_lock = Lock()
+
+
+def get_storage(backend: str = "local", root: str = ".", bucket_name: str = None, project: str = None):
+  """
+  return the shared storage for a backend (`local`, `memory` or `gcs`). memory
+  storage reads through to local storage at `root`
+  """
+  key = (backend, root, bucket_name, project)
+  with _storages_lock:
+    if key not in _storages:
+      if backend == "local":
+        _storages[key] = LocalStorage(root)
+      elif backend == "memory":
+        _storages[key] = MemoryStorage(fallback=LocalStorage(root))
+      elif backend == "gcs":
+        if not bucket_name:
+          raise ValueError("gcs storage needs a bucket name")
+        _storages[key] = GCSStorage(bucket_name, project)
+      else:
+        raise ValueError(f"unknown storage backend: {backend}")
+    return _storages[key]
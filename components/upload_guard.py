@@ -0,0 +1,164 @@
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+import os
+
+from PIL import Image
+
+"""
+Bound how much memory uploads can pin on a worker. Requests whose declared
+length is over the limit are refused before their body is read. Uploads are
+left in the spooled temp files the multipart parser already wrote them to,
+checked against per-request limits and then admitted against a global
+in-flight budget
+"""
+
+# per file and per request limits on the encoded upload size
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 25 * 1024 * 1024))
+MAX_REQUEST_BYTES = int(os.environ.get("MAX_REQUEST_BYTES", 50 * 1024 * 1024))
+# room for the multipart boundaries, part headers and form fields around the files
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+# largest image we are willing to decode, checked from the header before decoding
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 40_000_000))
+# budget for the decoded size of every image currently being processed by this worker
+MAX_INFLIGHT_BYTES = int(os.environ.get("MAX_INFLIGHT_BYTES", 1024 * 1024 * 1024))
+# how long a request waits for budget before it is turned away
+BUDGET_WAIT_SECONDS = float(os.environ.get("UPLOAD_BUDGET_WAIT_SECONDS", 30))
+
+# magic bytes for the image types the pipeline accepts
+IMAGE_SIGNATURES = {
+  b"\x89PNG\r\n\x1a\n": "PNG",
+  b"\xff\xd8\xff": "JPEG",
+}
+# decoded images are held as RGBA at most
+BYTES_PER_PIXEL = 4
+
+
+class UploadRejected(Exception):
+  def __init__(self, status_code: int, detail: str):
+    super().__init__(detail)
+    self.status_code = status_code
+    self.detail = detail
+
+
+# return the image type from the first bytes of a file or None if it is not an image we accept
+def sniff_image_type(header: bytes):
+  for signature, image_type in IMAGE_SIGNATURES.items():
+    if header.startswith(signature):
+      return image_type
+  if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+    return "WEBP"
+  return None
+
+
+class UploadGuard:
+  def __init__(
+    self,
+    max_upload_bytes: int = MAX_UPLOAD_BYTES,
+    max_request_bytes: int = MAX_REQUEST_BYTES,
+    max_image_pixels: int = MAX_IMAGE_PIXELS,
+    max_inflight_bytes: int = MAX_INFLIGHT_BYTES,
+    budget_wait_seconds: float = BUDGET_WAIT_SECONDS,
+  ):
+    logging.basicConfig()
+    self.logger = logging.getLogger(__name__)
+    self.logger.setLevel(logging.INFO)
+    self.max_upload_bytes = max_upload_bytes
+    self.max_request_bytes = max_request_bytes
+    self.max_image_pixels = max_image_pixels
+    self.max_inflight_bytes = max_inflight_bytes
+    self.budget_wait_seconds = budget_wait_seconds
+    self.inflight_bytes = 0
+    # created lazily so the guard can be built before the event loop exists
+    self._condition = None
+
+
+  def check_content_length(self, headers):
+    """
+    refuse a request whose `Content-Length` can't fit the request limit, before
+    its body is parsed and spooled. requests without one are checked after parsing
+    """
+    content_length = headers.get("content-length")
+    if not content_length or not content_length.isdigit():
+      return
+    if int(content_length) > self.max_request_bytes + MULTIPART_OVERHEAD_BYTES:
+      raise UploadRejected(413, f"request body is {content_length} bytes, limit is {self.max_request_bytes}")
+
+
+  def check_upload(self, upload):
+    """
+    validate one upload without reading it into memory, returns the spooled
+    file object and the estimated decoded size in bytes
+    """
+    fileobj = upload.file
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    if size == 0:
+      raise UploadRejected(400, f"{upload.filename} is empty")
+    if size > self.max_upload_bytes:
+      raise UploadRejected(413, f"{upload.filename} is {size} bytes, limit is {self.max_upload_bytes}")
+
+    image_type = sniff_image_type(fileobj.read(16))
+    fileobj.seek(0)
+    if image_type is None:
+      raise UploadRejected(415, f"{upload.filename} is not a png, jpeg or webp image")
+
+    # only parses the header, pixel data is decoded later by the component
+    try:
+      width, height = Image.open(fileobj).size
+    except Exception as e:
+      raise UploadRejected(400, f"{upload.filename} could not be read as an image: {e}")
+    finally:
+      fileobj.seek(0)
+    if width * height > self.max_image_pixels:
+      raise UploadRejected(413, f"{upload.filename} is {width}x{height}, limit is {self.max_image_pixels} pixels")
+
+    return fileobj, size, width * height * BYTES_PER_PIXEL
+
+
+  async def _reserve(self, amount):
+    if amount > self.max_inflight_bytes:
+      raise UploadRejected(413, f"request needs {amount} bytes of image memory, limit is {self.max_inflight_bytes}")
+    if self._condition is None:
+      self._condition = asyncio.Condition()
+    async with self._condition:
+      try:
+        await asyncio.wait_for(
+          self._condition.wait_for(lambda: self.inflight_bytes + amount <= self.max_inflight_bytes),
+          timeout=self.budget_wait_seconds
+        )
+      except asyncio.TimeoutError:
+        raise UploadRejected(503, "server is busy processing other uploads, retry later")
+      self.inflight_bytes += amount
+
+
+  async def _release(self, amount):
+    async with self._condition:
+      self.inflight_bytes -= amount
+      self._condition.notify_all()
+
+
+  @asynccontextmanager
+  async def admit(self, *uploads):
+    """
+    check every upload of a request and hold budget for their decoded size
+    while the request is processed, yields the spooled file objects
+    """
+    files = []
+    request_bytes = 0
+    decoded_bytes = 0
+    for upload in uploads:
+      fileobj, size, decoded = self.check_upload(upload)
+      files.append(fileobj)
+      request_bytes += size
+      decoded_bytes += decoded
+    if request_bytes > self.max_request_bytes:
+      raise UploadRejected(413, f"request uploads total {request_bytes} bytes, limit is {self.max_request_bytes}")
+
+    await self._reserve(decoded_bytes)
+    self.logger.info(f"admitted {len(files)} upload(s), {self.inflight_bytes} of {self.max_inflight_bytes} bytes in flight")
+    try:
+      yield files
+    finally:
+      await self._release(decoded_bytes)
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+import hashlib
+from io import BytesIO
+import logging
+from threading import Lock
+
+from PIL import Image
+
+"""
+Shrink and re-encode images before they are sent to replicate. Uploads are sent
+as base64 data uris so every byte we drop here is time saved on prediction creation
+"""
+
+# prepared uploads are shared across component instances (the api creates a new
+# component per request) so the cache lives at module level
+_PREPARED_CACHE = OrderedDict()
+_PREPARED_CACHE_LOCK = Lock()
+MAX_CACHE_ENTRIES = 64
+
+
+# normalise bytes, paths and file objects into bytes
+def read_source(source):
+  if isinstance(source, (bytes, bytearray)):
+    return bytes(source)
+  if isinstance(source, str):
+    with open(source, "rb") as f:
+      return f.read()
+  # file like object, rewind so callers can pass the same object more than once
+  if hasattr(source, "seek"):
+    source.seek(0)
+  return source.read()
+
+
+# wrap raw bytes in a file object, or rewind a file object that is already open
+def as_file(source):
+  if isinstance(source, (bytes, bytearray)):
+    return BytesIO(source)
+  if hasattr(source, "seek"):
+    source.seek(0)
+  return source
+
+
+def open_image(source, target_size=None):
+  """
+  open an image lazily. when a target size is given, let the decoder skip work
+  with draft (jpeg) and reduce large images by an integer factor before they
+  are resized so we never hold more full resolution pixels than needed
+  """
+  image = Image.open(as_file(source))
+  if not target_size:
+    return image
+  width, height = target_size
+  image.draft(image.mode if image.mode in ("RGB", "L") else "RGB", (width, height))
+  factor = min(image.size[0] // max(width, 1), image.size[1] // max(height, 1))
+  if factor >= 2:
+    image = image.reduce(factor)
+  return image
+
+
+class UploadPreparer:
+  # image formats replicate models can decode, webp is smaller but slower to encode
+  IMAGE_FORMAT = "JPEG"
+  IMAGE_QUALITY = 90
+
+  def __init__(self, max_side: int = 512, image_format: str = None, quality: int = None):
+    logging.basicConfig()
+    self.logger = logging.getLogger(__name__)
+    self.logger.setLevel(logging.INFO)
+    # longest side the model actually works at, anything larger is downsized
+    self.max_side = max_side
+    self.image_format = (image_format or self.IMAGE_FORMAT).upper()
+    self.quality = quality or self.IMAGE_QUALITY
+
+
+  def target_size(self, size):
+    """scale (width, height) so the longest side is at most max_side"""
+    width, height = size
+    longest = max(width, height)
+    if not self.max_side or longest <= self.max_side:
+      return size
+    scale = self.max_side / longest
+    return (max(1, round(width * scale)), max(1, round(height * scale)))
+
+
+  def _cached(self, key, build):
+    with _PREPARED_CACHE_LOCK:
+      if key in _PREPARED_CACHE:
+        _PREPARED_CACHE.move_to_end(key)
+        self.logger.info(f"reusing prepared upload {key[:12]}")
+        return _PREPARED_CACHE[key]
+    value = build()
+    with _PREPARED_CACHE_LOCK:
+      _PREPARED_CACHE[key] = value
+      while len(_PREPARED_CACHE) > MAX_CACHE_ENTRIES:
+        _PREPARED_CACHE.popitem(last=False)
+    return value
+
+
+  def _to_file(self, data, name):
+    # replicate guesses the mime type of the data uri from the file name
+    upload = BytesIO(data)
+    upload.name = name
+    return upload
+
+
+  def _key(self, kind, data, *params):
+    digest = hashlib.sha256(data).hexdigest()
+    return f"{digest}:{kind}:{':'.join(str(param) for param in params)}"
+
+
+  def _prepare_image_bytes(self, data):
+    size = self.target_size(Image.open(BytesIO(data)).size)
+    image = open_image(data, target_size=size).convert("RGB")
+    if image.size != size:
+      image = image.resize(size, Image.LANCZOS)
+    output = BytesIO()
+    save_kwargs = {"quality": self.quality}
+    if self.image_format == "JPEG":
+      save_kwargs["optimize"] = True
+    image.save(output, format=self.image_format, **save_kwargs)
+    self.logger.info(f"prepared image upload: {len(data)} -> {output.tell()} bytes at {size}")
+    return output.getvalue(), size
+
+
+  def _prepare_mask_bytes(self, data, size):
+    mask = Image.open(BytesIO(data)).convert("L")
+    if size is None:
+      size = self.target_size(mask.size)
+    if mask.size != tuple(size):
+      # nearest keeps the mask hard edged, it is thresholded right after
+      mask = mask.resize(size, Image.NEAREST)
+    mask = mask.point(lambda value: 255 if value >= 128 else 0).convert("1")
+    output = BytesIO()
+    mask.save(output, format="PNG", optimize=True)
+    self.logger.info(f"prepared mask upload: {len(data)} -> {output.tell()} bytes at {size}")
+    return output.getvalue()
+
+
+  def prepare_image(self, source):
+    """return a compact file object of the image and the size it was encoded at"""
+    data = read_source(source)
+    key = self._key("image", data, self.max_side, self.image_format, self.quality)
+    prepared, size = self._cached(key, lambda: self._prepare_image_bytes(data))
+    extension = "jpg" if self.image_format == "JPEG" else self.image_format.lower()
+    return self._to_file(prepared, f"image.{extension}"), size
+
+
+  def prepare_mask(self, source, size=None):
+    """
+    return a 1-bit png file object of the mask, resized to `size` so it lines
+    up with the prepared image
+    """
+    data = read_source(source)
+    key = self._key("mask", data, self.max_side, size)
+    prepared = self._cached(key, lambda: self._prepare_mask_bytes(data, size))
+    return self._to_file(prepared, "mask.png")
+
+
+  def prepare_pair(self, image_source, mask_source):
+    """prepare an image and its mask so both are encoded at the same size"""
+    image, size = self.prepare_image(image_source)
+    mask = self.prepare_mask(mask_source, size=size)
+    return image, mask
@@ -0,0 +1,215 @@
+from datetime import datetime
+import logging
+import os
+from threading import Lock
+import time
+
+"""
+Account for replicate usage: predictions, inference steps, outputs and the
+seconds each prediction spent queued and running on the gpu, aggregated per
+endpoint, per prompt and per batch. Optional budgets stop new predictions
+from being created once the spend so far reaches them
+"""
+
+# budgets for the process wide ledger, unset means unlimited
+MAX_PREDICTIONS = os.environ.get("REPLICATE_MAX_PREDICTIONS")
+MAX_PREDICT_SECONDS = os.environ.get("REPLICATE_MAX_PREDICT_SECONDS")
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# label -> key of its breakdown in reports
+LABELS = {"endpoint": "endpoints", "prompt": "prompts", "batch": "batches"}
+FINISHED = ("succeeded", "failed", "canceled")
+
+
+class BudgetExceeded(Exception):
+  pass
+
+
+def _parse_time(value):
+  """replicate timestamps are iso strings ending in Z, None when missing or unparseable"""
+  if not value:
+    return None
+  if isinstance(value, datetime):
+    return value
+  value = value.replace("Z", "+00:00")
+  try:
+    return datetime.fromisoformat(value)
+  except ValueError:
+    pass
+  # older pythons only accept 3 or 6 fractional digits
+  head, dot, rest = value.partition(".")
+  if not dot:
+    return None
+  digits = "".join(c for c in rest if c.isdigit())
+  try:
+    return datetime.fromisoformat(f"{head}.{digits[:6].ljust(6, '0')}{rest[len(digits):]}")
+  except ValueError:
+    return None
+
+
+def _seconds_between(start, end):
+  start, end = _parse_time(start), _parse_time(end)
+  if start is None or end is None:
+    return None
+  return max(0.0, (end - start).total_seconds())
+
+
+def _field(source, name):
+  return source.get(name) if isinstance(source, dict) else getattr(source, name, None)
+
+
+def has_timings(prediction):
+  """
+  whether a prediction object carries its metrics and timestamps. replicate 0.4.0's
+  Prediction model drops them, they have to be read from the api json instead
+  """
+  return _field(prediction, "metrics") is not None or _field(prediction, "completed_at") is not None
+
+
+def prediction_timings(prediction):
+  """
+  (queue seconds, predict seconds) of a finished prediction, given as a prediction
+  object or the api's prediction json. either can be None
+  """
+  queue_seconds = _seconds_between(_field(prediction, "created_at"), _field(prediction, "started_at"))
+  metrics = _field(prediction, "metrics") or {}
+  predict_seconds = metrics.get("predict_time")
+  if predict_seconds is None:
+    predict_seconds = _seconds_between(_field(prediction, "started_at"), _field(prediction, "completed_at"))
+  return queue_seconds, predict_seconds
+
+
+def _empty_totals():
+  return {
+    "predictions": 0,
+    "succeeded": 0,
+    "failed": 0,
+    "inference_steps": 0,
+    "outputs": 0,
+    "queue_seconds": 0.0,
+    "predict_seconds": 0.0,
+    # succeeded predictions whose gpu time couldn't be read, charged the wall time
+    # they were tracked for instead (an overestimate, it includes time queued)
+    "estimated": 0,
+  }
+
+
+class UsageLedger:
+  def __init__(self, max_predictions: int = None, max_predict_seconds: float = None):
+    self.max_predictions = max_predictions
+    self.max_predict_seconds = max_predict_seconds
+    self.totals = _empty_totals()
+    # label name -> label value -> totals
+    self.breakdowns = {label: {} for label in LABELS}
+    # prediction id -> (labels, steps, outputs, time tracked) until the prediction finishes
+    self.pending = {}
+    self._lock = Lock()
+
+
+  def set_budget(self, max_predictions: int = None, max_predict_seconds: float = None):
+    """change the budgets that are passed, the others are kept"""
+    if max_predictions is not None:
+      self.max_predictions = max_predictions
+    if max_predict_seconds is not None:
+      self.max_predict_seconds = max_predict_seconds
+
+
+  def check_budget(self):
+    """raise BudgetExceeded if another prediction would go over budget"""
+    with self._lock:
+      if self.max_predictions is not None and self.totals["predictions"] >= self.max_predictions:
+        raise BudgetExceeded(f"prediction budget of {self.max_predictions} used up")
+      if self.max_predict_seconds is not None and self.totals["predict_seconds"] >= self.max_predict_seconds:
+        raise BudgetExceeded(f"budget of {self.max_predict_seconds} predict seconds used up")
+
+
+  def _add(self, labels, **values):
+    buckets = [self.totals] + [
+      self.breakdowns[label].setdefault(labels[label], _empty_totals())
+      for label in LABELS if labels.get(label) is not None
+    ]
+    for bucket in buckets:
+      for name, value in values.items():
+        bucket[name] += value
+
+
+  def track(self, prediction, labels, inference_steps: int = 0, outputs: int = 1):
+    """count a created (or reattached) prediction, its timings are added once it finishes"""
+    with self._lock:
+      if prediction.id in self.pending:
+        return
+      self.pending[prediction.id] = (labels, inference_steps, outputs, time.monotonic())
+      self._add(labels, predictions=1)
+
+
+  def needs_timings(self, prediction):
+    """whether the prediction is tracked, finished, and its object lacks the timings to record it"""
+    with self._lock:
+      pending = prediction.id in self.pending
+    return pending and prediction.status in FINISHED and not has_timings(prediction)
+
+
+  def record_finished(self, prediction, details=None):
+    """
+    add the timings of a tracked prediction, safe to call more than once. details is
+    the api's json for the prediction, read instead of the object when given
+    """
+    with self._lock:
+      if prediction.id not in self.pending:
+        return
+      if prediction.status not in FINISHED:
+        return
+      labels, inference_steps, outputs, tracked_at = self.pending.pop(prediction.id)
+      queue_seconds, predict_seconds = prediction_timings(details if details is not None else prediction)
+      succeeded = prediction.status == "succeeded"
+      estimated = succeeded and predict_seconds is None
+      if estimated:
+        # keeps the budget enforceable without the real gpu time
+        predict_seconds = time.monotonic() - tracked_at
+        logger.warning(f"prediction {prediction.id} finished without timings, charging the {predict_seconds:.1f} seconds it was tracked for")
+      self._add(
+        labels,
+        succeeded=int(succeeded),
+        failed=int(not succeeded),
+        # steps and outputs only count when the work was done
+        inference_steps=inference_steps if succeeded else 0,
+        outputs=outputs if succeeded else 0,
+        queue_seconds=queue_seconds or 0.0,
+        predict_seconds=predict_seconds or 0.0,
+        estimated=int(estimated),
+      )
+
+
+  def to_dict(self):
+    with self._lock:
+      return {
+        "totals": dict(self.totals),
+        "in_flight": len(self.pending),
+        "budget": {
+          "max_predictions": self.max_predictions,
+          "max_predict_seconds": self.max_predict_seconds,
+        },
+        **{
+          LABELS[label]: {value: dict(totals) for value, totals in breakdown.items()}
+          for label, breakdown in self.breakdowns.items()
+        },
+      }
+
+
+_ledger = None
+_ledger_lock = Lock()
+
+
+def get_usage_ledger():
+  """the ledger shared by every component in the process, budgets come from the environment"""
+  global _ledger
+  with _ledger_lock:
+    if _ledger is None:
+      _ledger = UsageLedger(
+        max_predictions=int(MAX_PREDICTIONS) if MAX_PREDICTIONS else None,
+        max_predict_seconds=float(MAX_PREDICT_SECONDS) if MAX_PREDICT_SECONDS else None,
+      )
+    return _ledger
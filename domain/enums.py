@@ -2,4 +2,16 @@ from enum import Enum
 
 class MaskGen(Enum):
   LOCAL = "local"
-  REPLICATE = "replicate"
\ No newline at end of file
+  REPLICATE = "replicate"
+
+
+class Anchor(Enum):
+  TOP_LEFT = "top-left"
+  TOP_CENTER = "top-center"
+  TOP_RIGHT = "top-right"
+  CENTER_LEFT = "center-left"
+  CENTER = "center"
+  CENTER_RIGHT = "center-right"
+  BOTTOM_LEFT = "bottom-left"
+  BOTTOM_CENTER = "bottom-center"
+  BOTTOM_RIGHT = "bottom-right"
\ No newline at end of file
@@ -1,6 +1,8 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List
 
+from domain.enums import Anchor
+
 
 class OverlayRequestGenerate(BaseModel):
     """schema to be used for generating background images
@@ -16,3 +18,13 @@ class ImageListResponse(BaseModel):
     """
     output: List[str]
 
+
+class OverlayPlacement(BaseModel):
+    """schema for one variant of a batch overlay: which scene the
+    foreground goes on and where
+    """
+    scene: int = Field(0, ge=0)
+    x: int = 0
+    y: int = 0
+    scale: float = Field(1.0, gt=0)
+    anchor: Anchor = Anchor.TOP_LEFT
@@ -0,0 +1,644 @@
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+import heapq
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+from threading import Lock, Thread
+import time
+import types
+
+from PIL import Image, ImageDraw
+
+"""
+Load test the api with a weighted mix of endpoints and image sizes and report
+throughput, latency percentiles and error rates for each concurrency level as
+json. By default the app runs in a subprocess with replicate replaced by a stub
+with a configurable latency distribution and outputs kept in memory behind a
+configurable write latency, local segmentation runs for real. Pass --target to
+load an already running server instead (nothing is stubbed then)
+"""
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_MIX = "create-binary-mask:local=4,overlay-image=4,overlay-batch=1,infill-background=1,generate-background=1,health=1"
+ENDPOINTS = (
+  "create-binary-mask:local",
+  "create-binary-mask:replicate",
+  "infill-background",
+  "generate-background",
+  "overlay-image",
+  "overlay-batch",
+  "health",
+)
+# scenes sent with each /overlay-batch request, the fixture image is each scene
+OVERLAY_BATCH_SCENES = 4
+FIXTURE_DIRS = ("background-images", "scenes")
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+# a concurrency level counts as saturated when it adds less than this much throughput
+SATURATION_GAIN = 0.05
+
+
+class LatencyDistribution:
+  """
+  seconds to sleep, parsed from `fixed:S`, `uniform:LOW,HIGH` or
+  `lognormal:MEDIAN,SIGMA`
+  """
+
+  def __init__(self, spec: str, seed: int = None):
+    self.spec = spec
+    kind, _, params = spec.partition(":")
+    self.kind = kind
+    self.params = [float(param) for param in params.split(",") if param]
+    expected = {"fixed": 1, "uniform": 2, "lognormal": 2}
+    if expected.get(kind) != len(self.params):
+      raise ValueError(f"bad latency spec {spec!r}, use fixed:S, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA")
+    self.rng = random.Random(seed)
+
+
+  def sample(self):
+    if self.kind == "fixed":
+      return self.params[0]
+    if self.kind == "uniform":
+      return self.rng.uniform(*self.params)
+    median, sigma = self.params
+    return median * self.rng.lognormvariate(0, sigma)
+
+
+def _timestamp(seconds):
+  """replicate style iso timestamp for a time.time() value"""
+  return (datetime(1970, 1, 1) + timedelta(seconds=seconds)).isoformat() + "Z"
+
+
+def stub_prediction_id(number, created, started, completed, failed):
+  # the schedule is carried in the id so the stub api can answer for predictions
+  # created in another process, see `stub_prediction_json`
+  return f"stub-{number}-{created:.3f}-{started:.3f}-{completed:.3f}-{int(failed)}"
+
+
+def stub_prediction_json(prediction_id, now=None):
+  """the api's json for a stub prediction, with the metrics and timestamps the client model drops"""
+  _, _, created, started, completed, failed = prediction_id.split("-")
+  created, started, completed, failed = float(created), float(started), float(completed), failed == "1"
+  now = time.time() if now is None else now
+  prediction = {"id": prediction_id, "status": "starting", "created_at": _timestamp(created), "started_at": None, "completed_at": None, "metrics": {}}
+  if now >= completed:
+    prediction.update(
+      status="failed" if failed else "succeeded",
+      started_at=_timestamp(started),
+      completed_at=_timestamp(completed),
+      metrics={"predict_time": completed - started},
+    )
+  elif now >= started:
+    prediction.update(status="processing", started_at=_timestamp(started))
+  return prediction
+
+
+class StubPrediction:
+  """
+  quacks like a replicate 0.4.0 prediction that finishes on a precomputed schedule.
+  like the real model it has no metrics or timestamps, those come from the stub api
+  """
+
+  def __init__(self, id, input, output, created, started, completed, failed):
+    self.id = id
+    self.input = input
+    self.version = None
+    self._output = output
+    self._started = started
+    self._completed = completed
+    self._failed = failed
+    self.status = "starting"
+    self.output = None
+    self.error = None
+    self.logs = ""
+    self.reload()
+
+
+  def reload(self):
+    now = time.time()
+    if now >= self._completed:
+      if self._failed:
+        self.status = "failed"
+        self.error = "stub failure"
+      else:
+        self.status = "succeeded"
+        self.output = self._output
+    elif now >= self._started:
+      self.status = "processing"
+
+
+  def wait(self):
+    remaining = self._completed - time.time()
+    if remaining > 0:
+      time.sleep(remaining)
+    self.reload()
+
+
+  def cancel(self):
+    self._completed = min(self._completed, time.time())
+    self._failed = True
+
+
+class StubPredictions:
+  def __init__(self, latency: LatencyDistribution, output_url: str, failure_rate: float = 0.0, gpu_slots: int = 0, seed: int = None):
+    self.latency = latency
+    self.output_url = output_url
+    self.failure_rate = failure_rate
+    # finish times of the simulated gpus, predictions queue for the first free one
+    self.slots = [0.0] * gpu_slots
+    self.predictions = {}
+    self.ids = itertools.count()
+    self.rng = random.Random(seed)
+    self._lock = Lock()
+
+
+  def create(self, version=None, input=None):
+    input = input or {}
+    now = time.time()
+    with self._lock:
+      predict_seconds = self.latency.sample()
+      started = now
+      if self.slots:
+        started = max(now, heapq.heappop(self.slots))
+        heapq.heappush(self.slots, started + predict_seconds)
+      failed = self.rng.random() < self.failure_rate
+      prediction_id = stub_prediction_id(next(self.ids), now, started, started + predict_seconds, failed)
+    if "input_image" in input:
+      # the segmentation model returns a single mask url
+      output = f"{self.output_url}/mask.png"
+    else:
+      output = [f"{self.output_url}/image-{index}.png" for index in range(input.get("num_outputs", 1))]
+    prediction = StubPrediction(prediction_id, input, output, now, started, started + predict_seconds, failed)
+    with self._lock:
+      self.predictions[prediction_id] = prediction
+    return prediction
+
+
+  def get(self, id):
+    prediction = self.predictions[id]
+    prediction.reload()
+    return prediction
+
+
+class StubModel:
+  def __init__(self, name):
+    self.name = name
+    self.versions = types.SimpleNamespace(
+      get=lambda id: types.SimpleNamespace(id=id),
+      list=lambda: [types.SimpleNamespace(id="stub")],
+    )
+
+
+def install_replicate_stub(predictions: StubPredictions):
+  """put a fake replicate module in sys.modules, must run before anything imports replicate"""
+  module = types.ModuleType("replicate")
+  module.predictions = predictions
+  module.models = types.SimpleNamespace(get=StubModel)
+  module.default_client = None
+  sys.modules["replicate"] = module
+  return module
+
+
+def latency_storage(latency: LatencyDistribution):
+  """output storage that only sleeps, so a long run doesn't keep every output in memory"""
+  from components.storage import BaseStorage
+
+  class LatencyStorage(BaseStorage):
+    def write(self, key, data):
+      time.sleep(latency.sample())
+      return f"memory://{key}"
+
+    def read(self, key):
+      raise FileNotFoundError(key)
+
+    def exists(self, key):
+      return False
+
+    def list(self, prefix):
+      return []
+
+  return LatencyStorage()
+
+
+def encode(image, image_format="PNG", **params):
+  output = BytesIO()
+  image.save(output, format=image_format, **params)
+  return output.getvalue()
+
+
+def subject_alpha(size):
+  """an ellipse in the middle of the frame standing in for a product cut out"""
+  alpha = Image.new("L", size, 0)
+  width, height = size
+  ImageDraw.Draw(alpha).ellipse((width // 4, height // 4, 3 * width // 4, 3 * height // 4), fill=255)
+  return alpha
+
+
+def synthetic_image(seed):
+  rng = random.Random(seed)
+  gradient = Image.linear_gradient("L").resize((512, 512))
+  channels = [gradient.rotate(rng.choice((0, 90, 180, 270))) for _ in range(3)]
+  return Image.merge("RGB", channels)
+
+
+def load_sources(directories, max_sources):
+  sources = []
+  for directory in directories:
+    if not os.path.isdir(directory):
+      continue
+    for name in sorted(os.listdir(directory)):
+      if name.lower().endswith(IMAGE_EXTENSIONS) and len(sources) < max_sources:
+        sources.append(Image.open(os.path.join(directory, name)).convert("RGB"))
+  if not sources:
+    logger.warning(f"no fixture images found in {', '.join(directories)}, using synthetic images")
+    sources = [synthetic_image(seed) for seed in range(max(1, min(max_sources, 4)))]
+  return sources
+
+
+def build_fixtures(sources, sizes, quality: int = 90):
+  """encode every source at every size (longest side) once, up front"""
+  fixtures = []
+  for source in sources:
+    for size in sizes:
+      scale = size / max(source.size)
+      dimensions = (max(1, round(source.width * scale)), max(1, round(source.height * scale)))
+      image = source.resize(dimensions, Image.LANCZOS)
+      alpha = subject_alpha(dimensions)
+      foreground = image.copy()
+      foreground.putalpha(alpha)
+      fixtures.append({
+        "size": size,
+        "image": encode(image, "JPEG", quality=quality),
+        # inpainting masks have the background white
+        "mask": encode(alpha.point(lambda value: 255 - value).convert("1")),
+        "foreground": encode(foreground),
+      })
+  return fixtures
+
+
+class OutputServer:
+  """
+  serves the stub prediction outputs, each download sleeps for the fetch latency,
+  and the stub replicate api's `/v1/predictions/{id}`
+  """
+
+  def __init__(self, image, mask, latency: LatencyDistribution, host: str = "127.0.0.1"):
+    files = {"/mask.png": mask}
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.startswith("/v1/predictions/"):
+          try:
+            body = json.dumps(stub_prediction_json(self.path.rsplit("/", 1)[1])).encode()
+            status = 200
+          except ValueError:
+            body, status = b'{"detail": "Not found."}', 404
+          self.send_response(status)
+          self.send_header("Content-Type", "application/json")
+          self.send_header("Content-Length", str(len(body)))
+          self.end_headers()
+          self.wfile.write(body)
+          return
+        time.sleep(latency.sample())
+        body = files.get(self.path, image)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    self.httpd = ThreadingHTTPServer((host, 0), Handler)
+    self.httpd.daemon_threads = True
+    self.url = f"http://{host}:{self.httpd.server_address[1]}"
+
+
+  def start(self):
+    Thread(target=self.httpd.serve_forever, daemon=True).start()
+    return self
+
+
+  def stop(self):
+    self.httpd.shutdown()
+
+
+def parse_mix(spec: str):
+  """`endpoint=weight,...` -> (endpoints, weights)"""
+  endpoints, weights = [], []
+  for item in spec.split(","):
+    name, _, weight = item.strip().partition("=")
+    if name not in ENDPOINTS:
+      raise ValueError(f"unknown endpoint {name!r} in mix, choose from {', '.join(ENDPOINTS)}")
+    endpoints.append(name)
+    weights.append(float(weight or 1))
+  return endpoints, weights
+
+
+def send_request(session, base_url, endpoint, fixture, timeout):
+  """send one request, returns the response status code"""
+  if endpoint == "health":
+    return session.get(f"{base_url}/health", timeout=timeout).status_code
+  if endpoint.startswith("create-binary-mask"):
+    mask_gen = endpoint.partition(":")[2]
+    return session.post(
+      f"{base_url}/create-binary-mask",
+      params={"mask_gen": mask_gen},
+      files={"input_image": ("image.jpg", fixture["image"], "image/jpeg")},
+      timeout=timeout,
+    ).status_code
+  if endpoint == "infill-background":
+    return session.post(
+      f"{base_url}/infill-background",
+      params={"prompt": "a mountain valley at sunrise", "num_outputs": 2},
+      files={
+        "input_image": ("image.jpg", fixture["image"], "image/jpeg"),
+        "mask_image": ("mask.png", fixture["mask"], "image/png"),
+      },
+      timeout=timeout,
+    ).status_code
+  if endpoint == "generate-background":
+    return session.post(
+      f"{base_url}/generate-background",
+      json={"prompt": "a mountain valley at sunrise", "num_outputs": 1},
+      timeout=timeout,
+    ).status_code
+  if endpoint == "overlay-image":
+    return session.post(
+      f"{base_url}/overlay-image",
+      params={"x_pos": 0, "y_pos": 0},
+      files={
+        "background_file": ("background.jpg", fixture["image"], "image/jpeg"),
+        "foreground_file": ("foreground.png", fixture["foreground"], "image/png"),
+      },
+      timeout=timeout,
+    ).status_code
+  if endpoint == "overlay-batch":
+    # one placement per scene at two scales, so the foreground is resized more than once
+    placements = [{"scene": scene, "x": 0, "y": 0, "scale": 1.0 if scene % 2 else 0.5} for scene in range(OVERLAY_BATCH_SCENES)]
+    return session.post(
+      f"{base_url}/overlay-batch",
+      data={"placements": json.dumps(placements)},
+      files=[("foreground_file", ("foreground.png", fixture["foreground"], "image/png"))] + [
+        ("background_files", (f"background-{scene}.jpg", fixture["image"], "image/jpeg"))
+        for scene in range(OVERLAY_BATCH_SCENES)
+      ],
+      timeout=timeout,
+    ).status_code
+  raise ValueError(endpoint)
+
+
+def percentile(sorted_values, fraction):
+  """nearest rank percentile of an already sorted list"""
+  if not sorted_values:
+    return None
+  index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+  return sorted_values[index]
+
+
+def summarize(samples, elapsed):
+  """samples are (latency seconds, status code or None for a client error)"""
+  latencies = sorted(latency for latency, _ in samples)
+  status_codes = defaultdict(int)
+  for _, status in samples:
+    status_codes[str(status) if status is not None else "error"] += 1
+  errors = sum(1 for _, status in samples if status is None or status >= 400)
+  return {
+    "requests": len(samples),
+    "errors": errors,
+    "error_rate": errors / len(samples) if samples else 0.0,
+    "shed": status_codes.get("429", 0) + status_codes.get("503", 0),
+    "throughput_rps": len(samples) / elapsed if elapsed else 0.0,
+    "status_codes": dict(status_codes),
+    "latency_ms": {
+      "p50": _ms(percentile(latencies, 0.50)),
+      "p95": _ms(percentile(latencies, 0.95)),
+      "p99": _ms(percentile(latencies, 0.99)),
+      "mean": _ms(sum(latencies) / len(latencies)) if latencies else None,
+      "max": _ms(latencies[-1]) if latencies else None,
+    },
+  }
+
+
+def _ms(seconds):
+  return None if seconds is None else round(seconds * 1000, 2)
+
+
+def run_level(base_url, concurrency, duration, endpoints, weights, fixtures, timeout, seed):
+  """closed loop: `concurrency` clients each send their next request as soon as the last one returns"""
+  import requests
+
+  samples = []
+  samples_lock = Lock()
+  deadline = time.perf_counter() + duration
+
+  def client(index):
+    rng = random.Random(seed * 1000 + index)
+    session = requests.Session()
+    local_samples = []
+    while time.perf_counter() < deadline:
+      endpoint = rng.choices(endpoints, weights)[0]
+      fixture = rng.choice(fixtures)
+      start_time = time.perf_counter()
+      try:
+        status = send_request(session, base_url, endpoint, fixture, timeout)
+      except Exception as e:
+        logger.debug(f"{endpoint} failed: {e}")
+        status = None
+      local_samples.append((endpoint, fixture["size"], time.perf_counter() - start_time, status))
+    session.close()
+    with samples_lock:
+      samples.extend(local_samples)
+
+  start_time = time.perf_counter()
+  threads = [Thread(target=client, args=(index,)) for index in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.perf_counter() - start_time
+
+  by_endpoint = defaultdict(list)
+  by_size = defaultdict(list)
+  for endpoint, size, latency, status in samples:
+    by_endpoint[endpoint].append((latency, status))
+    by_size[size].append((latency, status))
+  return {
+    "concurrency": concurrency,
+    "duration_seconds": round(elapsed, 3),
+    **summarize([(latency, status) for _, _, latency, status in samples], elapsed),
+    "endpoints": {endpoint: summarize(endpoint_samples, elapsed) for endpoint, endpoint_samples in by_endpoint.items()},
+    "image_sizes": {str(size): summarize(size_samples, elapsed) for size, size_samples in by_size.items()},
+  }
+
+
+def find_saturation(levels):
+  """the level after which adding clients stops adding meaningful throughput"""
+  best = None
+  for level in levels:
+    if best is not None and level["throughput_rps"] < best["throughput_rps"] * (1 + SATURATION_GAIN):
+      break
+    best = level
+  if best is None:
+    return None
+  return {"concurrency": best["concurrency"], "throughput_rps": best["throughput_rps"], "p95_ms": best["latency_ms"]["p95"]}
+
+
+def wait_until_ready(base_url, timeout, process=None):
+  import requests
+
+  deadline = time.perf_counter() + timeout
+  while time.perf_counter() < deadline:
+    if process is not None and process.poll() is not None:
+      raise RuntimeError(f"server exited with code {process.returncode} before becoming ready")
+    try:
+      if requests.get(f"{base_url}/ready", timeout=5).status_code == 200:
+        return
+    except Exception:
+      pass
+    time.sleep(0.5)
+  raise TimeoutError(f"{base_url} not ready after {timeout} seconds")
+
+
+def serve(args):
+  """run the api with stubbed replicate and output storage, used as the load test subprocess"""
+  os.environ["STORAGE_BACKEND"] = "memory"
+  # prediction timings are read from the stub api, as they are from replicate's
+  os.environ["REPLICATE_API_URL"] = args.output_url
+  install_replicate_stub(StubPredictions(
+    latency=LatencyDistribution(args.replicate_latency, args.seed),
+    output_url=args.output_url,
+    failure_rate=args.replicate_failure_rate,
+    gpu_slots=args.replicate_gpus,
+    seed=args.seed,
+  ))
+  import api
+  api.output_storage = latency_storage(LatencyDistribution(args.storage_latency, args.seed))
+
+  import server
+  server.serve(host="127.0.0.1", port=args.port, workers=args.workers)
+
+
+def start_server(args, output_url):
+  command = [
+    sys.executable, os.path.abspath(__file__), "--serve",
+    "--port", str(args.port),
+    "--workers", str(args.workers),
+    "--output-url", output_url,
+    "--replicate-latency", args.replicate_latency,
+    "--replicate-failure-rate", str(args.replicate_failure_rate),
+    "--replicate-gpus", str(args.replicate_gpus),
+    "--storage-latency", args.storage_latency,
+    "--seed", str(args.seed),
+  ]
+  logger.info(f"starting stubbed server on port {args.port} with {args.workers} worker(s)...")
+  return subprocess.Popen(command)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Load test the api')
+  parser.add_argument('--target', type=str, default=None, help='Base url of a running server to load, by default a stubbed server is started')
+  parser.add_argument('--mix', type=str, default=DEFAULT_MIX, help=f'Weighted endpoints, `endpoint=weight,...` out of {", ".join(ENDPOINTS)}')
+  parser.add_argument('--sizes', type=str, default='512,1024,2048', help='Longest side of the uploaded images, each request picks one at random')
+  parser.add_argument('--fixtures', type=str, default=','.join(FIXTURE_DIRS), help='Directories to take fixture images from')
+  parser.add_argument('--max-fixtures', type=int, default=8, help='Max number of fixture images to load')
+  parser.add_argument('--concurrency', type=str, default='1,2,4,8,16,32', help='Concurrency levels to step through')
+  parser.add_argument('--duration', type=float, default=30, help='Seconds to run each concurrency level')
+  parser.add_argument('--request-timeout', type=float, default=120, help='Client side timeout for one request')
+  parser.add_argument('--output', type=str, default=None, help='Path to write the json report, printed to stdout if not set')
+  parser.add_argument('--seed', type=int, default=0, help='Random seed for the request mix and stub latencies')
+  # stubbed server args
+  parser.add_argument('--port', type=int, default=8765, help='Port for the stubbed server')
+  parser.add_argument('--workers', type=int, default=1, help='Worker processes for the stubbed server')
+  parser.add_argument('--replicate-latency', type=str, default='lognormal:4,0.5', help='Stub prediction run time: fixed:S, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA')
+  parser.add_argument('--replicate-failure-rate', type=float, default=0.0, help='Fraction of stub predictions that fail')
+  parser.add_argument('--replicate-gpus', type=int, default=0, help='Stub predictions run on this many simulated gpus and queue for a free one, 0 for unlimited')
+  parser.add_argument('--fetch-latency', type=str, default='fixed:0.05', help='Latency of downloading a stub prediction output')
+  parser.add_argument('--storage-latency', type=str, default='lognormal:0.08,0.4', help='Latency of writing an output to (stub) storage')
+  parser.add_argument('--ready-timeout', type=float, default=300, help='Seconds to wait for the server to load its models')
+  # internal, runs the stubbed server in this process
+  parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+  parser.add_argument('--output-url', type=str, default=None, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.serve:
+    serve(args)
+    return
+
+  endpoints, weights = parse_mix(args.mix)
+  sizes = [int(size) for size in args.sizes.split(",")]
+  concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+  sources = load_sources(args.fixtures.split(","), args.max_fixtures)
+  fixtures = build_fixtures(sources, sizes)
+  logger.info(f"built {len(fixtures)} fixture(s) from {len(sources)} image(s) at sizes {sizes}")
+
+  output_server = None
+  process = None
+  base_url = args.target
+  if base_url is None:
+    # outputs look like stable diffusion results, masks like the segmentation model's
+    output_image = sources[0].resize((768, 768), Image.LANCZOS)
+    output_server = OutputServer(
+      image=encode(output_image),
+      mask=encode(subject_alpha(output_image.size)),
+      latency=LatencyDistribution(args.fetch_latency, args.seed),
+    ).start()
+    process = start_server(args, output_server.url)
+    base_url = f"http://127.0.0.1:{args.port}"
+
+  try:
+    wait_until_ready(base_url, args.ready_timeout, process)
+    levels = []
+    for concurrency in concurrency_levels:
+      logger.info(f"running {concurrency} concurrent client(s) for {args.duration} seconds...")
+      level = run_level(base_url, concurrency, args.duration, endpoints, weights, fixtures, args.request_timeout, args.seed)
+      logger.info(
+        f"concurrency {concurrency}: {level['throughput_rps']:.2f} req/s, "
+        f"p50 {level['latency_ms']['p50']} ms, p95 {level['latency_ms']['p95']} ms, "
+        f"error rate {level['error_rate']:.1%}"
+      )
+      levels.append(level)
+  finally:
+    if process is not None:
+      process.terminate()
+      process.wait()
+    if output_server is not None:
+      output_server.stop()
+
+  report = {
+    "config": {
+      "target": args.target or "stub",
+      "mix": dict(zip(endpoints, weights)),
+      "sizes": sizes,
+      "duration_seconds": args.duration,
+      "workers": args.workers if args.target is None else None,
+      "replicate_latency": args.replicate_latency if args.target is None else None,
+      "replicate_gpus": args.replicate_gpus if args.target is None else None,
+      "storage_latency": args.storage_latency if args.target is None else None,
+    },
+    "levels": levels,
+    "saturation": find_saturation(levels),
+  }
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2)
+    logger.info(f"wrote load test report to {args.output}")
+  else:
+    print(json.dumps(report, indent=2))
+
+
+
+if __name__ == '__main__':
+  main()
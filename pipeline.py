@@ -1,10 +1,20 @@
 import argparse
+from datetime import datetime
+import json
 import logging
+import os
 
-from components.local_mask_generate import LocalMaskGen
-from components.replicate_inpaint import ReplicateInPainting
-from components.replicate_mask_generate import ReplicateMaskGen
-from components.overlay_image import OverlayImage
+# each stage's component (and its backends) is only imported when the stage runs
+import components
+from components.compositing import ANCHORS, DEFAULT_ANCHOR, Placement
+from components.dedup import DEFAULT_MAX_DISTANCE, DedupReport
+from components.http_client import get_http_client
+from components.lazy_import import import_timings
+from components.manifest import CHUNK_SIZE, FORMATS, read_manifest
+from components.mask_postprocess import MaskPostProcessor
+from components.profiling import Profiler, maybe_profile
+from components.storage import get_storage
+from components.usage import get_usage_ledger
 
 
 logging.basicConfig()
@@ -12,6 +22,30 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+def load_placements(path, scene_names):
+  """
+  placements from a json list of {"scene", "x", "y", "scale", "anchor"}, scene is
+  a file name in the scenes directory or an index into its sorted listing
+  """
+  with open(path) as f:
+    entries = json.load(f)
+  placements = []
+  for entry in entries:
+    scene = entry.get("scene", 0)
+    if isinstance(scene, str):
+      if scene not in scene_names:
+        raise ValueError(f"placement refers to scene {scene!r} which is not in the scenes directory")
+      scene = scene_names.index(scene)
+    placements.append(Placement(
+      scene=scene,
+      x=entry.get("x", 0),
+      y=entry.get("y", 0),
+      scale=entry.get("scale", 1.0),
+      anchor=entry.get("anchor", DEFAULT_ANCHOR),
+    ))
+  return placements
+
+
 def main():
   parser = argparse.ArgumentParser(description='Stable diffusion pipeline')
   # mask args
@@ -22,8 +56,21 @@ def main():
   parser.add_argument('--input-path', type=str, default='background-images', help='[MASK] Path to input image(s)')
   parser.add_argument('--no-bg-path', type=str, default='no-bg-images', help='[MASK] Path to no background image(s)')
   parser.add_argument('--mask-path', type=str, default='mask-images', help='[MASK] Path to mask image(s)')
+  parser.add_argument('--mask-threshold', type=int, default=MaskPostProcessor.THRESHOLD, help='[MASK] Segmentation value (0-255) above which a pixel is subject')
+  parser.add_argument('--mask-erode', type=int, default=MaskPostProcessor.ERODE, help='[MASK] Pixels to shrink the subject by so the inpainter redraws the fringe')
+  parser.add_argument('--mask-dilate', type=int, default=MaskPostProcessor.DILATE, help='[MASK] Pixels to grow the subject by')
+  parser.add_argument('--mask-feather', type=float, default=MaskPostProcessor.FEATHER, help='[MASK] Blur sigma for the edge of no background images, 0 to disable')
+  parser.add_argument('--no-mask-refine', dest='mask_refine', action='store_false', help='[MASK] Disable guided filter refinement of mask edges')
+  parser.add_argument('--no-fill-holes', dest='fill_holes', action='store_false', help='[MASK] Keep holes inside the subject')
+  parser.set_defaults(mask_refine=True, fill_holes=True)
   # inpainting args
   parser.add_argument('--inpainting', action='store_true', help="[In-Painting] Enable inpainting to run")
+  parser.add_argument('--journal', type=str, default=None, help='[In-Painting] Path of a journal to resume an interrupted batch from, off by default')
+  parser.add_argument('--no-resume', dest='resume', action='store_false', help='[In-Painting] Discard the existing journal and run every file again')
+  parser.add_argument('--manifest', type=str, default=None, help='[In-Painting] Csv or jsonl manifest of files with their prompt, num_outputs, num_inference_steps and placement')
+  parser.add_argument('--manifest-format', type=str, default=None, choices=FORMATS, help='[In-Painting] Format of --manifest, guessed from the extension by default')
+  parser.add_argument('--manifest-chunk-size', type=int, default=CHUNK_SIZE, help='[In-Painting] Manifest rows submitted and waited for together')
+  parser.set_defaults(resume=True)
   # parser.add_argument('--no-inpainting', dest='inpainting', action='store_false', help="[In-Painting] Disable inpainting from running")
   # parser.set_defaults(inpainting=False)
   # overlay args
@@ -39,22 +86,72 @@ def main():
   parser.add_argument('--background-path', type=str, default=None, help='[Overlay] Path to background image for overlaying')
   parser.add_argument('--foreground-path', type=str, default=None, help='[Overlay] Path to foreground image for overlaying')
   parser.add_argument('--output-path', type=str, default=None, help='[Overlay] Path to output image from overlaying')
+  parser.add_argument('--overlay-batch', action='store_true', help='[Overlay] overlay --foreground-path onto every image in --scenes-dir')
+  parser.add_argument('--scenes-dir', type=str, default='scenes', help='[Overlay] Directory of scenes for --overlay-batch')
+  parser.add_argument('--placements', type=str, default=None, help='[Overlay] Json file of placements for --overlay-batch, defaults to one per scene')
+  parser.add_argument('--scale', type=float, default=1.0, help='[Overlay] Foreground size for --overlay-batch as a fraction of the largest size that fits the scene')
+  parser.add_argument('--anchor', type=str, default=DEFAULT_ANCHOR, choices=list(ANCHORS), help='[Overlay] Where --overlay-batch lines the foreground up with the scene, --x-pos and --y-pos offset from it')
+  parser.add_argument('--output-dir', type=str, default='output-images', help='[Overlay] Directory to write --overlay-batch outputs to')
+  # storage args
+  parser.add_argument('--storage', type=str, default='local', choices=['local', 'memory', 'gcs'], help='Where images are read from and written to')
+  parser.add_argument('--storage-root', type=str, default='.', help='Root directory for `local` storage, `memory` storage reads missing inputs from here')
+  parser.add_argument('--bucket', type=str, default=None, help='Bucket name for `gcs` storage')
+  # near duplicate args
+  parser.add_argument('--dedup', action='store_true', help='Run mask generation once per group of near duplicate images')
+  parser.add_argument('--dedup-distance', type=int, default=DEFAULT_MAX_DISTANCE, help='Max perceptual hash distance (bits out of 64) for two images to count as duplicates')
+  parser.add_argument('--dedup-report', type=str, default=None, help='Path to write a json report of the inference calls avoided')
+  # usage args
+  parser.add_argument('--max-predictions', type=int, default=None, help='Stop creating replicate predictions after this many')
+  parser.add_argument('--max-predict-seconds', type=float, default=None, help='Stop creating replicate predictions once this many gpu seconds are used')
+  parser.add_argument('--usage-report', type=str, default=None, help='Path to write a json report of replicate usage')
+  # diagnostics
+  parser.add_argument('--profile', action='store_true', help='Capture a cpu profile and allocation snapshot per file (per batch for local masks)')
+  parser.add_argument('--profile-dir', type=str, default='profiles', help='Directory to write profiles to')
+  parser.add_argument('--profile-sample-rate', type=float, default=1.0, help='Fraction of files to profile with --profile')
+  parser.add_argument('--max-profiles', type=int, default=0, help='Delete the oldest profiles beyond this many, 0 keeps every profile')
+  parser.add_argument('--import-timings', action='store_true', help='Log the time spent importing each lazily loaded module')
   args = parser.parse_args()
 
 
+  # every stage reads and writes through the same storage
+  storage = get_storage(backend=args.storage, root=args.storage_root, bucket_name=args.bucket)
+
+  # shared by every stage so the report covers the whole run
+  dedup_report = DedupReport()
+  dedup_distance = args.dedup_distance if args.dedup else None
+
+  # every replicate prediction of this run is accounted under one batch id
+  usage = get_usage_ledger()
+  usage.set_budget(max_predictions=args.max_predictions, max_predict_seconds=args.max_predict_seconds)
+  batch_id = datetime.now().isoformat()
+
+  profiler = Profiler(directory=args.profile_dir, sample_rate=args.profile_sample_rate, max_profiles=args.max_profiles) if args.profile else None
+
   # set to None for later check
   mask_gen = None
 
   if args.mask.lower() == 'local':
     logger.info("using local mask generator...")
-    mask_gen = LocalMaskGen()
+    mask_gen = components.LocalMaskGen()
   elif args.mask.lower() == 'replicate':
     logger.info("using replicate hosted mask generator...")
-    mask_gen = ReplicateMaskGen()
+    mask_gen = components.ReplicateMaskGen()
+    mask_gen.set_usage_labels(endpoint="pipeline:mask", batch=batch_id)
   else:
     logger.warning("`--mask` argument not set to either `local` or `replicate`, not generating masks")
 
   if mask_gen:
+    mask_gen.set_storage(storage)
+    mask_gen.set_dedup(dedup_distance, dedup_report)
+    mask_gen.set_profiler(profiler)
+    mask_gen.set_mask_postprocessor(MaskPostProcessor(
+      threshold=args.mask_threshold,
+      fill_holes=args.fill_holes,
+      erode=args.mask_erode,
+      dilate=args.mask_dilate,
+      feather=args.mask_feather,
+      refine=args.mask_refine,
+    ))
     try:
       mask_gen.set_constants(
         batch=args.batch,
@@ -69,30 +166,113 @@ def main():
   
   if args.inpainting:
     logger.info("inpainting enabled...")
-    inpainter = ReplicateInPainting()
+    inpainter = components.ReplicateInPainting()
+    inpainter.set_storage(storage)
+    inpainter.set_profiler(profiler)
+    inpainter.set_usage_labels(endpoint="pipeline:inpainting", batch=batch_id)
+    if args.journal and not args.resume and os.path.isfile(args.journal):
+      logger.info(f"--no-resume set, discarding journal {args.journal}")
+      os.remove(args.journal)
+    inpainter.set_journal(args.journal or None)
     logger.info("starting inpainting...")
-    inpainter.run()
+    if args.manifest:
+      inpainter.run_manifest(read_manifest(args.manifest, args.manifest_format), chunk_size=args.manifest_chunk_size)
+    else:
+      inpainter.run()
   else:
     logger.warning("`--inpainting` argument not set, not running inpaiting module")
   
 
   if args.overlay:
-    overlay = OverlayImage()
+    overlay = components.OverlayImage()
+    overlay.set_storage(storage)
+    overlay.set_usage_labels(endpoint="pipeline:overlay", batch=batch_id)
     if args.generate:
-      _ = overlay.generate_scenes(prompt=args.prompt, num_outputs=args.num_outputs)
+      with maybe_profile(profiler, "overlay generate scenes"):
+        _ = overlay.generate_scenes(prompt=args.prompt, num_outputs=args.num_outputs)
     if args.background_path and args.foreground_path and args.output_path:
-      _ = overlay.overlay_image(
-        background_path=args.background_path,
-        foreground_path=args.foreground_path,
-        output_path=args.output_path,
-        x_pos=args.x_pos,
-        y_pos=args.y_pos
-      )
-    else:
+      with maybe_profile(profiler, f"overlay {args.foreground_path}"):
+        _ = overlay.overlay_image(
+          background_path=args.background_path,
+          foreground_path=args.foreground_path,
+          output_path=args.output_path,
+          x_pos=args.x_pos,
+          y_pos=args.y_pos
+        )
+    elif not args.overlay_batch:
       logger.warning("need to set --background-path, --foreground-path, and --output-path to overlay images")
+    if args.overlay_batch:
+      if args.foreground_path:
+        scene_names = sorted(storage.list_images(args.scenes_dir))
+        default = Placement(x=args.x_pos, y=args.y_pos, scale=args.scale, anchor=args.anchor)
+        placements = []
+        if args.placements:
+          placements = load_placements(args.placements, scene_names)
+        elif args.manifest:
+          # manifest rows naming a scene place the foreground on it, other rows are for inpainting
+          scene_indexes = {name: index for index, name in enumerate(scene_names)}
+          placements = [
+            item.placement(scene=scene_indexes[item.filename], default=default)
+            for item in read_manifest(args.manifest, args.manifest_format)
+            if item.filename in scene_indexes
+          ]
+          if not placements:
+            logger.warning(f"no rows of {args.manifest} name a scene in {args.scenes_dir}, placing on every scene")
+        if not placements:
+          placements = [
+            Placement(scene=index, x=default.x, y=default.y, scale=default.scale, anchor=default.anchor)
+            for index in range(len(scene_names))
+          ]
+        with maybe_profile(profiler, f"overlay batch {args.foreground_path}"):
+          locations = overlay.overlay_batch(
+            foreground_path=args.foreground_path,
+            scene_paths=[f"{args.scenes_dir}/{name}" for name in scene_names],
+            placements=placements,
+            output_dir=args.output_dir,
+          )
+        logger.info(f"wrote {len([location for location in locations if location])} overlain image(s) to {args.output_dir}")
+      else:
+        logger.warning("need to set --foreground-path to batch overlay images")
   else:
     logger.warning("`--overlay` argument not set, not running overlay module")
 
+  if args.dedup:
+    report = dedup_report.to_dict()
+    logger.info(f"near duplicate grouping avoided {report['calls_avoided']} inference call(s)")
+    if args.dedup_report:
+      with open(args.dedup_report, "w") as f:
+        json.dump(report, f, indent=2)
+      logger.info(f"wrote dedup report to {args.dedup_report}")
+
+  usage_report = usage.to_dict()
+  if usage_report["totals"]["predictions"]:
+    totals = usage_report["totals"]
+    logger.info(
+      f"replicate usage: {totals['predictions']} prediction(s), {totals['inference_steps']} inference step(s), "
+      f"{totals['predict_seconds']:.1f} predict seconds, {totals['queue_seconds']:.1f} queue seconds"
+    )
+  if args.usage_report:
+    with open(args.usage_report, "w") as f:
+      json.dump(usage_report, f, indent=2)
+    logger.info(f"wrote usage report to {args.usage_report}")
+
+  downloads = get_http_client().metrics()["totals"]
+  if downloads["downloads"]:
+    logger.info(
+      f"downloaded {downloads['downloads']} output(s), {downloads['bytes'] / 1e6:.1f}MB in {downloads['seconds']:.1f} seconds "
+      f"(slowest {downloads['max_seconds']:.1f}), {downloads['retries']} retries, {downloads['failed']} failed"
+    )
+
+  if profiler is not None:
+    profiles = profiler.list()
+    logger.info(f"wrote {len(profiles)} profile(s) to {args.profile_dir}")
+    for profile in sorted(profiles, key=lambda profile: profile["wall_seconds"], reverse=True)[:5]:
+      logger.info(f"{profile['name']}: {profile['wall_seconds']:.3f} seconds, hottest {profile['hottest']}")
+
+  if args.import_timings:
+    for module_name, seconds in import_timings().items():
+      logger.info(f"import {module_name}: {seconds:.3f} seconds")
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,97 @@
+import argparse
+import gc
+import logging
+import multiprocessing
+import os
+
+from gunicorn.app.base import BaseApplication
+
+"""
+Production entry point. Loads the app and its models once in the parent process,
+then forks uvicorn workers that share the loaded models copy-on-write
+"""
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class ProductionServer(BaseApplication):
+  def __init__(self, application, options):
+    self.application = application
+    self.options = options
+    super().__init__()
+
+
+  def load_config(self):
+    for key, value in self.options.items():
+      if key in self.cfg.settings and value is not None:
+        self.cfg.set(key, value)
+
+
+  def load(self):
+    return self.application
+
+
+def default_workers():
+  return int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Stable diffusion pipeline api server')
+  parser.add_argument('--host', type=str, default='0.0.0.0', help='Address to bind to')
+  parser.add_argument('--port', type=int, default=int(os.environ.get("PORT", 80)), help='Port to bind to')
+  parser.add_argument('--workers', type=int, default=default_workers(), help='Number of worker processes, defaults to WEB_CONCURRENCY or the cpu count')
+  parser.add_argument('--timeout', type=int, default=300, help='Seconds a worker can be silent before it is restarted')
+  parser.add_argument('--keep-alive', type=int, default=300, help='Seconds to keep idle connections open')
+  parser.add_argument('--no-preload', dest='preload', action='store_false', help='Load models in each worker instead of the parent')
+  parser.set_defaults(preload=True)
+  args = parser.parse_args()
+  serve(
+    host=args.host,
+    port=args.port,
+    workers=args.workers,
+    timeout=args.timeout,
+    keep_alive=args.keep_alive,
+    preload=args.preload,
+  )
+
+
+def serve(host: str, port: int, workers: int, timeout: int = 300, keep_alive: int = 300, preload: bool = True):
+  # one onnx thread per worker keeps the onnx session fork safe so it can be
+  # built once here and shared, must be set before the registry is imported
+  if preload:
+    os.environ.setdefault("ONNX_THREADS_PER_WORKER", "1")
+
+  from api import app, preload_models
+  from components import model_registry
+
+  if preload:
+    logger.info("preloading models before forking workers...")
+    # a session with a thread pool would be thrown away and rebuilt in the worker,
+    # leave it to the worker unless it can be shared
+    if not model_registry.fork_safe():
+      logger.warning(
+        f"ONNX_THREADS_PER_WORKER={model_registry.ONNX_THREADS} can't be shared across the fork, "
+        "every worker loads its own rembg session"
+      )
+    preload_models(rembg=model_registry.fork_safe())
+    model_registry.close_connections()
+    # move everything loaded so far out of the gc's reach, otherwise the
+    # collector touches every object and breaks copy-on-write sharing
+    gc.freeze()
+
+  options = {
+    "bind": f"{host}:{port}",
+    "workers": workers,
+    "worker_class": "uvicorn.workers.UvicornWorker",
+    "timeout": timeout,
+    "keepalive": keep_alive,
+    "preload_app": preload,
+  }
+  logger.info(f"starting {workers} worker(s) on {options['bind']}")
+  ProductionServer(app, options).run()
+
+
+if __name__ == '__main__':
+  main()